@@ -1,12 +1,59 @@
-__all__ = ['copyfileobj']
+__all__ = ['copyfileobj', 'SizeLimitExceeded', 'remaining_size']
 
+import os
 import shutil
 
 
+class SizeLimitExceeded(IOError):
+    """
+    Raised when copying more than the allowed number of bytes.
+    """
+
+
+def remaining_size(f):
+    """
+    Return the number of bytes left to read from a real or in memory file, or
+    None if that can't be known without reading it.
+    """
+    try:
+        return os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    try:
+        offset = f.tell()
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(offset)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return size - offset
+
+
+class _LimitedReader(object):
+    """
+    Wraps a source file, raising SizeLimitExceeded as soon as more than
+    max_size bytes have been read from it.
+    """
+
+    def __init__(self, fsrc, max_size):
+        self._fsrc = fsrc
+        self._max_size = max_size
+        self._total = 0
+        if hasattr(fsrc, 'fileno'):
+            self.fileno = fsrc.fileno
+
+    def read(self, size=-1):
+        data = self._fsrc.read(size)
+        self._total += len(data)
+        if self._total > self._max_size:
+            raise SizeLimitExceeded('More than %s bytes'% self._max_size)
+        return data
+
+
 try:
     from fadvise import posix_fadvise, POSIX_FADV_DONTNEED
 
-    def copyfileobj(fsrc, fdst, length=16*1024, advise_after=1024*1024):
+    def _copyfileobj(fsrc, fdst, length=16*1024, advise_after=1024*1024):
         """
         Reimplementation of shutil.copyfileobj that advises the OS to remove
         parts of the source file from the OS's caches once copied to the
@@ -38,5 +85,22 @@ try:
         posix_fadvise(fsrc.fileno(), 0, 0, POSIX_FADV_DONTNEED)
 
 except ImportError:
-    copyfileobj = shutil.copyfileobj
+    _copyfileobj = shutil.copyfileobj
+
+
+def copyfileobj(fsrc, fdst, length=16*1024, max_size=None):
+    """
+    Copy the source file-like object to the destination in chunks of length
+    bytes.
+
+    If max_size is given, SizeLimitExceeded is raised before anything is
+    copied when the source is known to be too large, or as soon as more than
+    max_size bytes have been read otherwise.
+    """
+    if max_size is not None:
+        size = remaining_size(fsrc)
+        if size is not None and size > max_size:
+            raise SizeLimitExceeded('%s bytes is more than %s'% (size, max_size))
+        fsrc = _LimitedReader(fsrc, max_size)
+    return _copyfileobj(fsrc, fdst, length)
 
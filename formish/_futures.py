@@ -0,0 +1,136 @@
+"""
+A small thread pool executor with futures, a subset of the concurrent.futures
+API for use on Pythons without it.
+
+An object with a compatible submit method, such as a
+concurrent.futures.ThreadPoolExecutor, can be used wherever an executor is
+accepted.
+"""
+
+__all__ = ['Future', 'ThreadExecutor']
+
+import sys
+import threading
+import Queue
+
+import logging
+log = logging.getLogger('formish')
+
+
+class Future(object):
+    """
+    The result of a call running in an executor.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """ Has the call finished? """
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return its result, or raise its
+        exception.
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Wait for the call to finish and return its exception or None """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) once the call has finished, straight away if it has
+        already. Callbacks run in the thread that finished the call.
+        """
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        self._call(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _wait(self, timeout):
+        self._done.wait(timeout)
+        if not self.done():
+            raise RuntimeError('Timed out waiting for the result')
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            self._call(fn)
+
+    def _call(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            log.exception('Future callback %r failed' % (fn,))
+
+
+class ThreadExecutor(object):
+    """
+    Runs calls in a fixed number of daemon threads, started when first
+    needed.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """ Queue fn(*args, **kwargs) and return its Future """
+        self._start()
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+            del future, fn, args, kwargs
@@ -0,0 +1,167 @@
+"""
+Per-key locking, used to make sure only one thread (and optionally process)
+does some expensive work for a key at a time.
+"""
+
+__all__ = ['KeyLocks']
+
+import os
+import os.path
+import threading
+from hashlib import md5
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Marks a stripe whose file is being locked by a thread.
+_LOCKING = object()
+
+
+class KeyLocks(object):
+    """
+    A set of exclusive locks, one per key.
+
+    Locks are always held within the process. If a lock_dir is given (and
+    the platform supports flock) a lock file is also locked in that directory
+    so that processes sharing the directory exclude each other too. Keys
+    share a fixed number of lock files (stripes), chosen by a hash of the
+    key, so the directory never holds more than that many lock files. Keys
+    sharing a stripe only exclude each other across processes.
+
+    As unrelated keys share stripes, a process must not acquire a key while
+    holding another one if other processes share the lock_dir, otherwise two
+    processes can each hold the stripe the other is waiting for.
+
+    Usage::
+
+        locks.acquire(key)
+        try:
+            ...
+        finally:
+            locks.release(key)
+    """
+
+    def __init__(self, lock_dir=None, stripes=256):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._lock = threading.Lock()
+        # key -> [lock, number of threads holding or waiting]
+        self._locks = {}
+        # stripe -> [stripe, open and locked file (or _LOCKING or None),
+        #            number of threads holding it]
+        self._stripes = {}
+        self._stripes_changed = threading.Condition(self._lock)
+
+    def acquire(self, key):
+        """ Block until the lock for the key is held """
+        self._lock.acquire()
+        try:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        finally:
+            self._lock.release()
+        entry[0].acquire()
+        try:
+            self._acquire_stripe(key)
+        except:
+            self._release(key, entry)
+            raise
+
+    def release(self, key):
+        """ Release the lock for the key """
+        entry = self._locks[key]
+        try:
+            self._release_stripe(key)
+        finally:
+            self._release(key, entry)
+
+    def _release(self, key, entry):
+        entry[0].release()
+        self._lock.acquire()
+        try:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+        finally:
+            self._lock.release()
+
+    def _stripe(self, key):
+        """ Return the key's stripe entry, or None if files aren't locked """
+        if self.lock_dir is None or fcntl is None:
+            return None
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        stripe = int(md5(key).hexdigest()[:8], 16) % self.stripes
+        self._lock.acquire()
+        try:
+            entry = self._stripes.get(stripe)
+            if entry is None:
+                entry = self._stripes[stripe] = [stripe, None, 0]
+            return entry
+        finally:
+            self._lock.release()
+
+    def _acquire_stripe(self, key):
+        """
+        Lock the key's stripe file. Threads of this process share the file
+        lock (they exclude each other with the per key locks), so holding
+        several keys of the same stripe can't deadlock.
+
+        No lock is held while waiting for another process to release the
+        file, threads wanting the same stripe wait for the locking thread to
+        finish.
+        """
+        entry = self._stripe(key)
+        if entry is None:
+            return
+        self._stripes_changed.acquire()
+        try:
+            while entry[1] is _LOCKING:
+                self._stripes_changed.wait()
+            if entry[2]:
+                entry[2] += 1
+                return
+            entry[1] = _LOCKING
+        finally:
+            self._stripes_changed.release()
+        lock_file = None
+        try:
+            filename = os.path.join(self.lock_dir, '.lock-%02x'% entry[0])
+            lock_file = open(filename, 'a')
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        except:
+            if lock_file is not None:
+                lock_file.close()
+            self._set_stripe(entry, None, 0)
+            raise
+        self._set_stripe(entry, lock_file, 1)
+
+    def _set_stripe(self, entry, lock_file, holders):
+        self._stripes_changed.acquire()
+        try:
+            entry[1] = lock_file
+            entry[2] = holders
+            self._stripes_changed.notifyAll()
+        finally:
+            self._stripes_changed.release()
+
+    def _release_stripe(self, key):
+        entry = self._stripe(key)
+        if entry is None:
+            return
+        self._stripes_changed.acquire()
+        try:
+            entry[2] -= 1
+            if not entry[2]:
+                lock_file, entry[1] = entry[1], None
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                finally:
+                    lock_file.close()
+        finally:
+            self._stripes_changed.release()
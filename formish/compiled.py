@@ -0,0 +1,392 @@
+"""
+Compiled rendering for formish's structural templates.
+
+A form is normally rendered by a cascade of template calls: every field
+renders ``field/main.html`` which, in turn, renders the field's seqdelete,
+seqgrab, label, inputs, error and description templates, each going through a
+template lookup. The functions in this module produce exactly the same markup
+as formish's own structural templates but build it directly in Python, leaving
+only the widget templates to the renderer.
+
+Compilation is only used when it is guaranteed to be invisible, i.e. when the
+form's renderer is a formish Renderer and every structural template an item
+needs resolves to the template shipped with formish. A plan recording this is
+built once per renderer and widget configuration; anything else (custom
+renderers, overridden templates, widget specific templates) is rendered by the
+templates as usual.
+
+The same functions can also produce the markup as a sequence of chunks in
+document order (see iter_form) so that a response can be sent while the rest
+of the form is still being rendered.
+"""
+
+import os.path
+import urllib
+import weakref
+
+from pkg_resources import resource_filename
+
+from formish.renderer import Renderer
+
+try:
+    from mako import exceptions, filters
+except ImportError:
+    exceptions = filters = None
+
+
+# Structural templates needed to compile an item, by template type.
+_ITEM_TEMPLATES = {
+    'field': ['field/main', 'field/label', 'field/inputs', 'field/error',
+              'field/description'],
+    'structure': ['structure/main', 'structure/label', 'structure/error',
+                  'structure/fields', 'structure/description'],
+    'sequence': ['sequence/main', 'sequence/label', 'sequence/error',
+                 'sequence/fields', 'sequence/description',
+                 'sequence/metadata'],
+    }
+
+# Sequence hooks are always rendered from the field templates.
+_HOOK_TEMPLATES = ['field/seqdelete', 'field/seqgrab']
+
+# Form level templates needed to compile a whole form.
+_FORM_TEMPLATES = ['/formish/form/main.html', '/formish/form/fields.html']
+
+# Widgets whose widget template can be rendered in chunks.
+_WIDGET_TEMPLATE = '/formish/widgets/%s/widget.html'
+
+
+_plans = weakref.WeakKeyDictionary()
+
+
+def get_plan(renderer):
+    """
+    Return the compiled rendering plan for the renderer or None if the
+    renderer cannot be compiled for.
+    """
+    if filters is None or not isinstance(renderer, Renderer):
+        return None
+    if renderer.__class__.__call__.im_func is not Renderer.__call__.im_func:
+        return None
+    if renderer.lookup.template_args.get('default_filters') != ['unicode', 'h']:
+        return None
+    try:
+        return _plans[renderer]
+    except KeyError:
+        plan = _plans[renderer] = Plan(renderer.lookup)
+        return plan
+
+
+class Plan(object):
+    """
+    Records which items can be rendered without their structural templates.
+
+    Template resolution is done once per (template type, widget) pair so that
+    rendering a compiled item never touches the template lookup.
+    """
+
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self.builtin_dir = os.path.abspath(resource_filename('formish', 'templates/mako'))
+        self._items = {}
+        self._widgets = {}
+        self._form = None
+
+    def compiles_item(self, template_type, widget):
+        """ Can an item of the template type and widget be compiled? """
+        try:
+            return self._items[(template_type, widget)]
+        except KeyError:
+            names = _ITEM_TEMPLATES.get(template_type)
+            compiles = names is not None
+            if compiles:
+                for name in names + _HOOK_TEMPLATES:
+                    if self._exists('/formish/widgets/%s/%s.html'%(widget, name)) \
+                            or not self._is_builtin('/formish/%s.html'%name):
+                        compiles = False
+                        break
+            self._items[(template_type, widget)] = compiles
+            return compiles
+
+    def compiles_form(self):
+        """ Can the form level main and fields templates be compiled? """
+        if self._form is None:
+            self._form = True
+            for uri in _FORM_TEMPLATES:
+                if not self._is_builtin(uri):
+                    self._form = False
+                    break
+        return self._form
+
+    def compiles_widget(self, widget):
+        """ Can the widget's (builtin) widget template be compiled? """
+        try:
+            return self._widgets[widget]
+        except KeyError:
+            compiles = widget in _WIDGETS and self._is_builtin(_WIDGET_TEMPLATE % widget)
+            self._widgets[widget] = compiles
+            return compiles
+
+    def _exists(self, uri):
+        try:
+            self.lookup.get_template(uri)
+        except exceptions.TopLevelLookupException:
+            return False
+        return True
+
+    def _is_builtin(self, uri):
+        try:
+            template = self.lookup.get_template(uri)
+        except exceptions.TopLevelLookupException:
+            return False
+        filename = os.path.abspath(template.filename)
+        return filename == os.path.join(self.builtin_dir, *uri.split('/'))
+
+
+def render_form(form):
+    """
+    Render the whole form, equivalent to the /formish/form/main.html template,
+    or return None if the form can't be compiled.
+    """
+    chunks = iter_form(form)
+    if chunks is None:
+        return None
+    return u''.join(chunks)
+
+
+def iter_form(form):
+    """
+    Return an iterator of chunks of the whole form in document order (header,
+    metadata, alert, error list, fields, actions and footer), which joined are
+    equivalent to the /formish/form/main.html template, or return None if the
+    form can't be compiled.
+
+    Fields that can be compiled are split further, e.g. a sequence yields a
+    chunk per item and a Grid a chunk per row. Anything else is a single
+    chunk rendered as usual.
+    """
+    plan = get_plan(form.renderer)
+    if plan is None or not plan.compiles_form():
+        return None
+    return _iter_form(form)
+
+
+def _iter_form(form):
+    yield u'%s\n%s\n%s\n%s\n' % (
+        form.header(), form.metadata(), form.alert(), form.error_list())
+    for chunk in _iter_fields(form.fields):
+        yield chunk
+    yield u'\n%s\n%s\n' % (form.actions(), form.footer())
+
+
+def render_item(item):
+    """
+    Render a form item (field, group or sequence) equivalent to its main
+    template, or return None if the item can't be compiled.
+    """
+    chunks = _iter_main(item)
+    if chunks is None:
+        return None
+    return u''.join(chunks)
+
+
+def iter_item(item):
+    """
+    Return an iterator of chunks of a form item, which joined are equivalent
+    to calling the item.
+    """
+    chunks = _iter_main(item)
+    if chunks is None:
+        return iter([item()])
+    return chunks
+
+
+def _iter_main(item):
+    plan = get_plan(item.form.renderer)
+    if plan is None:
+        return None
+    template_type, widget = item.form._plan.template(item.widget.template)
+    if not plan.compiles_item(template_type, widget):
+        return None
+    return _MAIN[template_type](item)
+
+
+def render_fields(fields):
+    """ Render a sequence of items, one per line """
+    return u''.join([u'%s\n' % f() for f in fields])
+
+
+def _iter_fields(fields):
+    for f in fields:
+        for chunk in iter_item(f):
+            yield chunk
+        yield u'\n'
+
+
+def _h(value):
+    """ Apply the renderer's default filters to a value """
+    return filters.html_escape(unicode(value))
+
+
+def _parent_flag(item, flag):
+    parentkey = '.'.join(item.name.split('.')[:-1])
+    if not parentkey:
+        return False
+    parent = item.form.get_field(parentkey)
+    return getattr(parent.widget, flag, False) != False
+
+
+def _seqdelete(item):
+    if not _parent_flag(item, 'addremove'):
+        return u''
+    return u'\n<span class="seqdelete"></span>\n'
+
+
+def _seqgrab(item):
+    if not _parent_flag(item, 'sortable'):
+        return u''
+    return u'\n<span class="seqgrab"></span>\n'
+
+
+def _oneify(key):
+    def try_one_base(v):
+        try:
+            return str(int(v)+1)
+        except ValueError:
+            return v
+    return ','.join([try_one_base(k) for k in key.split('.')])
+
+
+def _field_main(item):
+    yield u'<div id="%s--field" class="%s">\n%s\n%s\n%s\n\n<div class="inputs">\n' % (
+        _h(item.cssname), _h(item.classes), _seqdelete(item), _seqgrab(item),
+        _field_label(item))
+    for chunk in _iter_widget(item):
+        yield chunk
+    yield u'\n</div>\n\n%s\n%s\n</div>\n' % (
+        _field_error(item), _description(item, 'span'))
+
+
+def _field_label(item):
+    if item.widget.type == 'Hidden':
+        return u'\n\n'
+    if item.required:
+        required = u'<span class="required-marker">*</span>'
+    else:
+        required = u''
+    return u'\n\n<label for="%s">%s%s</label>\n' % (
+        _h(item.cssname), _h(item.title), required)
+
+
+def _iter_widget(item):
+    """ The widget's markup, in chunks if its template can be compiled """
+    if item.widget.readonly != True:
+        plan = get_plan(item.form.renderer)
+        widget_type, widget = item.form._plan.template(item.widget.template)
+        if plan.compiles_widget(widget):
+            return _WIDGETS[widget](item)
+    return [item.widget()]
+
+
+def _grid_widget(item):
+    rows = list(item.fields)
+    if not rows:
+        # Let the template fail in its own way.
+        yield item.widget()
+        return
+    out = [u'\n\n\n\n<table id="%s">\n  <thead>\n    <tr>\n' % _h(item.cssname)]
+    for f in rows[0].fields:
+        out.append(u'      <th>%s</th>\n' % _h(f.title))
+    out.append(u'    </tr>\n  </thead>\n\n')
+    yield u''.join(out)
+    for row in rows:
+        yield u'  <tr>\n%s  </tr>\n' % u''.join(
+            [u'<td>%s</td>\n' % f.widget() for f in row.fields])
+    yield u'</table>\n'
+
+
+def _field_error(item):
+    out = [u'\n\n']
+    if item.error:
+        out.append(u'<span class="error">%s</span><br />\n' % _h(unicode(item.error)))
+    out.append(u'\n')
+    if item.contains_error:
+        for key, error in item.contained_errors:
+            out.append(u'<span class="error">item %s "%s"</span><br />\n' % (
+                _h(_oneify(key)), _h(error)))
+    return u''.join(out)
+
+
+def _description(item, element):
+    description = item.description
+    if not description:
+        return u'\n'
+    return u'\n<%s class="description">%s</%s>\n' % (
+        element, _h(description), element)
+
+
+def _structure_main(item):
+    if item.title:
+        label = u'\n<legend class="group">%s</legend>\n' % _h(item.title)
+    else:
+        label = u'\n'
+    if hasattr(item.errors, 'message'):
+        error = u'\n<span class="error">%s</span>\n' % _h(unicode(item.error))
+    else:
+        error = u'\n'
+    yield u'<fieldset id="%s--field" class="%s">\n%s\n%s\n%s\n%s\n\n' % (
+        _h(item.cssname), _h(item.classes), _seqdelete(item), _seqgrab(item),
+        label, error)
+    for chunk in _iter_fields(item.fields):
+        yield chunk
+    yield u'\n%s\n</fieldset>\n' % _description(item, 'div')
+
+
+def _sequence_main(item):
+    widget = item.widget
+    if widget.addremove is True:
+        addremoveclass = ' addremove'
+    else:
+        addremoveclass = ''
+    if widget.sortable is True:
+        sortableclass = ' sortable'
+    else:
+        sortableclass = ''
+    if item.title:
+        label = u'\n<legend>%s</legend>\n' % _h(item.title)
+    else:
+        label = u'\n'
+    if hasattr(item.errors, 'message'):
+        error = u'\n<div class="error">%s</div>\n' % _h(unicode(item.error))
+    else:
+        error = u'\n'
+    yield (u'\n\n<fieldset id="%s--field" class="%s%s%s">\n'
+           u'  <span class="formish-sequencedata" title="batch_add_count=%s"> </span>\n'
+           u'%s\n%s\n%s\n%s\n\n') % (
+        _h(item.cssname), _h(item.classes), _h(addremoveclass), _h(sortableclass),
+        _h(widget.batch_add_count), _seqdelete(item), _seqgrab(item), label,
+        error)
+    for chunk in _iter_fields(item.fields):
+        yield chunk
+    yield u'\n%s\n%s\n</fieldset>\n' % (
+        _description(item, 'div'), _sequence_metadata(item))
+
+
+def _sequence_metadata(item):
+    if item.widget.addremove is not True:
+        return u'\n\n\n\n\n\n'
+    template = item.template
+    return u'\n\n\n\n\n\n   <input type="hidden" name="%s" class="adder" value="\n  %s\n" />\n' % (
+        _h(template.name), urllib.quote(template().encode('utf-8')))
+
+
+# Generators of the chunks of each type of item's main template.
+_MAIN = {
+    'field': _field_main,
+    'structure': _structure_main,
+    'sequence': _sequence_main,
+    }
+
+# Generators of the chunks of widget templates, by widget.
+_WIDGETS = {
+    'Grid': _grid_widget,
+    }
@@ -1,13 +1,35 @@
 """
 The fileresource provides a basic restish fileresource for assets and images
 
-Requires ImageMagick for image resizing
+Images are resized in process using PIL when it is installed, otherwise
+ImageMagick's convert is required for image resizing
+
+Text files are served gzip compressed to clients that accept it, or brotli
+compressed when the brotli module is installed.
 """
-import tempfile, os, subprocess, shutil
+import tempfile, os, subprocess, shutil, uuid, threading, Queue, cgi, time
+import gzip
+import multiprocessing
+from cStringIO import StringIO
+from email.utils import formatdate, mktime_tz, parsedate_tz
 from restish import http, resource
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from formish import util
-from formish.filestore import CachedTempFilestore, FileSystemHeaderedFilestore
+from formish._copyfile import remaining_size
+from formish._keylock import KeyLocks
+from formish._futures import ThreadExecutor
+from formish.filestore import CachedTempFilestore, FileSystemHeaderedFilestore, \
+        delete_many
 
 import logging
 log = logging.getLogger('formish')
@@ -31,7 +53,7 @@ class FileResource(resource.Resource):
         cache = CachedTempFilestore(FileSystemHeaderedFilestore(root_dir=cache_dirname))
         return cls(store, cache)
 
-    def __init__(self, filestores=None, cache=None):
+    def __init__(self, filestores=None, cache=None, resizer=None, lock_dir=None):
         """
         Create a FileResource to serve application and/or cached files.
 
@@ -48,6 +70,24 @@ class FileResource(resource.Resource):
         of None is used to represent the unnamed filestore, allowing an
         application to configure the resource to serve files from a default and
         a set of named filestores.
+
+        The resizer is the callable used to resize images, see resize_image,
+        and defaults to PIL when it is installed or convert when it isn't.
+
+        Passing a ResizePool as the resizer runs resizes in a bounded pool of
+        processes. When the pool is full a 503 response with a Retry-After
+        of retry_after seconds is returned, or the original image is served
+        if serve_original_when_busy is set.
+
+        Only one request at a time resizes a given image, others wait and are
+        then served the cached result. Passing a lock_dir (e.g. the cache's
+        directory) extends this to all processes sharing the directory.
+
+        Files whose content type starts with one of compress_types, and that
+        are at least compress_min_size bytes, are served compressed with the
+        first of encodings the client accepts. Compressed copies are kept in
+        the cache alongside resized images. Set encodings to [] to serve
+        files as they are stored.
         """
         self.cache = cache
         # Build a dict of filestores.
@@ -60,6 +100,18 @@ class FileResource(resource.Resource):
             filestores['tmp'] = CachedTempFilestore()
         self.filestores = filestores
         self.resize_quality = 70
+        if resizer is None:
+            resizer = resize_image
+        self.resizer = resizer
+        self.resize_locks = KeyLocks(lock_dir)
+        self.retry_after = 5
+        self.serve_original_when_busy = False
+        self.chunk_size = 64*1024
+        self.encodings = [encoding for encoding in ['br', 'gzip'] if encoding in ENCODERS]
+        self.compress_types = ['text/', 'application/json', 'application/javascript',
+                               'application/xml', 'image/svg+xml']
+        self.compress_min_size = 256
+        self.compress_level = 6
 
     @resource.child(resource.any)
     def child(self, request, segments):
@@ -88,33 +140,30 @@ class FileResource(resource.Resource):
         try:
             cache_tag, headers, f = filestore.get(filename, etag)
             content_type = dict(headers)['Content-Type']
+            modified = last_modified(headers, f)
         except KeyError:
-            # XXX if the original is not their, clear resize cache (this would mean a globbing delete every request!)
-            # cache_filename = filestore.name+'_'+filename
-            # self.cache.delete(cache_filename, glob=True)
+            # The original has gone, so remove any resized copies of it.
+            if self.cache is not None:
+                self.invalidate_derivatives(filestore_name, filename)
             return 
         try:
             width, height, ismax = get_size_from_dict(request.GET)
         except ValueError:
             return http.bad_request()
-        if request.GET.get('crop'):
-            crop = True
-            cropmark = '-crop'
-        else:
-            crop = False
-            cropmark = ''
+        crop = bool(request.GET.get('crop'))
         size = get_size_suffix(width, height, ismax)
 
         if not size:
+            if self.compressible(content_type):
+                return self.encoded_response(request, filestore_name, filename, etag,
+                                             cache_tag, content_type, f, modified)
             if f:
-                data = f.read()
-                f.close()
-                return http.ok([('Content-Type', content_type ),('ETag', cache_tag)], data)
+                return self.file_response(request, f, [('Content-Type', content_type ),('ETag', cache_tag)], modified)
             else:
                 return http.not_modified([('ETag', cache_tag)])
 
         try:
-            cache_filename = (filestore_name or '')+'_'+filename+size+cropmark
+            cache_filename = get_cache_filename(filestore_name, filename, size, crop)
             resized_cache_tag, headers, rf = self.cache.get(cache_filename, etag)
             content_type = dict(headers)['Content-Type']
             resize_needed = resized_cache_tag != cache_tag
@@ -125,53 +174,959 @@ class FileResource(resource.Resource):
             resize_needed = True
 
         if resize_needed:
-            if f is None:
+            self.resize_locks.acquire(cache_filename)
+            try:
+                # Another request may have resized the image while we waited.
+                rf = self.get_resized(cache_filename, cache_tag)
+                if rf is not None:
+                    if f is not None:
+                        f.close()
+                    return self.file_response(request, rf, [('Content-Type', content_type ),('ETag', cache_tag)], modified)
+                if f is None:
+                    try:
+                        cache_tag, headers, f = filestore.get(filename)
+                        content_type = dict(headers)['Content-Type']
+                        modified = last_modified(headers, f)
+                    except KeyError:
+                        return 
                 try:
-                    cache_tag, headers, f = filestore.get(filename)
-                    content_type = dict(headers)['Content-Type']
-                except KeyError:
-                    return 
-            rf = resize_image(f, (width, height), ismax, quality=self.resize_quality, crop=crop)
-            f.close()
-            self.cache.put(cache_filename, rf, cache_tag, [('Content-Type', content_type)])
+                    rf = self.resizer(f, (width, height), ismax, quality=self.resize_quality, crop=crop)
+                except ResizeBusy:
+                    return self.busy_response(request, f, content_type)
+                f.close()
+                self.cache.put(cache_filename, rf, cache_tag, [('Content-Type', content_type)])
+            finally:
+                self.resize_locks.release(cache_filename)
+            self.add_derivative(filestore_name, filename, cache_tag, cache_filename)
             rf.seek(0)
-            data = rf.read()
-            rf.close()
-            return http.ok([('Content-Type', content_type ),('ETag', cache_tag)], data)
+            return self.file_response(request, rf, [('Content-Type', content_type ),('ETag', cache_tag)], modified)
         
+        if f is not None:
+            f.close()
         if rf:
-            data = rf.read()
-            rf.close()
-            return http.ok([('Content-Type', content_type ),('ETag', cache_tag)], data)
+            return self.file_response(request, rf, [('Content-Type', content_type ),('ETag', cache_tag)], modified)
         else:
             return http.not_modified([('ETag', cache_tag)])
-       
+
+    def generate(self, filestore_name, filename, args):
+        """
+        Make sure the cache holds an up to date resized copy of a stored
+        image, as described by request args such as {'size': '20x20'}. This
+        allows resized images to be made before they are first requested.
+
+        :returns: True if the image was resized, False if it wasn't needed.
+        :raises KeyError: the file or filestore was not found.
+        """
+        width, height, ismax = get_size_from_dict(args)
+        crop = bool(args.get('crop'))
+        size = get_size_suffix(width, height, ismax)
+        if not size:
+            return False
+        cache_filename = get_cache_filename(filestore_name, filename, size, crop)
+        filestore = self.filestores[filestore_name]
+        cache_tag, headers = get_headers(filestore, filename)
+        content_type = dict(headers)['Content-Type']
+        if not content_type.startswith('image/'):
+            return False
+        self.resize_locks.acquire(cache_filename)
+        try:
+            try:
+                if get_headers(self.cache, cache_filename)[0] == cache_tag:
+                    return False
+            except KeyError:
+                pass
+            cache_tag, headers, f = filestore.get(filename)
+            try:
+                rf = self.resizer(f, (width, height), ismax, quality=self.resize_quality, crop=crop)
+            finally:
+                f.close()
+            try:
+                self.cache.put(cache_filename, rf, cache_tag, [('Content-Type', content_type)])
+            finally:
+                rf.close()
+        finally:
+            self.resize_locks.release(cache_filename)
+        self.add_derivative(filestore_name, filename, cache_tag, cache_filename)
+        return True
+
+    def compressible(self, content_type):
+        """ Should files of the content type be served compressed? """
+        if not self.encodings or self.cache is None:
+            return False
+        content_type = content_type.split(';')[0].strip().lower()
+        for compress_type in self.compress_types:
+            if content_type.startswith(compress_type):
+                return True
+        return False
+
+    def encoded_response(self, request, filestore_name, filename, etag, cache_tag,
+                         content_type, f, modified):
+        """
+        Respond with the stored file (f, or None if the client's copy is
+        current) compressed with an encoding the client accepts, or as it is
+        if it accepts none or the file is small.
+
+        Each encoding is a separate representation with its own ETag, the
+        original's cache_tag plus the encoding, and all the responses vary
+        by Accept-Encoding.
+        """
+        vary = [('Vary', 'Accept-Encoding')]
+        if f is None:
+            return http.not_modified([('ETag', cache_tag)] + vary)
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'), self.encodings)
+        size = remaining_size(f)
+        if encoding is None or (size is not None and size < self.compress_min_size):
+            return self.file_response(request, f, [('Content-Type', content_type),
+                                                   ('ETag', cache_tag)] + vary, modified)
+        encoded_tag = '%s-%s'% (cache_tag, encoding)
+        if etag == encoded_tag:
+            f.close()
+            return http.not_modified([('ETag', encoded_tag)] + vary)
+        headers = [('Content-Type', content_type), ('Content-Encoding', encoding),
+                   ('ETag', encoded_tag)] + vary
+        cache_filename = get_cache_filename(filestore_name, filename, '-%s'% encoding, False)
+        ef = self.get_resized(cache_filename, cache_tag)
+        if ef is None:
+            encoded = False
+            self.resize_locks.acquire(cache_filename)
+            try:
+                # Another request may have compressed the file while we waited.
+                ef = self.get_resized(cache_filename, cache_tag)
+                if ef is None:
+                    ef = tempfile.TemporaryFile()
+                    ENCODERS[encoding](f, ef, self.compress_level, self.chunk_size)
+                    ef.seek(0)
+                    self.cache.put(cache_filename, ef, cache_tag,
+                                   [('Content-Type', content_type), ('Content-Encoding', encoding)])
+                    ef.seek(0)
+                    encoded = True
+            finally:
+                self.resize_locks.release(cache_filename)
+            if encoded:
+                self.add_derivative(filestore_name, filename, cache_tag, cache_filename)
+        f.close()
+        return self.file_response(request, ef, headers, modified)
+
+    def add_derivative(self, filestore_name, filename, cache_tag, cache_filename):
+        """
+        Record a resized image, cached as cache_filename, in the derivative
+        index of the stored file it was made from. The index is kept in the
+        cache with the original's cache_tag; if that has changed, the resized
+        images of the previous version are removed first.
+
+        This takes the index's lock, so it must be called after the resized
+        image's lock is released (see KeyLocks).
+        """
+        index_key = get_derivative_index_key(filestore_name, filename)
+        self.resize_locks.acquire(index_key)
+        try:
+            index_cache_tag, keys = self._read_derivatives(index_key)
+            if index_cache_tag != cache_tag:
+                delete_many(self.cache, [key for key in keys if key != cache_filename])
+                keys = []
+            if cache_filename not in keys:
+                keys.append(cache_filename)
+                self.cache.put(index_key, StringIO('\n'.join(keys)), cache_tag)
+        finally:
+            self.resize_locks.release(index_key)
+
+    def invalidate_derivatives(self, filestore_name, filename):
+        """
+        Remove all the cached resized images of a stored file, e.g. once the
+        file has been deleted.
+        """
+        index_key = get_derivative_index_key(filestore_name, filename)
+        self.resize_locks.acquire(index_key)
+        try:
+            index_cache_tag, keys = self._read_derivatives(index_key)
+            if keys:
+                delete_many(self.cache, keys + [index_key])
+        finally:
+            self.resize_locks.release(index_key)
+
+    def _read_derivatives(self, index_key):
+        """
+        Return (cache_tag, cache filenames) from a derivative index, or
+        (None, []) if there isn't one.
+        """
+        try:
+            cache_tag, headers, f = self.cache.get(index_key)
+        except KeyError:
+            return None, []
+        try:
+            return cache_tag, [key for key in f.read().split('\n') if key]
+        finally:
+            f.close()
+
+    def busy_response(self, request, f, content_type):
+        """
+        Respond when an image can't be resized because the resizer is busy,
+        either with a 503 or, if serve_original_when_busy is set, with the
+        original image. The original isn't given a cache validator so that
+        the client doesn't keep it in place of the resized image.
+        """
+        if self.serve_original_when_busy:
+            return self.file_response(request, f, [('Content-Type', content_type),
+                                                   ('Cache-Control', 'no-store')])
+        f.close()
+        return http.Response('503 Service Unavailable',
+                             [('Retry-After', str(self.retry_after))], '')
+
+    def get_resized(self, cache_filename, cache_tag):
+        """
+        Return the open cached resized image if it's up to date with the
+        original's cache_tag, otherwise None.
+        """
+        try:
+            resized_cache_tag, headers, rf = self.cache.get(cache_filename)
+        except KeyError:
+            return None
+        if resized_cache_tag != cache_tag:
+            rf.close()
+            return None
+        return rf
+
+    def file_response(self, request, f, headers, modified=None):
+        """
+        Return a response streaming the rest of the open file f, which is
+        closed once the response is sent.
+
+        Conditional (If-Modified-Since) and byte range (Range, If-Range)
+        requests are handled, returning 304, 206 or 416 responses as
+        appropriate. modified is the file's modification time in seconds,
+        used for Last-Modified.
+
+        Full responses use the server's wsgi.file_wrapper when available
+        (allowing the file to be sent using sendfile), otherwise the file is
+        read in chunks.
+        """
+        headers = list(headers)
+        if modified is not None:
+            headers.append(('Last-Modified', formatdate(modified, usegmt=True)))
+            if not_modified_since(request, modified):
+                f.close()
+                return http.not_modified(headers)
+        size = remaining_size(f)
+        if size is None:
+            return http.ok(headers, file_body(request, f, self.chunk_size))
+        headers.append(('Accept-Ranges', 'bytes'))
+        ranges = None
+        if if_range(request, dict(headers).get('ETag'), modified):
+            ranges = parse_ranges(request.headers.get('Range'), size)
+        if ranges is None:
+            headers.append(('Content-Length', str(size)))
+            return http.ok(headers, file_body(request, f, self.chunk_size))
+        if not ranges:
+            f.close()
+            headers.append(('Content-Range', 'bytes */%s'% size))
+            return http.Response('416 Requested Range Not Satisfiable', headers, '')
+        offset = f.tell()
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers.extend([('Content-Range', 'bytes %s-%s/%s'% (start, end-1, size)),
+                            ('Content-Length', str(end-start))])
+            parts = [('', start, end)]
+            closing = ''
+        else:
+            boundary = uuid.uuid4().hex
+            content_type = dict(headers).get('Content-Type')
+            headers = [(name, value) for name, value in headers
+                       if name != 'Content-Type']
+            parts = []
+            length = 0
+            for n, (start, end) in enumerate(ranges):
+                part_headers = []
+                if content_type:
+                    part_headers.append('Content-Type: %s'% content_type)
+                part_headers.append('Content-Range: bytes %s-%s/%s'% (start, end-1, size))
+                preamble = '%s--%s\r\n%s\r\n\r\n'% (
+                    ['', '\r\n'][n > 0], boundary, '\r\n'.join(part_headers))
+                parts.append((preamble, start, end))
+                length += len(preamble) + end - start
+            closing = '\r\n--%s--\r\n'% boundary
+            length += len(closing)
+            headers.extend([
+                ('Content-Type', 'multipart/byteranges; boundary=%s'% boundary),
+                ('Content-Length', str(length))])
+        return http.Response('206 Partial Content', headers,
+                             iter_file_ranges(f, offset, parts, closing, self.chunk_size))
+
+
+class AsyncFileServer(object):
+    """
+    Serves a FileResource's files to an event loop driven server, running the
+    blocking work (filestore access, resizing and reading the files) in a
+    thread pool so the loop only ever waits on futures.
+
+    serve returns a future of the same response the resource would give,
+    including conditional, range, cached and resized responses. Its body is
+    then read a chunk at a time with body(response).read(). Done callbacks
+    run in the pool's thread so the loop should hand results back to its own
+    thread (e.g. with IOLoop.add_callback or reactor.callFromThread).
+    """
+
+    def __init__(self, resource, executor=None, workers=8):
+        """
+        :arg resource: the FileResource whose files are served.
+        :arg executor: the executor to run calls in, anything with a
+            concurrent.futures style submit method. Defaults to a
+            ThreadExecutor of workers threads.
+        """
+        if executor is None:
+            executor = ThreadExecutor(workers)
+        self.resource = resource
+        self.executor = executor
+
+    def serve(self, request, path):
+        """
+        Return a future of the response for the file at path, relative to
+        where the resource is mounted.
+        """
+        return self.executor.submit(self._serve, request, path)
+
+    def body(self, response):
+        """ Return an AsyncBody to read the response's body with """
+        return AsyncBody(self.executor, response.app_iter)
+
+    def _serve(self, request, path):
+        filestore, key = util.decode_file_resource_path(path)
+        etag = str(request.if_none_match)
+        response = self.resource.get_file(request, filestore, key, etag)
+        if response:
+            return response
+        return http.not_found()
+
+
+class AsyncBody(object):
+    """
+    Reads a response body, a WSGI iterable, in an executor.
+    """
+
+    def __init__(self, executor, app_iter):
+        self.executor = executor
+        self.app_iter = app_iter
+        self._iter = None
+
+    def read(self):
+        """
+        Return a future of the body's next chunk, or of '' once it has all
+        been read (at which point the body is closed). Only one read should be
+        outstanding at a time.
+        """
+        return self.executor.submit(self._read)
+
+    def close(self):
+        """ Close the body, e.g. when the client has gone away """
+        return self.executor.submit(self._close)
+
+    def _read(self):
+        if self._iter is None:
+            self._iter = iter(self.app_iter)
+        for data in self._iter:
+            if data:
+                return data
+        self._close()
+        return ''
+
+    def _close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def get_headers(filestore, key):
+    """
+    Return (cache_tag, headers) for a stored file without reading its
+    content, for filestores that support it.
+
+    :raises KeyError: not found
+    """
+    get_headers = getattr(filestore, 'get_headers', None)
+    if get_headers is not None:
+        return get_headers(key)
+    cache_tag, headers, f = filestore.get(key)
+    f.close()
+    return cache_tag, headers
+
+
+class DerivativePipeline(object):
+    """
+    Generates resized images of uploaded files in background threads so that
+    they are in the FileResource's cache before they are first requested.
+
+    Presets describe the resized images as request args, either a dict such
+    as {'size': '20x20', 'crop': '1'}, a query string such as
+    'max-size=100x100' or simply a size such as '20x20'. Pass the pipeline to
+    a FileUpload widget as its derivatives to generate these (and the
+    widget's thumbnail) for every uploaded image.
+    """
+
+    def __init__(self, resource, presets=None, workers=2):
+        """
+        :arg resource: the FileResource that will serve the files.
+        :arg presets: the resized images to generate for every file.
+        :arg workers: number of worker threads.
+        """
+        self.resource = resource
+        self.presets = [_preset_args(preset) for preset in presets or []]
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, filestore_name, key, presets=None):
+        """
+        Queue the generation of the resized images for a stored file, for the
+        pipeline's presets plus any extra presets given.
+        """
+        self._start()
+        all_args = []
+        for args in self.presets + [_preset_args(p) for p in presets or []]:
+            if args not in all_args:
+                all_args.append(args)
+                self._queue.put((filestore_name, key, args))
+
+    def join(self):
+        """ Wait until everything queued has been generated """
+        self._queue.join()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            filestore_name, key, args = self._queue.get()
+            try:
+                try:
+                    self.resource.generate(filestore_name, key, args)
+                except KeyError:
+                    # The file has gone already.
+                    pass
+                except ResizeBusy:
+                    # Try again once requests have had a chance.
+                    time.sleep(self.resource.retry_after)
+                    self._queue.put((filestore_name, key, args))
+                except Exception:
+                    log.exception('Failed to generate %r for %r' % (args, key))
+            finally:
+                self._queue.task_done()
+
+
+class ResizeBusy(Exception):
+    """
+    Raised by a ResizePool that has no room for another resize.
+    """
 
 
+class ResizePool(object):
+    """
+    A resizer that runs another resizer (resize_image by default) in a pool
+    of worker processes, keeping CPU bound image work out of the web
+    server's threads.
+
+    At most processes + queue_depth resizes are running or waiting at any
+    time; calling the pool when it is full raises ResizeBusy immediately
+    rather than queueing the request.
+    """
+
+    def __init__(self, resizer=None, processes=None, queue_depth=None):
+        """
+        :arg resizer: resizer run in the worker processes, which must be
+            importable by name (i.e. a module level function).
+        :arg processes: number of worker processes, defaults to the number
+            of CPUs.
+        :arg queue_depth: number of resizes allowed to wait for a process,
+            defaults to the number of processes.
+        """
+        if resizer is None:
+            resizer = resize_image
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if queue_depth is None:
+            queue_depth = processes
+        self.resizer = resizer
+        self.processes = processes
+        self.queue_depth = queue_depth
+        self._slots = threading.Semaphore(processes + queue_depth)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def __call__(self, src_fh, size, ismax, quality=70, crop=False):
+        if not self._slots.acquire(False):
+            raise ResizeBusy()
+        try:
+            return self._resize(src_fh, size, ismax, quality, crop)
+        finally:
+            self._slots.release()
+
+    def _resize(self, src_fh, size, ismax, quality, crop):
+        # Pass the worker a name for the open file to read, copying the
+        # source to a temporary file if it doesn't have one. The file's own
+        # name isn't used as a new file may have been put in its place.
+        src_name = _open_file_name(src_fh)
+        if src_name is not None:
+            offset, tmp_name = src_fh.tell(), None
+        else:
+            fileno, tmp_name = tempfile.mkstemp()
+            fh = os.fdopen(fileno, 'wb')
+            try:
+                shutil.copyfileobj(src_fh, fh)
+            finally:
+                fh.close()
+            src_name, offset = tmp_name, 0
+        try:
+            resized_filename = self._get_pool().apply_async(_resize_file,
+                (self.resizer, src_name, offset, size, ismax, quality, crop)).get()
+        finally:
+            if tmp_name is not None:
+                os.remove(tmp_name)
+        try:
+            # The open file stays readable once its name is removed.
+            return open(resized_filename, 'rb')
+        finally:
+            os.remove(resized_filename)
+
+    def _get_pool(self):
+        self._lock.acquire()
+        try:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes)
+            return self._pool
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """ Stop the worker processes """
+        self._lock.acquire()
+        try:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+        finally:
+            self._lock.release()
+
+
+def _open_file_name(f):
+    """
+    Return a name that another process can open the open file f by (on
+    systems with /proc), or None.
+    """
+    try:
+        fileno = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+    name = '/proc/%d/fd/%d'% (os.getpid(), fileno)
+    if not os.path.isfile(name):
+        return None
+    return name
+
+
+def _resize_file(resizer, src_name, offset, size, ismax, quality, crop):
+    """
+    Resize part of a ResizePool, run in a worker process. Returns the name of
+    a temporary file holding the resized image.
+    """
+    src_fh = open(src_name, 'rb')
+    try:
+        src_fh.seek(offset)
+        rf = resizer(src_fh, size, ismax, quality=quality, crop=crop)
+    finally:
+        src_fh.close()
+    try:
+        fileno, filename = tempfile.mkstemp()
+        fh = os.fdopen(fileno, 'wb')
+        try:
+            shutil.copyfileobj(rf, fh)
+        finally:
+            fh.close()
+    finally:
+        rf.close()
+    return filename
+
+
+def _preset_args(preset):
+    """
+    Convert a preset to a dict of request args.
+    """
+    if isinstance(preset, dict):
+        return preset
+    if '=' in preset:
+        return dict(cgi.parse_qsl(preset))
+    return {'size': preset}
+
+
+def get_cache_filename(filestore_name, filename, size, crop):
+    """
+    Return the key a resized image is cached as.
+    """
+    if crop:
+        cropmark = '-crop'
+    else:
+        cropmark = ''
+    return (filestore_name or '')+'_'+filename+size+cropmark
+
+
+def choose_encoding(header, encodings):
+    """
+    Return the first of the encodings allowed by an Accept-Encoding header,
+    or None if none of them are (or there's no header).
+    """
+    if not header:
+        return None
+    qualities = {}
+    for coding in header.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        qualities[name] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = qualities.get(encoding, qualities.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def gzip_file(src, dest, level=6, chunk_size=64*1024):
+    """
+    Write the rest of the open file src, gzip compressed, to dest.
+    """
+    gz = gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=dest, mtime=0)
+    try:
+        while True:
+            data = src.read(chunk_size)
+            if not data:
+                break
+            gz.write(data)
+    finally:
+        gz.close()
+
+
+def brotli_file(src, dest, level=6, chunk_size=64*1024):
+    """
+    Write the rest of the open file src, brotli compressed, to dest.
+    """
+    compressor = brotli.Compressor(quality=level)
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        dest.write(compressor.process(data))
+    dest.write(compressor.finish())
+
+
+# Content encodings that files can be compressed with.
+ENCODERS = {'gzip': gzip_file}
+if brotli is not None:
+    ENCODERS['br'] = brotli_file
+
+
+def get_derivative_index_key(filestore_name, filename):
+    """
+    Return the key the index of a stored file's resized images is cached as.
+    """
+    return get_cache_filename(filestore_name, filename, '-derivatives', False)
+
+
+def last_modified(headers, f):
+    """
+    Return the modification time, in seconds, of a stored file. This is the
+    Last-Modified header stored with the file if there is one, otherwise the
+    modification time of the file itself. None is returned if neither is
+    available.
+    """
+    value = dict(headers).get('Last-Modified')
+    if value:
+        return parse_http_date(value)
+    try:
+        return int(os.fstat(f.fileno()).st_mtime)
+    except (AttributeError, OSError, ValueError):
+        # In memory files (see MemoryTieredFilestore) may know the time.
+        return getattr(f, 'mtime', None)
 
-def resize_image(src_fh, size, ismax, quality=70, crop=False):
+
+def parse_http_date(value):
+    """
+    Parse an HTTP date into seconds since the epoch, or None if it's invalid.
+    """
+    try:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return mktime_tz(parsed)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def not_modified_since(request, modified):
+    """
+    Check the request's If-Modified-Since. If-None-Match, when sent, takes
+    precedence and has already been checked against the cache tag.
+    """
+    if request.headers.get('If-None-Match'):
+        return False
+    since = request.headers.get('If-Modified-Since')
+    if not since:
+        return False
+    since = parse_http_date(since)
+    return since is not None and int(modified) <= since
+
+
+def if_range(request, etag, modified):
+    """
+    Should the request's Range header be used? Only if there's no If-Range or
+    it matches the current entity tag or modification time.
+    """
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('W/'):
+        # Weak validators can't be used for ranges.
+        return False
+    if value.startswith('"') or parse_http_date(value) is None:
+        return etag is not None and value.strip('"') == etag
+    return modified is not None and parse_http_date(value) == int(modified)
+
+
+def parse_ranges(header, size):
+    """
+    Parse a Range header for a file of size bytes into a sorted list of
+    (start, end) pairs, with end exclusive, merging any that overlap.
+
+    None is returned if the header is missing or can't be parsed (so the
+    whole file should be sent) and an empty list if none of the ranges can
+    be satisfied.
+    """
+    if not header:
+        return None
+    units, _, ranges_spec = header.strip().partition('=')
+    if units.strip().lower() != 'bytes' or not ranges_spec.strip():
+        return None
+    ranges = []
+    for spec in ranges_spec.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        try:
+            first = first.strip() and int(first)
+            last = last.strip() and int(last)
+        except ValueError:
+            return None
+        if first == '':
+            # Suffix range, the last n bytes.
+            if last == '':
+                return None
+            if last == 0:
+                continue
+            ranges.append((max(size-last, 0), size))
+        else:
+            if first < 0 or (last != '' and last < first):
+                return None
+            if first >= size:
+                continue
+            if last == '' or last >= size:
+                last = size-1
+            ranges.append((first, last+1))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_body(request, f, chunk_size=64*1024):
+    """
+    Return an iterable WSGI response body for the open file f.
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(_unbuffered(f), chunk_size)
+    return iter_file(f, chunk_size)
+
+
+def iter_file_ranges(f, offset, parts, closing='', chunk_size=64*1024):
+    """
+    Yield parts of the open file f, closing it at the end (or when the
+    iterator is closed). parts is a list of (preamble, start, end) where the
+    preamble is yielded before the bytes from start to end of the file's
+    content, which begins at offset. closing is yielded at the end.
     """
+    try:
+        for preamble, start, end in parts:
+            if preamble:
+                yield preamble
+            f.seek(offset+start)
+            remaining = end-start
+            while remaining:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        if closing:
+            yield closing
+    finally:
+        f.close()
+
+
+def _unbuffered(f):
+    """
+    Return a file object for f with nothing read ahead, i.e. where the OS's
+    file position matches the file's position.
+
+    Reading the headers leaves some of the file in f's buffer so a wrapper
+    using sendfile would start from the wrong place.
+    """
+    if not hasattr(f, 'fileno'):
+        return f
+    offset = f.tell()
+    fd = os.dup(f.fileno())
+    f.close()
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.fdopen(fd, 'rb')
+
+
+def iter_file(f, chunk_size=64*1024):
+    """
+    Yield the contents of the open file f in chunks, closing it at the end
+    (or when the iterator is closed).
+    """
+    try:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+
+
+
+def convert_resize_image(src_fh, size, ismax, quality=70, crop=False):
+    """
+    Resize an image using ImageMagick's convert, returning a file-like object
+    for the resized image. The temporary files used are removed before
+    returning.
+
     this is an example identify
     '/home/tim/Desktop/tim.jpg JPEG 48x48 48x48+0+0 DirectClass 8-bit 920b \n'
     """
     fileno, filename = tempfile.mkstemp()
-    fh = os.fdopen(fileno, 'wb')
-    shutil.copyfileobj(src_fh, fh)
-    fh.close()
     resized_filename = filename + '-resized'
-    # Convert size and ismax args to string replacement values.
+    try:
+        fh = os.fdopen(fileno, 'wb')
+        shutil.copyfileobj(src_fh, fh)
+        fh.close()
+        # Convert size and ismax args to string replacement values.
+        width, height = size
+        width = width or ''
+        height = height or ''
+        ismax = ['', '>'][ismax]
+        if crop:
+            subprocess.call([CONVERT, '-thumbnail',
+            '%sx%s^'% (width, height), '-crop','%sx%s%s+0+0'% (width, height, ismax),'-gravity','center', '-quality', str(quality), filename, resized_filename])
+        else:
+            subprocess.call([CONVERT, '-thumbnail',
+            '%sx%s%s'% (width, height, ismax), '-quality', str(quality), filename, resized_filename])
+        # The open file stays readable once its name is removed.
+        return open(resized_filename,'rb')
+    finally:
+        for name in (filename, resized_filename):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def pil_resize_image(src_fh, size, ismax, quality=70, crop=False):
+    """
+    Resize an image in process using PIL, returning a file-like object for
+    the resized image in the original's format.
+
+    The size semantics are the same as convert's -thumbnail: the image is
+    scaled to fit within the size, only shrinking if ismax is set. Cropping
+    scales the image to cover the size and crops the centre.
+    """
+    # PIL reads from the start of the file, so copy the image (the rest of
+    # src_fh, which may be after a stored file's headers) to a file of its
+    # own.
+    image_fh = tempfile.SpooledTemporaryFile(1024*1024)
+    try:
+        shutil.copyfileobj(src_fh, image_fh)
+        image_fh.seek(0)
+        return _pil_resize(image_fh, size, ismax, quality, crop)
+    finally:
+        image_fh.close()
+
+
+def _pil_resize(src_fh, size, ismax, quality, crop):
+    image = Image.open(src_fh)
+    format = image.format or 'PNG'
     width, height = size
-    width = width or ''
-    height = height or ''
-    ismax = ['', '>'][ismax]
-    if crop:
-        subprocess.call([CONVERT, '-thumbnail',
-        '%sx%s^'% (width, height), '-crop','%sx%s%s+0+0'% (width, height, ismax),'-gravity','center', '-quality', str(quality), filename, resized_filename])
+    image_width, image_height = image.size
+    scales = []
+    if width:
+        scales.append(float(width)/image_width)
+    if height:
+        scales.append(float(height)/image_height)
+    if crop and width and height:
+        scale = max(scales)
     else:
-        subprocess.call([CONVERT, '-thumbnail',
-        '%sx%s%s'% (width, height, ismax), '-quality', str(quality), filename, resized_filename])
-        
-    return open(resized_filename,'rb')
+        scale = min(scales)
+    if not (ismax and scale >= 1):
+        new_size = (max(int(round(image_width*scale)), 1),
+                    max(int(round(image_height*scale)), 1))
+        if image.mode not in ('1', 'L', 'RGB', 'RGBA', 'I', 'F'):
+            # Resampling doesn't work for paletted images
+            image = image.convert('RGBA')
+        image = image.resize(new_size, Image.ANTIALIAS)
+    if crop and width and height:
+        image_width, image_height = image.size
+        left = max((image_width-width)//2, 0)
+        top = max((image_height-height)//2, 0)
+        image = image.crop((left, top, left+min(width, image_width),
+                            top+min(height, image_height)))
+    fh = tempfile.TemporaryFile()
+    if format == 'JPEG':
+        if image.mode not in ('L', 'RGB', 'CMYK'):
+            image = image.convert('RGB')
+        image.save(fh, format, quality=quality)
+    else:
+        if format == 'GIF' and image.mode != 'P':
+            image = image.convert('P', palette=Image.ADAPTIVE)
+        image.save(fh, format)
+    fh.seek(0)
+    return fh
+
+
+# The default image resizer.
+if Image is not None:
+    resize_image = pil_resize_image
+else:
+    resize_image = convert_resize_image
+
 
 def get_size_suffix(width, height, ismax):
     if width is None and height is None:
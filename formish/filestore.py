@@ -2,14 +2,438 @@
 Standard filehandlers for temporary storage of file uploads. Uses tempfile to
 make temporary files
 """
+import errno
 import os
 import os.path
+import re
+import shutil
+import struct
 import tempfile
+import threading
+import time
+import uuid
+from cStringIO import StringIO
+from hashlib import md5, sha1
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from formish import _copyfile, safefilename
+from formish._copyfile import SizeLimitExceeded
+from formish._futures import ThreadExecutor
+
+import logging
+log = logging.getLogger('formish')
+
+
+# Headered files start with a magic string, the format version and the length
+# of the header block, so the offset of the body is known from the first read.
+# Line breaks and backslashes in the block's names and values are backslash
+# escaped. Files written before the format was versioned just start with the
+# header lines, ended by a blank line.
+HEADER_MAGIC = 'FMHS'
+HEADER_VERSION = 1
+_header_prefix = struct.Struct('>4sBI')
+_header_escapes = {'\\': '\\\\', '\n': '\\n', '\r': '\\r'}
+_header_unescapes = {'\\': '\\', 'n': '\n', 'r': '\r'}
+
+
+def _write_headers(dest, headers):
+    """ Write the headers, in the current format, to the start of a file """
+    if isinstance(headers, dict):
+        headers = headers.items()
+    lines = []
+    for name, value in headers:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        lines.append('%s: %s\n' % (_escape_header('%s'% name), _escape_header('%s'% value)))
+    block = ''.join(lines)
+    dest.write(_header_prefix.pack(HEADER_MAGIC, HEADER_VERSION, len(block)))
+    dest.write(block)
+
+
+def _read_headers(f):
+    """
+    Read the headers from the start of a file, of either format, leaving the
+    file positioned at the start of the body.
+    """
+    prefix = f.read(_header_prefix.size)
+    if len(prefix) == _header_prefix.size and prefix.startswith(HEADER_MAGIC):
+        magic, version, length = _header_prefix.unpack(prefix)
+        if version != HEADER_VERSION:
+            raise ValueError('Unsupported header format version %s'% version)
+        # Each line ends with '\n'; values may hold other line breaks.
+        lines = [_unescape_header(line) for line in f.read(length).split('\n')[:-1]]
+    else:
+        # The original, text, format.
+        f.seek(0)
+        lines = []
+        while True:
+            line = f.readline().strip()
+            if not line:
+                break
+            lines.append(line)
+    headers = []
+    for line in lines:
+        name, value = line.split(': ', 1)
+        headers.append((name, value.decode('utf-8')))
+    return headers
+
+
+def _escape_header(s):
+    """ Escape a header name or value for the header block """
+    return re.sub(r'[\\\n\r]', lambda m: _header_escapes[m.group()], s)
+
+
+def _unescape_header(s):
+    """ Undo _escape_header """
+    return re.sub(r'\\(.)', lambda m: _header_unescapes.get(m.group(1), m.group(1)), s)
+
+
+def _check_size(src, max_size):
+    """
+    Raise SizeLimitExceeded if src is known to be larger than max_size.
+    """
+    if max_size is None:
+        return
+    size = _copyfile.remaining_size(src)
+    if size is not None and size > max_size:
+        raise SizeLimitExceeded('%s bytes is more than %s'% (size, max_size))
+
+
+class _FileSystemLayout(object):
+    """
+    Maps keys to files below a root directory.
+
+    Files are either all in the root directory or, with a shard_depth, in
+    subdirectories named by successive pairs of hex digits of the md5 of the
+    file name (e.g. 'ab/cd/name' for a depth of 2), keeping directories
+    small.
+
+    With an index_prefix length, the names of the files are also recorded in
+    hidden bucket files per leading index_prefix characters, so that deleting
+    by a prefix at least that long reads one bucket rather than listing the
+    whole store. Deleting a file removes it from its bucket.
 
+    Only the files of the store's layout are listed (the root directory's
+    files, or the files in the shard directories), so a store can share its
+    root directory with other files and directories.
 
-class FileSystemHeaderedFilestore(object):
+    Files are written to a hidden temporary file in the same directory and
+    renamed into place, so readers see either the old or the new file, never
+    a partly written one, and need no locking. With fsync set the file (and
+    then its directory) is synced before (and after) the rename so that a
+    stored file survives a crash.
+    """
+
+    _index_dir_name = '.index'
+
+    def _init_layout(self, root_dir, shard_depth, index_prefix):
+        self._root_dir = root_dir
+        self._shard_depth = shard_depth
+        self._index_prefix = index_prefix
+        self._index_lock = threading.Lock()
+
+    def _name(self, key):
+        """ The file name for a key """
+        return safefilename.encode(key)
+
+    def _key(self, name):
+        """ The key for a file name """
+        return safefilename.decode(name)
+
+    def _path(self, name):
+        """ The full path of a file name """
+        if not self._shard_depth:
+            return os.path.join(self._root_dir, name)
+        digest = md5(name).hexdigest()
+        shards = [digest[n*2:n*2+2] for n in range(self._shard_depth)]
+        return os.path.join(self._root_dir, *(shards + [name]))
+
+    def _create(self, name):
+        """
+        Prepare to write a file, returning its path.
+        """
+        path = self._path(name)
+        if self._shard_depth:
+            _makedirs(os.path.dirname(path))
+        if self._index_prefix and not os.path.exists(path):
+            self._with_bucket(name, _append_line, name)
+        return path
+
+    def _write(self, name, write, args, sync_dir=True):
+        """
+        Atomically replace the named file with what write(dest, *args)
+        writes to the open dest file. Nothing is left behind if write fails.
+        Returns the file's directory, which is synced (if fsync is set)
+        unless sync_dir is false.
+        """
+        path = self._create(name)
+        dirname = os.path.dirname(path)
+        tmp_path = os.path.join(dirname, '.tmp-%s'% uuid.uuid4().hex)
+        fd = os.open(tmp_path, os.O_WRONLY|os.O_CREAT|os.O_EXCL, self._mode)
+        try:
+            dest = os.fdopen(fd, 'wb')
+            try:
+                write(dest, *args)
+                if self._fsync:
+                    dest.flush()
+                    os.fsync(dest.fileno())
+            finally:
+                dest.close()
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if self._fsync and sync_dir:
+            _fsync_dir(dirname)
+        return dirname
+
+    def _put_many(self, items):
+        """
+        Store several (name, args) with _write, syncing each directory just
+        once at the end.
+        """
+        dirnames = set()
+        for name, args in items:
+            dirnames.add(self._write(name, self._write_file, args, sync_dir=False))
+        if self._fsync:
+            for dirname in dirnames:
+                _fsync_dir(dirname)
+
+    def get_many(self, keys):
+        """
+        Get the files stored for several keys.
+
+        :returns: dict of key to (headers, f), as returned by get. Keys that
+                  aren't found are left out.
+        """
+        files = {}
+        for key in keys:
+            try:
+                files[key] = self.get(key)
+            except KeyError:
+                pass
+        return files
+
+    def delete_many(self, keys, glob=False):
+        """
+        Delete the files for several keys or, with glob, all files whose keys
+        start with any of the keys. Keys that aren't found are ignored.
+
+        Glob deletes read each index bucket, or list the store, only once.
+        """
+        names = [self._name(key) for key in keys]
+        if not glob:
+            for name in names:
+                _remove(self._path(name))
+            if self._index_prefix:
+                buckets = {}
+                for name in names:
+                    buckets.setdefault(name[:self._index_prefix], set()).add(name)
+                for bucket_names in buckets.values():
+                    self._with_bucket(list(bucket_names)[0], _remove_lines, bucket_names)
+            return
+        buckets = {}
+        unindexed = []
+        for name in names:
+            if self._index_prefix and len(name) >= self._index_prefix:
+                buckets.setdefault(name[:self._index_prefix], []).append(name)
+            else:
+                unindexed.append(name)
+        for prefixes in buckets.values():
+            self._with_bucket(prefixes[0], self._delete_bucket_prefix, tuple(prefixes))
+        if unindexed:
+            unindexed = tuple(unindexed)
+            for name, path in self._iter_names():
+                if name.startswith(unindexed):
+                    os.remove(path)
+
+    def _delete(self, name):
+        """ Delete the named file, and its index entry """
+        os.remove(self._path(name))
+        if self._index_prefix:
+            self._with_bucket(name, _remove_lines, set([name]))
+
+    def _delete_prefix(self, prefix):
+        """ Delete all the files whose names start with the prefix """
+        if self._index_prefix and len(prefix) >= self._index_prefix:
+            self._with_bucket(prefix, self._delete_bucket_prefix, prefix)
+            return
+        for name, path in self._iter_names():
+            if name.startswith(prefix):
+                os.remove(path)
+
+    def _delete_bucket_prefix(self, bucket, prefix):
+        # prefix may be a tuple of prefixes, see str.startswith.
+        names = []
+        seen = set()
+        for name in bucket.read().splitlines():
+            if name in seen:
+                continue
+            seen.add(name)
+            if name.startswith(prefix):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+            else:
+                names.append(name)
+        bucket.seek(0)
+        bucket.write(''.join(['%s\n'% name for name in names]))
+        bucket.truncate()
+
+    def _with_bucket(self, name, func, *args):
+        """
+        Call func with the open, locked, index bucket for the name.
+        """
+        index_dir = os.path.join(self._root_dir, self._index_dir_name)
+        _makedirs(index_dir)
+        filename = os.path.join(index_dir, name[:self._index_prefix])
+        self._index_lock.acquire()
+        try:
+            fd = os.open(filename, os.O_RDWR|os.O_CREAT, 0600)
+            bucket = os.fdopen(fd, 'r+b')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(bucket.fileno(), fcntl.LOCK_EX)
+                return func(bucket, *args)
+            finally:
+                bucket.close()
+        finally:
+            self._index_lock.release()
+
+    def _shard_dirs(self, shard_depth):
+        """
+        Return the directories holding the files of a layout with the given
+        shard_depth, deepest last, as a list per level.
+        """
+        levels = [[self._root_dir]]
+        for n in range(shard_depth):
+            levels.append([os.path.join(dirname, name)
+                           for dirname in levels[-1] for name in _listdir(dirname)
+                           if _is_shard(name) and os.path.isdir(os.path.join(dirname, name))])
+        return levels
+
+    def _iter_names(self, shard_depth=None):
+        """
+        Yield (name, path) for every file in the store's layout, or in the
+        layout with the given shard_depth. Hidden files (such as lock files)
+        and anything that isn't part of the layout are skipped.
+        """
+        if shard_depth is None:
+            shard_depth = self._shard_depth
+        for dirname in self._shard_dirs(shard_depth)[-1]:
+            for name in _listdir(dirname):
+                path = os.path.join(dirname, name)
+                if not name.startswith('.') and os.path.isfile(path):
+                    yield name, path
+
+    def migrate(self, previous_shard_depth=0):
+        """
+        Move the files stored with a previous layout (e.g. a flat store that
+        is now sharded) to where the store's current layout expects them and
+        rebuild the index.
+
+        Only files the store recognises as its own are moved and indexed, see
+        _is_own_file. A FileSystemHeaderedFilestore recognises its files by
+        their headers; a FileSystemFilestore can't tell, so it must have a
+        directory of its own to be migrated.
+
+        :arg previous_shard_depth: the shard_depth the files were stored
+                                   with, defaults to 0 (a flat directory).
+        :returns: the number of files moved.
+        """
+        moved = 0
+        if previous_shard_depth != self._shard_depth:
+            for name, path in list(self._iter_names(previous_shard_depth)):
+                if not self._is_own_file(path):
+                    continue
+                new_path = self._path(name)
+                _makedirs(os.path.dirname(new_path))
+                os.rename(path, new_path)
+                moved += 1
+            # Remove the previous layout's shard directories if now empty.
+            for level in reversed(self._shard_dirs(previous_shard_depth)[1:]):
+                for dirname in level:
+                    try:
+                        os.rmdir(dirname)
+                    except OSError:
+                        pass
+        index_dir = os.path.join(self._root_dir, self._index_dir_name)
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        if self._index_prefix:
+            for name, path in list(self._iter_names()):
+                if self._is_own_file(path):
+                    self._with_bucket(name, _append_line, name)
+        return moved
+
+    def _is_own_file(self, path):
+        """ Could the file at path have been written by this store? """
+        return True
+
+
+def _makedirs(dirname):
+    """ Create a directory (and its parents) if it doesn't already exist """
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _listdir(dirname):
+    """ List a directory, which may not exist """
+    try:
+        return os.listdir(dirname)
+    except OSError:
+        return []
+
+
+def _is_shard(name):
+    """ Is the name that of a shard directory (two hex digits)? """
+    return len(name) == 2 and name.strip('0123456789abcdef') == ''
+
+
+def _remove_lines(f, lines):
+    """ Remove any of the set of lines from the open file """
+    f.seek(0)
+    remaining = [line for line in f.read().splitlines() if line not in lines]
+    f.seek(0)
+    f.write(''.join(['%s\n'% line for line in remaining]))
+    f.truncate()
+
+
+def _remove(path):
+    """ Remove a file, if it exists """
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _fsync_dir(dirname):
+    """ Sync a directory, making renames within it durable """
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _append_line(f, line):
+    f.seek(0, os.SEEK_END)
+    f.write('%s\n'% line)
+
+
+class FileSystemHeaderedFilestore(_FileSystemLayout):
     """
     A general purpose readable and writable file store useful for storing data
     along with additional metadata (simple key-value pairs).
@@ -18,16 +442,27 @@ class FileSystemHeaderedFilestore(object):
     XXX file ownership?
     """
 
-    def __init__(self, root_dir, mode=0660):
+    def __init__(self, root_dir, mode=0660, chunk_size=64*1024, shard_depth=0,
+                 index_prefix=None, fsync=False):
         """
         Create a new storage space.
 
         :arg root_dir: directory for stored files to be written to.
         :arg mode: initial mode of created files, defaults to 0660. See os.open
                    for details.
+        :arg chunk_size: number of bytes copied at a time when storing a file.
+        :arg shard_depth: number of levels of hashed subdirectories to spread
+                          the files over, defaults to 0 (a flat directory).
+                          Call migrate() after changing it.
+        :arg index_prefix: length of the key prefixes indexed for glob deletes,
+                           defaults to None (no index).
+        :arg fsync: sync stored files to disk before they replace the old
+                    ones, defaults to False.
         """
-        self._root_dir = root_dir
+        self._init_layout(root_dir, shard_depth, index_prefix)
         self._mode = mode
+        self._chunk_size = chunk_size
+        self._fsync = fsync
 
     def get(self, key):
         """
@@ -39,19 +474,29 @@ class FileSystemHeaderedFilestore(object):
         :raises KeyError: not found
         """
         try:
-            f = open(os.path.join(self._root_dir, safefilename.encode(key)), 'rb')
+            f = open(self._path(self._name(key)), 'rb')
         except (IOError, AttributeError):
             raise KeyError(key)
-        headers = []
-        while True:
-            line = f.readline().strip()
-            if not line:
-                break
-            name, value = line.split(': ', 1)
-            headers.append((name, value.decode('utf-8')))
+        try:
+            headers = _read_headers(f)
+        except:
+            f.close()
+            raise
         return headers, f
 
-    def put(self, key, headers, src):
+    def get_headers(self, key):
+        """
+        Get just the headers stored for the given key.
+
+        :arg key: unique key that identifies the file.
+        :returns: list of (name, value) pairs.
+        :raises KeyError: not found
+        """
+        headers, f = self.get(key)
+        f.close()
+        return headers
+
+    def put(self, key, headers, src, max_size=None):
         """
         Add a file to the store, overwriting an existing file with the same key.
 
@@ -59,48 +504,108 @@ class FileSystemHeaderedFilestore(object):
         :arg headers: list of (name, value) pairs that will be associated with
                       the file.
         :arg src: readable file-like object
+        :arg max_size: maximum number of bytes to accept from src.
+        :raises SizeLimitExceeded: src is larger than max_size, nothing is
+                                   stored.
         """
         # XXX We should only allow strings as headers keys and values.
-        # Open the file with minimal permissions..
-        filename = os.path.join(self._root_dir, safefilename.encode(key))
-        fd = os.open(filename, os.O_RDWR|os.O_CREAT, self._mode)
-        dest = os.fdopen(fd, 'wb')
-        try:
-            if isinstance(headers, dict):
-               headers = headers.items()
-            for name, value in headers:
-                if isinstance(value, unicode):
-                    value = value.encode('utf-8')
-                dest.write('%s: %s\n' % (name, value))
-            dest.write('\n')
-            _copyfile.copyfileobj(src, dest)
-        finally:
-            dest.close()
+        # Refuse before creating anything if the size is already known.
+        _check_size(src, max_size)
+        self._write(self._name(key), self._write_file, (headers, src, max_size))
+
+    def put_many(self, items, max_size=None):
+        """
+        Add several files to the store, see put. With fsync set each
+        directory is synced once, after all the files are written.
+
+        :arg items: (key, headers, src) for each file.
+        :raises SizeLimitExceeded: a src is larger than max_size. Nothing is
+                                   stored if that's known from the sources'
+                                   sizes, otherwise the files before it are.
+        """
+        batch = []
+        for key, headers, src in items:
+            _check_size(src, max_size)
+            batch.append((self._name(key), (headers, src, max_size)))
+        self._put_many(batch)
+
+    def _write_file(self, dest, headers, src, max_size):
+        _write_headers(dest, headers)
+        _copyfile.copyfileobj(src, dest, self._chunk_size, max_size=max_size)
 
     def delete(self, key, glob=False):
         # if glob is true will delete all with filename prefix
         if glob == True:
-            for f in os.listdir(self._root_dir):
-                if f.startswith(safefilename.encode(key)):
-                    os.remove(os.path.join(self._root_dir,f))
+            self._delete_prefix(self._name(key))
         else:
-            os.remove( os.path.join(self._root_dir, safefilename.encode(key)))
+            self._delete(self._name(key))
+
+    def _is_own_file(self, path):
+        """ Does the file at path start with headers, of either format? """
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return False
+        try:
+            start = f.read(4096)
+        finally:
+            f.close()
+        if start.startswith(HEADER_MAGIC):
+            return True
+        # The original, text, format: header lines up to a blank line.
+        if start.startswith('\n'):
+            return True
+        end = start.find('\n\n')
+        if end == -1:
+            return False
+        for line in start[:end].split('\n'):
+            if ': ' not in line:
+                return False
+        return True
+
+    def iter_files(self):
+        """
+        Yield (key, size, atime) for the files in the store, least recently
+        accessed first. Hidden files (such as lock files) are skipped.
+        """
+        files = []
+        for name, path in self._iter_names():
+            try:
+                stat = os.stat(path)
+                key = self._key(name)
+            except (OSError, UnicodeDecodeError):
+                continue
+            files.append((stat.st_atime, key, stat.st_size))
+        files.sort()
+        for atime, key, size in files:
+            yield key, size, atime
 
-class FileSystemFilestore(object):
+class FileSystemFilestore(_FileSystemLayout):
     """
     A general purpose readable and writable file store useful for storing data
     """
 
-    def __init__(self, root_dir, mode=0660):
+    def __init__(self, root_dir, mode=0660, chunk_size=64*1024, shard_depth=0,
+                 index_prefix=None, fsync=False):
         """
         Create a new storage space.
 
         :arg root_dir: directory for stored files to be written to.
         :arg mode: initial mode of created files, defaults to 0660. See os.open
                    for details.
+        :arg chunk_size: number of bytes copied at a time when storing a file.
+        :arg shard_depth: number of levels of hashed subdirectories to spread
+                          the files over, defaults to 0 (a flat directory).
+                          Call migrate() after changing it.
+        :arg index_prefix: length of the key prefixes indexed for glob deletes,
+                           defaults to None (no index).
+        :arg fsync: sync stored files to disk before they replace the old
+                    ones, defaults to False.
         """
-        self._root_dir = root_dir
+        self._init_layout(root_dir, shard_depth, index_prefix)
         self._mode = mode
+        self._chunk_size = chunk_size
+        self._fsync = fsync
 
     def get(self, key):
         """
@@ -111,15 +616,14 @@ class FileSystemFilestore(object):
                   pairs and f is a readable file-like object.
         :raises KeyError: not found
         """
-        filename = os.path.join(self._root_dir, key)
+        filename = self._path(self._name(key))
         try:
             f = open(filename, 'rb')
         except (IOError, AttributeError):
             raise KeyError(key)
-        contenttype = mimetype.content_type(filename)
         return [], f
 
-    def put(self, key, headers, src):
+    def put(self, key, headers, src, max_size=None):
         """
         Add a file to the store, overwriting an existing file with the same key.
 
@@ -127,26 +631,51 @@ class FileSystemFilestore(object):
         :arg headers: list of (name, value) pairs that will be associated with
                       the file.
         :arg src: readable file-like object
+        :arg max_size: maximum number of bytes to accept from src.
+        :raises SizeLimitExceeded: src is larger than max_size, nothing is
+                                   stored.
         """
         # XXX We should only allow strings as headers keys and values.
-        # Open the file with minimal permissions..
-        filename = os.path.join(self._root_dir, key)
-        fd = os.open(filename, os.O_RDWR|os.O_CREAT, self._mode)
-        dest = os.fdopen(fd, 'wb')
-        try:
-            _copyfile.copyfileobj(src, dest)
-        finally:
-            dest.close()
+        _check_size(src, max_size)
+        self._write(self._name(key), self._write_file, (src, max_size))
+
+    def put_many(self, items, max_size=None):
+        """
+        Add several files to the store, see put and
+        FileSystemHeaderedFilestore.put_many.
+
+        :arg items: (key, headers, src) for each file.
+        """
+        batch = []
+        for key, headers, src in items:
+            _check_size(src, max_size)
+            batch.append((self._name(key), (src, max_size)))
+        self._put_many(batch)
+
+    def _write_file(self, dest, src, max_size):
+        _copyfile.copyfileobj(src, dest, self._chunk_size, max_size=max_size)
 
     def delete(self, key, glob=False):
         # if glob is true will delete all with filename prefix
         if glob == True:
-            for f in os.listdir(self._root_dir):
-                if f.startswith(key):
-                    os.remove(os.path.join(self._root_dir,f))
+            self._delete_prefix(self._name(key))
         else:
-            os.remove( os.path.join(self._root_dir, safefilename.encode(key)))
+            self._delete(self._name(key))
+
+    def _name(self, key):
+        # Keys are used as file names as they are.
+        return key
 
+    def _key(self, name):
+        return name
+
+
+
+def _split_cache_tag(headers):
+    """ Split the stored headers into (cache tag, the other headers) """
+    if headers and headers[0][0] == 'Cache-Tag':
+        return headers[0][1], headers[1:]
+    return None, headers
 
 
 class CachedTempFilestore(object):
@@ -169,17 +698,30 @@ class CachedTempFilestore(object):
         :raises KeyError: not found
         """
         headers, f = self.backend.get(key)
-        if headers and headers[0][0] == 'Cache-Tag':
-            header_cache_tag = headers[0][1]
-            headers = headers[1:]
-        else:
-            header_cache_tag = None
+        header_cache_tag, headers = _split_cache_tag(headers)
         if cache_tag and header_cache_tag == cache_tag:
             f.close()
             return (cache_tag, headers, None)
         return (header_cache_tag, headers, f)
 
-    def put(self, key, src, cache_tag, headers=None):
+    def get_headers(self, key):
+        """
+        Get just the cache tag and headers stored for the given key, without
+        leaving the file open.
+
+        :arg key: unique key that identifies the file.
+        :returns: tuple of (cache_tag, headers).
+        :raises KeyError: not found
+        """
+        get_headers = getattr(self.backend, 'get_headers', None)
+        if get_headers is not None:
+            headers = get_headers(key)
+        else:
+            headers, f = self.backend.get(key)
+            f.close()
+        return _split_cache_tag(headers)
+
+    def put(self, key, src, cache_tag, headers=None, max_size=None):
         """
         Add a file to the store, overwriting an existing file with the same key.
 
@@ -189,13 +731,1027 @@ class CachedTempFilestore(object):
         :arg headers: list of (name, value) pairs that will be associated with
                       the file.
         :arg src: readable file-like object
+        :arg max_size: maximum number of bytes to accept from src, passed on
+                       to the backend when given.
+        :raises SizeLimitExceeded: src is larger than max_size.
         """
         if headers is None:
             headers = []
         if cache_tag:
             headers = [('Cache-Tag', cache_tag)] + headers
-        self.backend.put(key, headers, src)
+        if max_size is None:
+            self.backend.put(key, headers, src)
+        else:
+            self.backend.put(key, headers, src, max_size=max_size)
 
     def delete(self, key):
         self.backend.delete(key)
 
+    def get_many(self, keys):
+        """
+        Get the files stored for several keys.
+
+        :returns: dict of key to (cache_tag, headers, f). Keys that aren't
+                  found are left out.
+        """
+        files = {}
+        for key, (headers, f) in get_many(self.backend, keys).iteritems():
+            header_cache_tag, headers = _split_cache_tag(headers)
+            files[key] = (header_cache_tag, headers, f)
+        return files
+
+    def put_many(self, items, max_size=None):
+        """
+        Add several files to the store, see put.
+
+        :arg items: (key, src, cache_tag) or (key, src, cache_tag, headers)
+                    for each file.
+        :arg max_size: maximum number of bytes to accept from each src.
+        """
+        put_many(self.backend, [_backend_item(*item) for item in items], max_size)
+
+    def delete_many(self, keys):
+        """
+        Delete the files for several keys, ignoring keys that aren't found.
+        """
+        delete_many(self.backend, keys)
+
+
+def _backend_item(key, src, cache_tag, headers=None):
+    """ Turn CachedTempFilestore.put arguments into a backend put's """
+    if headers is None:
+        headers = []
+    if cache_tag:
+        headers = [('Cache-Tag', cache_tag)] + headers
+    return key, headers, src
+
+
+def get_many(store, keys):
+    """
+    Get the files stored for several keys, using the store's get_many if it
+    has one or calling get for each key if it doesn't.
+
+    :returns: dict of key to the result of the store's get. Keys that aren't
+              found are left out.
+    """
+    if hasattr(store, 'get_many'):
+        return store.get_many(keys)
+    files = {}
+    for key in keys:
+        try:
+            files[key] = store.get(key)
+        except KeyError:
+            pass
+    return files
+
+
+def put_many(store, items, max_size=None):
+    """
+    Add several files to a store, using the store's put_many if it has one
+    or calling put for each item if it doesn't.
+
+    :arg items: the arguments of the store's put, for each file.
+    :arg max_size: maximum number of bytes to accept from each file.
+    """
+    if hasattr(store, 'put_many'):
+        if max_size is None:
+            return store.put_many(items)
+        return store.put_many(items, max_size=max_size)
+    for item in items:
+        if max_size is None:
+            store.put(*item)
+        else:
+            store.put(*item, **{'max_size': max_size})
+
+
+def delete_many(store, keys, glob=False):
+    """
+    Delete the files for several keys from a store, using the store's
+    delete_many if it has one or calling delete for each key if it doesn't.
+    Keys that aren't found are ignored.
+    """
+    if hasattr(store, 'delete_many'):
+        if glob:
+            return store.delete_many(keys, glob=True)
+        return store.delete_many(keys)
+    for key in keys:
+        try:
+            if glob:
+                store.delete(key, glob=True)
+            else:
+                store.delete(key)
+        except (KeyError, OSError):
+            pass
+
+
+class ExpiringTempFilestore(CachedTempFilestore):
+    """
+    A temporary filestore for uploads that removes files once they are older
+    than a time to live.
+
+    The creation time and size of each file put are appended to an index
+    file, in creation order. Sweeping reads the index up to the first file
+    that hasn't expired, removing the expired files and dropping them from
+    the index, so the store's directory is never scanned.
+
+    Call sweep() periodically or start_sweeper() to sweep from a background
+    thread. The index is locked (where flock is available) so that several
+    processes can share the store.
+    """
+
+    index_name = '.formish-uploads.index'
+
+    def __init__(self, backend=None, ttl=3600, index_path=None):
+        """
+        :arg backend: the store's backend, defaulting to the system's temp dir.
+        :arg ttl: seconds a file is kept after it is put.
+        :arg index_path: file name of the index, defaulting to a hidden file
+                         in the backend's root_dir.
+        """
+        CachedTempFilestore.__init__(self, backend)
+        if index_path is None:
+            index_path = os.path.join(self.backend._root_dir, self.index_name)
+        self.ttl = ttl
+        self.index_path = index_path
+        self._lock = threading.Lock()
+
+    def put(self, key, src, cache_tag, headers=None, max_size=None):
+        """
+        Add a file to the store, see CachedTempFilestore.put, recording it in
+        the index.
+        """
+        src = _CountingReader(src)
+        CachedTempFilestore.put(self, key, src, cache_tag, headers, max_size)
+        self._with_index(self._append, '%d %d %s\n'% (time.time(), src.count,
+                                                     safefilename.encode(key)))
+
+    def put_many(self, items, max_size=None):
+        """
+        Add several files to the store, see CachedTempFilestore.put_many,
+        recording them in the index with a single write.
+        """
+        counted = []
+        for item in items:
+            item = list(item)
+            item[1] = _CountingReader(item[1])
+            counted.append(item)
+        try:
+            CachedTempFilestore.put_many(self, counted, max_size)
+        finally:
+            # Record every file, even if one failed and later files weren't
+            # stored; sweeping ignores files that don't exist.
+            now = time.time()
+            lines = ['%d %d %s\n'% (now, item[1].count, safefilename.encode(item[0]))
+                     for item in counted]
+            if lines:
+                self._with_index(self._append, ''.join(lines))
+
+    def sweep(self, now=None):
+        """
+        Remove the files that have expired.
+
+        :returns: (number of files, total size) removed.
+        """
+        if now is None:
+            now = time.time()
+        return self._with_index(self._sweep, now - self.ttl)
+
+    def start_sweeper(self, interval=60):
+        """
+        Start a daemon thread calling sweep every interval seconds, returning
+        a threading.Event that stops the thread when set.
+        """
+        stop = threading.Event()
+        def sweeper():
+            while not stop.isSet():
+                try:
+                    self.sweep()
+                except Exception:
+                    log.exception('Failed to sweep %r' % (self.index_path,))
+                stop.wait(interval)
+        thread = threading.Thread(target=sweeper)
+        thread.setDaemon(True)
+        thread.start()
+        return stop
+
+    def _with_index(self, func, *args):
+        """
+        Call func with the open, locked, index file
+        """
+        self._lock.acquire()
+        try:
+            fd = os.open(self.index_path, os.O_RDWR|os.O_CREAT, 0600)
+            index = os.fdopen(fd, 'r+b')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(index.fileno(), fcntl.LOCK_EX)
+                return func(index, *args)
+            finally:
+                index.close()
+        finally:
+            self._lock.release()
+
+    def _append(self, index, line):
+        index.seek(0, os.SEEK_END)
+        index.write(line)
+
+    def _sweep(self, index, expires):
+        count = size = 0
+        while True:
+            position = index.tell()
+            line = index.readline()
+            if not line:
+                break
+            try:
+                created, file_size, key = line.split(' ', 2)
+                created, file_size = float(created), int(file_size)
+                key = safefilename.decode(key.rstrip('\n'))
+            except ValueError:
+                # Drop anything unreadable.
+                continue
+            if created > expires:
+                index.seek(position)
+                break
+            try:
+                self.delete(key)
+                count += 1
+                size += file_size
+            except (OSError, KeyError):
+                # Removed already.
+                pass
+        remaining = index.read()
+        if index.tell() != len(remaining):
+            # Rewrite the index with only the entries that remain.
+            index.seek(0)
+            index.write(remaining)
+            index.truncate()
+        return count, size
+
+
+class ContentAddressedFilestore(object):
+    """
+    A store, with the same interface as CachedTempFilestore, that stores each
+    distinct content only once.
+
+    Content is stored under its sha1 digest, which is also used as the cache
+    tag of every key with that content (the cache_tag passed to put is
+    ignored). Keys are small records mapping the key to the digest along
+    with the key's headers, and each content has a count of the keys using
+    it, so it is removed when the last of those keys is deleted.
+    """
+
+    def __init__(self, root_dir, mode=0660, chunk_size=64*1024, shard_depth=1,
+                 fsync=False):
+        """
+        :arg root_dir: directory for the store.
+        :arg mode: initial mode of created files, see os.open.
+        :arg chunk_size: number of bytes copied at a time when storing a file.
+        :arg shard_depth: levels of subdirectories to spread files over, see
+                          FileSystemHeaderedFilestore.
+        :arg fsync: sync stored files to disk, see FileSystemHeaderedFilestore.
+        """
+        self._root_dir = root_dir
+        self._mode = mode
+        self._chunk_size = chunk_size
+        self.keys = CachedTempFilestore(FileSystemHeaderedFilestore(
+            os.path.join(root_dir, 'keys'), mode, shard_depth=shard_depth, fsync=fsync))
+        # Contents are stored with a single Refs header, the number of keys
+        # using them.
+        self.contents = FileSystemHeaderedFilestore(
+            os.path.join(root_dir, 'contents'), mode, chunk_size, shard_depth=shard_depth,
+            fsync=fsync)
+        _makedirs(self.keys.backend._root_dir)
+        _makedirs(self.contents._root_dir)
+        self._lock = threading.Lock()
+
+    def get(self, key, cache_tag=None):
+        """
+        Get the file stored for the given key, see CachedTempFilestore.get.
+        """
+        digest, headers = self.keys.get_headers(key)
+        if cache_tag and cache_tag == digest:
+            return (digest, headers, None)
+        try:
+            refs, f = self.contents.get(digest)
+        except KeyError:
+            raise KeyError(key)
+        return (digest, headers, f)
+
+    def get_headers(self, key):
+        """
+        Get just the cache tag and headers stored for the given key.
+        """
+        return self.keys.get_headers(key)
+
+    def put(self, key, src, cache_tag=None, headers=None, max_size=None):
+        """
+        Add a file to the store, overwriting an existing file with the same
+        key, see CachedTempFilestore.put. The content is only written if it
+        isn't already stored.
+
+        :returns: the content's digest, the key's new cache tag.
+        """
+        _check_size(src, max_size)
+        if hasattr(src, 'seek') and _copyfile.remaining_size(src) is not None:
+            # A real file, reading it twice is cheaper than writing it twice.
+            # Wrapped files (e.g. counted by a BudgetedCache) are spooled.
+            offset = src.tell()
+            digest = _hash_file(_HashingReader(src), self._chunk_size, max_size)
+            src.seek(offset)
+            tmp_name = None
+        else:
+            digest, tmp_name = self._spool(src, max_size)
+        try:
+            self._with_lock(self._put, key, digest, src, tmp_name, headers)
+        finally:
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        return digest
+
+    def delete(self, key):
+        self._with_lock(self._delete, key)
+
+    def _spool(self, src, max_size):
+        """
+        Copy src to a temporary file in the store, returning (digest,
+        temporary file name).
+        """
+        fd, tmp_name = tempfile.mkstemp(dir=self._root_dir, prefix='.tmp-')
+        dest = os.fdopen(fd, 'wb')
+        src = _HashingReader(src)
+        try:
+            try:
+                _copyfile.copyfileobj(src, dest, self._chunk_size, max_size=max_size)
+            finally:
+                dest.close()
+        except:
+            os.remove(tmp_name)
+            raise
+        return src.hexdigest(), tmp_name
+
+    def _put(self, key, digest, src, tmp_name, headers):
+        try:
+            old_digest = self.keys.get_headers(key)[0]
+        except KeyError:
+            old_digest = None
+        if digest != old_digest:
+            self._incref(digest, src, tmp_name)
+            if old_digest is not None:
+                self._decref(old_digest)
+        self.keys.put(key, StringIO(''), digest, headers)
+
+    def _delete(self, key):
+        digest = self.keys.get_headers(key)[0]
+        self.keys.delete(key)
+        self._decref(digest)
+
+    def _incref(self, digest, src, tmp_name):
+        try:
+            refs, f = self.contents.get(digest)
+        except KeyError:
+            # New content.
+            if tmp_name is not None:
+                src = open(tmp_name, 'rb')
+            try:
+                self.contents.put(digest, [('Refs', '%010d'% 1)], src)
+            finally:
+                if tmp_name is not None:
+                    src.close()
+            return
+        self._set_refs(digest, f, int(dict(refs)['Refs']) + 1)
+
+    def _decref(self, digest):
+        try:
+            refs, f = self.contents.get(digest)
+        except KeyError:
+            return
+        count = int(dict(refs)['Refs']) - 1
+        if count > 0:
+            self._set_refs(digest, f, count)
+        else:
+            f.close()
+            self.contents.delete(digest)
+
+    def _set_refs(self, digest, f, count):
+        """
+        Rewrite the content's reference count in place. The count is written
+        with a fixed width so the header block doesn't change size.
+        """
+        f.close()
+        filename = self.contents._path(self.contents._name(digest))
+        header = open(filename, 'r+b')
+        try:
+            header.seek(_header_prefix.size)
+            header.write('Refs: %010d\n'% count)
+        finally:
+            header.close()
+
+    def _with_lock(self, func, *args):
+        """
+        Call func holding the store's lock, which is also flocked (where
+        available) for processes sharing the store.
+        """
+        self._lock.acquire()
+        try:
+            lock_file = open(os.path.join(self._root_dir, '.lock'), 'a')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                return func(*args)
+            finally:
+                lock_file.close()
+        finally:
+            self._lock.release()
+
+
+def _hash_file(src, chunk_size, max_size):
+    """ Read all of the hashing reader, returning the digest """
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        if max_size is not None and src.count > max_size:
+            raise SizeLimitExceeded('More than %s bytes'% max_size)
+    return src.hexdigest()
+
+
+class BudgetedCache(object):
+    """
+    A cache store, wrapping a CachedTempFilestore, that keeps the total size
+    and number of cached files within a budget by removing the least
+    recently used files.
+
+    Eviction happens as part of each put, removing just enough files to get
+    back within the budget.
+
+    When the store's backend can list its files (see
+    FileSystemHeaderedFilestore.iter_files) the store is scanned on the first
+    put and then every rescan_interval seconds, so files left by previous
+    runs or put by other processes sharing the directory are counted and
+    evicted too, least recently accessed first. Every file of the store's
+    layout is counted, so the store needs a directory of its own. Between
+    scans, other processes' puts aren't counted, so the directory can
+    briefly exceed the budget. Without a listable backend only the files put
+    through this cache are tracked.
+
+    The hits, misses and evictions counters record the cache's activity.
+    """
+
+    def __init__(self, store, max_bytes=None, max_entries=None, rescan_interval=300):
+        """
+        :arg store: the CachedTempFilestore holding the files, in a directory
+            of its own.
+        :arg max_bytes: maximum total size of the cached files.
+        :arg max_entries: maximum number of cached files.
+        :arg rescan_interval: seconds between scans of the store for files
+            put by other processes, or None to only scan on the first put.
+        """
+        self.store = store
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.rescan_interval = rescan_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._lru = _LRU()
+        # Time of the last scan, and the keys put since it started.
+        self._scanned = None
+        self._put_since_scan = set()
+
+    def __len__(self):
+        return len(self._lru)
+
+    @property
+    def total_bytes(self):
+        return self._lru.total_size
+
+    def get(self, key, cache_tag=None):
+        """
+        Get the file stored for the given key, see CachedTempFilestore.get.
+        """
+        try:
+            cache_tag, headers, f = self.store.get(key, cache_tag)
+        except KeyError:
+            self._record_miss(key)
+            raise
+        self._record_hit(key)
+        return cache_tag, headers, f
+
+    def get_headers(self, key):
+        """
+        Get just the cache tag and headers stored for the given key, see
+        CachedTempFilestore.get_headers.
+        """
+        try:
+            result = self.store.get_headers(key)
+        except KeyError:
+            self._record_miss(key)
+            raise
+        self._record_hit(key)
+        return result
+
+    def _record_hit(self, key):
+        self._lock.acquire()
+        try:
+            self.hits += 1
+            size = self._lru.size(key)
+            if size is not None:
+                self._touch(key, size)
+        finally:
+            self._lock.release()
+
+    def _record_miss(self, key):
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            self._forget(key)
+        finally:
+            self._lock.release()
+
+    def put(self, key, src, cache_tag, headers=None):
+        """
+        Add a file to the cache, see CachedTempFilestore.put, removing the
+        least recently used files if the cache is then over budget.
+        """
+        self._scan()
+        src = _CountingReader(src)
+        self.store.put(key, src, cache_tag, headers)
+        self._lock.acquire()
+        try:
+            self._put_since_scan.add(key)
+            self._touch(key, src.count)
+            self._evict(keep=key)
+        finally:
+            self._lock.release()
+
+    def _scan(self):
+        """
+        Rebuild the accounting from the files in the store, if it's time to
+        look again. Other threads carry on while one scans.
+        """
+        iter_files = getattr(getattr(self.store, 'backend', None), 'iter_files', None)
+        if iter_files is None:
+            return
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self._scanned is not None and (self.rescan_interval is None or
+                                              now < self._scanned + self.rescan_interval):
+                return
+            self._scanned = now
+            self._put_since_scan = set()
+        finally:
+            self._lock.release()
+        files = list(iter_files())
+        self._lock.acquire()
+        try:
+            # Order all the files by when they were last used, here or (by
+            # access time) elsewhere. Files removed by other processes are
+            # forgotten.
+            entries = []
+            stored = set()
+            for key, size, atime in files:
+                stored.add(key)
+                if self._lru.size(key) is not None:
+                    size = self._lru.size(key)
+                    atime = max(atime, self._lru.value(key))
+                entries.append((atime, key, size))
+            for key in self._put_since_scan:
+                if key not in stored and self._lru.size(key) is not None:
+                    entries.append((self._lru.value(key), key, self._lru.size(key)))
+            entries.sort()
+            self._lru = _LRU()
+            for used, key, size in entries:
+                self._lru.add(key, size, used)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self.store.delete(key)
+        self._lock.acquire()
+        try:
+            self._forget(key)
+        finally:
+            self._lock.release()
+
+    def _touch(self, key, size):
+        """ Record the key as most recently used """
+        self._lru.add(key, size, time.time())
+
+    def _forget(self, key):
+        self._lru.remove(key)
+
+    def _over_budget(self):
+        return (self.max_bytes is not None and self.total_bytes > self.max_bytes) or \
+               (self.max_entries is not None and len(self._lru) > self.max_entries)
+
+    def _evict(self, keep=None):
+        """ Remove least recently used files until within the budget """
+        while self._over_budget():
+            key = self._lru.oldest()
+            if key is None or key == keep:
+                # Never remove what was just added, even if it alone is over
+                # the budget.
+                break
+            self._forget(key)
+            try:
+                self.store.delete(key)
+            except (OSError, KeyError):
+                pass
+            self.evictions += 1
+
+
+class MemoryTieredFilestore(object):
+    """
+    A backend store, for use by a CachedTempFilestore, that keeps recently
+    used small files in memory in front of another backend, e.g. a
+    FileSystemHeaderedFilestore.
+
+    Files of up to max_file_size bytes are kept in memory once read or
+    written, the least recently used being dropped to keep the total within
+    max_bytes. Writes go through to the backend and deletes remove the file
+    from memory as well as from the backend, so the backend always holds
+    everything.
+
+    The hits and misses counters record how often files were found in
+    memory.
+    """
+
+    def __init__(self, backend, max_bytes=16*1024*1024, max_file_size=64*1024):
+        """
+        :arg backend: the store holding the files, see
+            FileSystemHeaderedFilestore.
+        :arg max_bytes: maximum total size of the files kept in memory.
+        :arg max_file_size: largest file kept in memory.
+        """
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> (headers, data, mtime)
+        self._lru = _LRU()
+        # Incremented by every change, so that a file read from the backend
+        # isn't kept if it changed while being read.
+        self._generation = 0
+
+    def get(self, key):
+        """
+        Get the file stored for the given key, see
+        FileSystemHeaderedFilestore.get.
+        """
+        entry = self._use(key)
+        if entry is not None:
+            headers, data, mtime = entry
+            return list(headers), _MemoryFile(data, mtime)
+        return self._load(key)
+
+    def _load(self, key):
+        """ Get a file from the backend, keeping it in memory if small """
+        generation = self._generation
+        headers, f = self.backend.get(key)
+        size = _copyfile.remaining_size(f)
+        if size is None or size > self.max_file_size:
+            return headers, f
+        try:
+            try:
+                mtime = int(os.fstat(f.fileno()).st_mtime)
+            except (AttributeError, OSError, ValueError):
+                mtime = None
+            data = f.read()
+        finally:
+            f.close()
+        self._keep(key, (headers, data, mtime), len(data), generation)
+        return list(headers), _MemoryFile(data, mtime)
+
+    def get_headers(self, key):
+        """
+        Get just the headers stored for the given key, see
+        FileSystemHeaderedFilestore.get_headers.
+        """
+        entry = self._use(key)
+        if entry is not None:
+            return list(entry[0])
+        get_headers = getattr(self.backend, 'get_headers', None)
+        if get_headers is not None:
+            return get_headers(key)
+        headers, f = self.backend.get(key)
+        f.close()
+        return headers
+
+    def put(self, key, headers, src, max_size=None):
+        """
+        Add a file to the store, see FileSystemHeaderedFilestore.put. Small
+        files are also kept in memory as they're written, with their headers
+        as a FileSystemHeaderedFilestore returns them, without reading them
+        back from the backend.
+        """
+        src = _KeepingReader(src, self.max_file_size)
+        if max_size is None:
+            self.backend.put(key, headers, src)
+        else:
+            self.backend.put(key, headers, src, max_size=max_size)
+        generation = self._invalidate(key)
+        self._keep_written(key, headers, src, generation)
+
+    def delete(self, key, glob=False):
+        """
+        Delete the file for the key or, with glob, all files whose keys start
+        with key.
+        """
+        try:
+            self.backend.delete(key, glob)
+        finally:
+            self._invalidate(key, glob)
+
+    def get_many(self, keys):
+        """
+        Get the files stored for several keys, see
+        FileSystemHeaderedFilestore.get_many.
+        """
+        files = {}
+        for key in keys:
+            try:
+                files[key] = self.get(key)
+            except KeyError:
+                pass
+        return files
+
+    def put_many(self, items, max_size=None):
+        """
+        Add several files to the store, see
+        FileSystemHeaderedFilestore.put_many.
+        """
+        kept = [(key, headers, _KeepingReader(src, self.max_file_size))
+                for key, headers, src in items]
+        generations = []
+        try:
+            put_many(self.backend, kept, max_size)
+        finally:
+            for key, headers, src in kept:
+                generations.append(self._invalidate(key))
+        for (key, headers, src), generation in zip(kept, generations):
+            self._keep_written(key, headers, src, generation)
+
+    def _keep_written(self, key, headers, src, generation):
+        """ Keep a file that was just written, if it was small enough """
+        data = src.data()
+        if data is None:
+            return
+        if isinstance(headers, dict):
+            headers = headers.items()
+        headers = [(name, _stored_value(value)) for name, value in headers]
+        self._keep(key, (headers, data, int(time.time())), len(data), generation)
+
+    def delete_many(self, keys, glob=False):
+        """
+        Delete the files for several keys, see
+        FileSystemHeaderedFilestore.delete_many.
+        """
+        keys = list(keys)
+        try:
+            delete_many(self.backend, keys, glob)
+        finally:
+            for key in keys:
+                self._invalidate(key, glob)
+
+    def _use(self, key):
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._lru.use(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+        finally:
+            self._lock.release()
+
+    def _keep(self, key, entry, size, generation):
+        self._lock.acquire()
+        try:
+            if generation != self._generation:
+                return
+            self._lru.add(key, size, entry)
+            # Drop the least recently used, possibly including this file.
+            while self._lru.total_size > self.max_bytes:
+                self._lru.remove(self._lru.oldest())
+        finally:
+            self._lock.release()
+
+    def _invalidate(self, key, glob=False):
+        """ Forget the key's file, returning the new generation """
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            if glob:
+                for k in self._lru.keys():
+                    if k.startswith(key):
+                        self._lru.remove(k)
+            else:
+                self._lru.remove(key)
+            return self._generation
+        finally:
+            self._lock.release()
+
+
+def _stored_value(value):
+    """ A header value as _read_headers returns it """
+    if isinstance(value, unicode):
+        return value
+    return ('%s'% value).decode('utf-8')
+
+
+class _MemoryFile(object):
+    """
+    A read only file of data held in memory. mtime is the modification time
+    of the file it was read from, if known.
+    """
+
+    def __init__(self, data, mtime=None):
+        f = StringIO(data)
+        self.read = f.read
+        self.readline = f.readline
+        self.seek = f.seek
+        self.tell = f.tell
+        self.close = f.close
+        self.mtime = mtime
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+class AsyncFilestore(object):
+    """
+    Runs a blocking filestore's methods in a thread pool, so that they can be
+    used from an event loop without blocking it.
+
+    Each method takes the same arguments as the wrapped store's and returns a
+    future of its result. A done callback runs in the pool's thread, so an
+    event loop should hand the result back to its own thread (e.g. with
+    IOLoop.add_callback or reactor.callFromThread).
+
+    Files returned by get are ordinary blocking files; read them with read,
+    or give them to an AsyncFileServer, to keep the reads off the loop.
+    """
+
+    def __init__(self, store, executor=None, workers=4):
+        """
+        :arg store: the filestore to wrap.
+        :arg executor: the executor to run calls in, anything with a
+            concurrent.futures style submit method. Defaults to a
+            ThreadExecutor of workers threads.
+        """
+        if executor is None:
+            executor = ThreadExecutor(workers)
+        self.store = store
+        self.executor = executor
+
+    def get(self, *args, **kwargs):
+        return self.executor.submit(self.store.get, *args, **kwargs)
+
+    def get_headers(self, *args, **kwargs):
+        return self.executor.submit(self.store.get_headers, *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self.executor.submit(self.store.put, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.executor.submit(self.store.delete, *args, **kwargs)
+
+    def read(self, f, size=-1):
+        """ Read from a file returned by get """
+        return self.executor.submit(f.read, size)
+
+
+class _LRU(object):
+    """
+    Keys in order of use, least recent first, each with a size and an
+    optional value. Callers do their own locking.
+    """
+
+    def __init__(self):
+        self.total_size = 0
+        # key -> [previous, next, key, size, value], a circular list in order
+        # of use around a sentinel.
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, 0, None]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def size(self, key):
+        """ The key's size, or None if the key isn't present """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry[3]
+
+    def value(self, key):
+        """ The key's value, or None if the key isn't present """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry[4]
+
+    def use(self, key):
+        """
+        Record the key as most recently used and return its value.
+
+        :raises KeyError: not present
+        """
+        entry = self._entries[key]
+        self.add(key, entry[3], entry[4])
+        return entry[4]
+
+    def add(self, key, size, value=None):
+        """ Add or replace the key as the most recently used """
+        self.remove(key)
+        last = self._root[0]
+        entry = [last, self._root, key, size, value]
+        last[1] = self._root[0] = self._entries[key] = entry
+        self.total_size += size
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            previous, next = entry[0], entry[1]
+            previous[1], next[0] = next, previous
+            self.total_size -= entry[3]
+
+    def oldest(self):
+        """ The least recently used key, or None if there are none """
+        if not self._entries:
+            return None
+        return self._root[1][2]
+
+
+class _CountingReader(object):
+    """
+    Wraps a source file counting the bytes read from it.
+    """
+
+    def __init__(self, src):
+        self._src = src
+        self.count = 0
+        # Allow the size of real files to be checked before reading.
+        for name in ('fileno', 'tell'):
+            if hasattr(src, name):
+                setattr(self, name, getattr(src, name))
+
+    def read(self, size=-1):
+        data = self._src.read(size)
+        self.count += len(data)
+        return data
+
+
+class _KeepingReader(_CountingReader):
+    """
+    Wraps a source file counting the bytes read from it, and keeping them
+    while there are no more than max_size.
+    """
+
+    def __init__(self, src, max_size):
+        _CountingReader.__init__(self, src)
+        self._max_size = max_size
+        self._chunks = []
+
+    def read(self, size=-1):
+        data = _CountingReader.read(self, size)
+        if self._chunks is not None:
+            if self.count > self._max_size:
+                self._chunks = None
+            else:
+                self._chunks.append(data)
+        return data
+
+    def data(self):
+        """ Everything read, or None if that was more than max_size """
+        if self._chunks is None:
+            return None
+        return ''.join(self._chunks)
+
+
+class _HashingReader(_CountingReader):
+    """
+    Wraps a source file counting and hashing the bytes read from it.
+    """
+
+    def __init__(self, src):
+        _CountingReader.__init__(self, src)
+        self._hash = sha1()
+
+    def read(self, size=-1):
+        data = _CountingReader.read(self, size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
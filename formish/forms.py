@@ -4,12 +4,14 @@ The form module contains the main form, field, group and sequence classes
 
 import re
 import warnings
+import weakref
 
 from peak.util.proxies import ObjectWrapper
 from webob.multidict import UnicodeMultiDict
 
 import schemaish, validatish
 from formish import util
+from formish import compiled
 from dottedish import dotted, unflatten, set as dottedish_set
 from formish import validation
 from formish import widgets
@@ -64,22 +66,24 @@ def _cssname(self):
     """ Returns a hyphenated identifier using the form name and field name """
     if self.form.name:
         return '%s-%s'% (self.form.name, '-'.join(self.name.split('.')))
-    return '%s'% ('-'.join(self.name.split('.')))
+    return '-'.join(self.name.split('.'))
 
 
 def _classes(self):
     """ Works out a list of classes that should be applied to the field """
-    schema_types = mroattrs(self.attr.__class__,'type')
-    widget_types = mroattrs(self.widget.widget.__class__,'type')
-    classes = ['field',re.sub('[0-9\*]+','n',_cssname(self))]
-    for t in schema_types:
-        classes.append('type-%s'%t.lower())
-    for t in widget_types:
-        classes.append('widget-%s'%t.lower())
+    widget = self.widget
+    form_plan = self.form._plan
+    if self.form.name:
+        cssclass = '%s-%s'% (form_plan.cssclass(self.form.name), self._plan.cssclass)
+    else:
+        cssclass = self._plan.cssclass
+    classes = ['field', cssclass]
+    classes.extend(self._plan.type_classes)
+    classes.extend(form_plan.widget_classes(widget.widget.__class__))
     if self.required:
         classes.append('required')
-    if self.widget.css_class is not None:
-        classes.append(self.widget.css_class)
+    if widget.css_class is not None:
+        classes.append(widget.css_class)
     if str(self.error):
         classes.append('error')
     if getattr(self,'contains_error',None):
@@ -101,18 +105,164 @@ def starify(name):
     return name
 
 
+# Per renderer cache of the template path that fall_back_renderer resolved for
+# a (widget, name) pair.
+_resolved_templates = weakref.WeakKeyDictionary()
+
+
+def _resolved_templates_for(renderer):
+    """
+    Return the renderer's resolved template cache, discarding it if the
+    renderer's template directories have changed since it was built.
+    """
+    directories = tuple(getattr(getattr(renderer, 'lookup', None), 'directories', ()))
+    try:
+        cache = _resolved_templates.get(renderer)
+        if cache is None or cache[0] != directories:
+            cache = _resolved_templates[renderer] = (directories, {})
+    except TypeError:
+        # Can't weakref or hash the renderer so there's nowhere to cache.
+        cache = (directories, {})
+    return cache[1]
+
+
+class ItemPlan(object):
+    """
+    Form independent facts about a schema attribute bound to a starred
+    dotted name (e.g. 'b.*.x'), shared by all the rows of a sequence.
+
+    Everything here is derived from the schema's names and types alone so it
+    can be shared by all the forms built from the schema. Anything that
+    depends on a row's indices or can be changed later (titles, validators,
+    widgets, data, errors, etc) is looked up on the item when needed.
+    """
+
+    def __init__(self, starname, attr):
+        self._attr = weakref.ref(attr)
+        self.starname = starname
+        if starname is None:
+            self.cssclass = ''
+        else:
+            self.cssclass = re.sub('[0-9\*]+', 'n', '-'.join(starname.split('.')))
+        self.type_classes = ['type-%s'%t.lower() for t in mroattrs(attr.__class__, 'type')]
+
+    def binds(self, attr):
+        """ Was the plan built for the attr? """
+        return self._attr() is attr
+
+
+class FormPlan(object):
+    """
+    The static structure of a schema, built lazily and shared by every form
+    created from the same schema instance.
+
+    Per-request state (data, errors, request data) lives on the form; the
+    plan only caches what would otherwise be recomputed for every form.
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._widget_classes = {}
+        self._cssclasses = {}
+        self._templates = {}
+        self._children = {}
+
+    def item(self, name, attr):
+        """ Return the ItemPlan for the attr bound to the dotted name """
+        if name is not None:
+            name = starify(name)
+        plan = self._items.get(name)
+        if plan is None or not plan.binds(attr):
+            plan = self._items[name] = ItemPlan(name, attr)
+        return plan
+
+    def widget_classes(self, widget_class):
+        """ The widget-* css classes for a widget class """
+        try:
+            return self._widget_classes[widget_class]
+        except KeyError:
+            classes = self._widget_classes[widget_class] = \
+                    ['widget-%s'%t.lower() for t in mroattrs(widget_class, 'type')]
+            return classes
+
+    def cssclass(self, form_name):
+        """ The form name part of a field's css class """
+        try:
+            return self._cssclasses[form_name]
+        except KeyError:
+            cssclass = self._cssclasses[form_name] = re.sub('[0-9\*]+', 'n', form_name)
+            return cssclass
+
+    def children(self, attr):
+        """
+        Map the names of a structure attr's children to (position, attr).
+        """
+        entry = self._children.get(id(attr))
+        if entry is None or entry[0]() is not attr or entry[1] != len(attr.attrs):
+            children = dict([(name, (n, a)) for n, (name, a) in enumerate(attr.attrs)])
+            entry = self._children[id(attr)] = (weakref.ref(attr), len(attr.attrs), children)
+        return entry[2]
+
+    def template(self, template):
+        """ Split a widget's template into (template type, widget) """
+        try:
+            return self._templates[template]
+        except KeyError:
+            parts = self._templates[template] = tuple(template.split('.'))
+            return parts
+
+
+_form_plans = weakref.WeakKeyDictionary()
+
+
+def form_plan(structure):
+    """
+    Return the shared FormPlan for a schema structure.
+    """
+    try:
+        plan = _form_plans.get(structure)
+        if plan is None:
+            plan = _form_plans[structure] = FormPlan()
+    except TypeError:
+        plan = FormPlan()
+    return plan
+
+
 def fall_back_renderer(renderer, name, widget, vars):
     """
     Tries to find template in widget directly then tries in top level directory
 
     This allows a field level widget override it's container by including the
-    changed version in the widgets directory with the same name
+    changed version in the widgets directory with the same name. The template
+    that was found, or the fact the widget has no template of its own, is
+    remembered so that later renders go straight to the right template.
     """
     import mako
+    resolved = _resolved_templates_for(renderer)
+    template = resolved.get((widget, name))
+    if template is not None:
+        return renderer(template, vars)
+    widget_template = '/formish/widgets/%s/%s.html'%(widget,name)
+    lookup = getattr(renderer, 'lookup', None)
+    if lookup is not None:
+        # Resolve without rendering so a lookup failure inside the template
+        # isn't mistaken for the template not existing.
+        try:
+            lookup.get_template(widget_template)
+            template = widget_template
+        except mako.exceptions.TopLevelLookupException:
+            template = '/formish/%s.html'%(name)
+        resolved[(widget, name)] = template
+        return renderer(template, vars)
     try:
-        return renderer('/formish/widgets/%s/%s.html'%(widget,name), vars)
+        html = renderer(widget_template, vars)
     except mako.exceptions.TopLevelLookupException:
-        return renderer('/formish/%s.html'%(name), vars)
+        template = '/formish/%s.html'%(name)
+        html = renderer(template, vars)
+        resolved[(widget, name)] = template
+        return html
+    resolved[(widget, name)] = widget_template
+    return html
 
 
 class TemplatedString(object):
@@ -142,7 +292,7 @@ class TemplatedString(object):
             return False
 
     def __call__(self):
-        widget_type, widget = self.obj.widget.template.split('.')
+        widget_type, widget = self.obj.form._plan.template(self.obj.widget.template)
         renderer = self.obj.form.renderer
         name = '%s/%s'%(widget_type,self.attr_name)
         vars = {'field':self.obj}
@@ -196,7 +346,7 @@ class RenderableObjectWrapper(ObjectWrapper):
                 '/formish/form/%s.html' % self.__property_name,
                 {'form': self.__form_item})
         # So, we're a field (doesn't seem to support container form items yet).
-        widget_type, widget = self.__form_item.widget.template.split('.')
+        widget_type, widget = self.__form_item.form._plan.template(self.__form_item.widget.template)
         name = '%s/%s'%(widget_type,self.__property_name)
         vars = {'field':self.__form_item}
         return fall_back_renderer(self.__form_item.form.renderer, name, widget, vars)
@@ -224,9 +374,10 @@ class Field(object):
         :type form: formish.Form instance.
         """
         self.name = name
-        self.nodename = name.split('.')[-1]
         self.attr = attr
         self.form = form
+        self._plan = form._plan.item(name, attr)
+        self.nodename = name.split('.')[-1]
 
     def __repr__(self):
         return 'formish.Field(name=%r, attr=%r)'% (self.name, self.attr)
@@ -240,7 +391,7 @@ class Field(object):
             if self.attr.title is not None:
                 return self.attr.title
             else:
-                return util.title_from_name(self.name.split('.')[-1])
+                return util.title_from_name(self.nodename)
 
     def description():
         def get(self):
@@ -313,7 +464,7 @@ class Field(object):
         """ return the fields widget bound with extra params. """
         # Loop on the name to work out if any '*' widgets are used
         try:
-            widget_type = self.form.get_item_data(starify(self.name),'widget')
+            widget_type = self.form.get_item_data(self._plan.starname,'widget')
         except KeyError:
             if self.attr.type == 'Boolean':
                 if self.required is True:
@@ -324,35 +475,33 @@ class Field(object):
                 widget_type = widgets.FileUpload()
             else:
                 widget_type = widgets.Input()
-            self.form.set_item_data(starify(self.name),'widget',widget_type)
+            self.form.set_item_data(self._plan.starname,'widget',widget_type)
         return BoundWidget(widget_type, self)
 
     @property
     def contains_error(self):
         """ Check to see if any child elements have errors """
-        for k in self.form.errors.keys():
-            if k != self.name and k.startswith(self.name):
-                return True
-        return False
+        return self.form.errors.contains(self.name)
 
     @property
     def contained_errors(self):
-        contained_errors = []
-        for k in self.form.errors.keys():
-            if k.startswith(self.name):
-                contained_errors.append( (k[len(self.name)+1:],self.form.errors[k]) )
-        return contained_errors
+        """ The (relative key, error) pairs at and below this field """
+        return self.form.errors.contained(self.name)
 
     def __call__(self):
         """ returns a serialisation for this field using the form's renderer """
-        widget_type, widget = self.widget.template.split('.')
+        if self.form.compiled:
+            html = compiled.render_item(self)
+            if html is not None:
+                return html
+        widget_type, widget = self.form._plan.template(self.widget.template)
         renderer = self.form.renderer
         name = 'field/main'
         vars = {'field':self}
         return fall_back_renderer(renderer, name, widget, vars)
 
     def label(self):
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         """ returns the templated title """
         renderer = self.form.renderer
         name = 'field/label'
@@ -360,7 +509,7 @@ class Field(object):
         return fall_back_renderer(renderer, name, widget, vars)
 
     def seqdelete(self):
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         """ creates a seq delete hook if this is an item in a updateable sequence """
         parentkey = '.'.join(self.name.split('.')[:-1])
         if not parentkey:
@@ -374,7 +523,7 @@ class Field(object):
         return fall_back_renderer(renderer, name, widget, vars)
 
     def seqgrab(self):
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         """ creates a seq grab hook if this is an item in a updateable sequence """
         parentkey = '.'.join(self.name.split('.')[:-1])
         if not parentkey:
@@ -389,7 +538,7 @@ class Field(object):
 
     def inputs(self):
         """ returns the templated widget """
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         renderer = self.form.renderer
         name = 'field/inputs'
         vars = {'field':self}
@@ -407,7 +556,7 @@ class CollectionFieldsWrapper(ObjectWrapper):
         self.collection = collection
 
     def __call__(self):
-        widget_type, widget = self.collection.widget.template.split('.')
+        widget_type, widget = self.collection.form._plan.template(self.collection.widget.template)
         renderer = self.collection.form.renderer
         name = '%s/fields'%widget_type
         vars = {'field':self.collection}
@@ -434,17 +583,18 @@ class Collection(object):
         :type form: formish.Form instance.
         """
         self.name = name
+        self.attr = attr
+        self.form = form
+        self._plan = form._plan.item(name, attr)
         if name is not None:
             self.nodename = name.split('.')[-1]
         else:
             self.nodename = ''
-        self.attr = attr
-        self.form = form
         self._fields = {}
         # Construct a title
         self.title = self.attr.title
         if self.title is None and name is not None:
-            self.title = util.title_from_name(self.name.split('.')[-1])
+            self.title = util.title_from_name(self.nodename)
 
     @property
     def template_type(self):
@@ -515,27 +665,21 @@ class Collection(object):
     @property
     def contains_error(self):
         """ Check to see if any child elements have errors """
-        for k in self.form.errors.keys():
-            if k != self.name and k.startswith(self.name):
-                return True
-        return False
+        return self.form.errors.contains(self.name)
 
     @property
     def contained_errors(self):
-        contained_errors = []
-        for k in self.form.errors.keys():
-            if k.startswith(self.name):
-                contained_errors.append( (k[len(self.name)+1:],self.form.errors[k]) )
-        return contained_errors
+        """ The (relative key, error) pairs at and below this field """
+        return self.form.errors.contained(self.name)
 
     @property
     def widget(self):
         """ return the fields widget bound with extra params. """
 
         try:
-            w = self.form.get_item_data(starify(self.name),'widget')
+            w = self.form.get_item_data(self._plan.starname,'widget')
             if not isinstance(w, BoundWidget):
-                widget_type = BoundWidget(self.form.get_item_data(starify(self.name),'widget'),self)
+                widget_type = BoundWidget(w,self)
             else:
                 widget_type = w
         except KeyError:
@@ -543,32 +687,43 @@ class Collection(object):
                 widget_type = BoundWidget(widgets.StructureDefault(),self)
             else:
                 widget_type = BoundWidget(widgets.SequenceDefault(),self)
-            self.form.set_item_data(starify(self.name),'widget',widget_type)
+            self.form.set_item_data(self._plan.starname,'widget',widget_type)
         return widget_type
 
 
     def get_field(self, name):
         """ recursively get dotted field names """
-        segments = name.split('.')
-        if segments[0] == '*':
-            # Bind '*' to a fake field.
-            field = self.bind('*', self.attr)
+        field = self
+        for segment in name.split('.'):
+            field = field.get_child(segment)
+        return field
+
+    def get_child(self, nodename):
+        """
+        Get an immediate child field by name, using the form's field index.
+        """
+        if self.name is None:
+            key = nodename
         else:
-            # Find named field.
-            for field in self.fields:
-                if field.name.split('.')[-1] == segments[0]:
-                    break
-            else:
-                field = None
+            key = '%s.%s'% (self.name, nodename)
+        index = self.form._field_index
+        field = index.get(key)
+        if field is not None:
+            return field
+        if nodename == '*':
+            # Bind '*' to a fake field.
+            field = index[key] = self.bind('*', getattr(self.attr, 'attr', self.attr))
+            return field
+        # Index all of the children in one pass so that looking up their
+        # siblings doesn't mean iterating the fields again.
+        for field in self.fields:
+            index[field.name] = field
+        field = index.get(key)
         # Raise a nice error if the field was not found.
-        if not field:
+        if field is None:
             raise KeyError('%s %r has no field %r' % (self.__class__.__name__,
-                                                      self.name, segments[0]))
-        # Return field or recurse.
-        if len(segments) == 1:
-            return field
-        else:
-            return field.get_field('.'.join(segments[1:]))
+                                                      self.name, nodename))
+        return field
 
 
     def __getitem__(self, key):
@@ -636,7 +791,11 @@ class Collection(object):
 
     def __call__(self):
         """ returns a serialisation for this field using the form's renderer """
-        widget_type, widget = self.widget.template.split('.')
+        if self.form.compiled:
+            html = compiled.render_item(self)
+            if html is not None:
+                return html
+        widget_type, widget = self.form._plan.template(self.widget.template)
         renderer = self.form.renderer
         name = '%s/main'%widget_type
         vars = {'field':self}
@@ -644,14 +803,14 @@ class Collection(object):
 
     def label(self):
         """ returns the templated title """
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         renderer = self.form.renderer
         name = '%s/label'%widget_type
         vars = {'field':self}
         return fall_back_renderer(renderer, name, widget, vars)
 
     def seqgrab(self):
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         """ creates a seq grab hook if this is an item in a updateable sequence """
         parentkey = '.'.join(self.name.split('.')[:-1])
         if not parentkey:
@@ -665,7 +824,7 @@ class Collection(object):
         return fall_back_renderer(renderer, name, widget, vars)
 
     def seqdelete(self):
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         """ creates a seq delete hook if this is an item in a updateable sequence """
         parentkey = '.'.join(self.name.split('.')[:-1])
         if not parentkey:
@@ -681,7 +840,7 @@ class Collection(object):
 
     def inputs(self):
         """ returns the templated widget """
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         renderer = self.form.renderer
         name = '%s/inputs'%widget_type
         vars = {'field':self}
@@ -766,7 +925,7 @@ class Sequence(Collection):
 
     def metadata(self):
         """ returns the metadata """
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.form._plan.template(self.widget.template)
         renderer = self.form.renderer
         name = '%s/metadata'%widget_type
         vars = {'field':self}
@@ -794,7 +953,7 @@ class BoundWidget(object):
         setattr(self.widget, name, value)
 
     def __call__(self, **kw):
-        widget_type, widget = self.widget.template.split('.')
+        widget_type, widget = self.field.form._plan.template(self.widget.template)
         if self.widget.readonly == True:
             widget_template = 'readonly'
         else:
@@ -832,33 +991,168 @@ def tryint(v):
         return v
 
 class ErrorDict(dict):
+    """
+    A dict of errors keyed by dotted field name.
 
-    def __init__(self, form):
+    As well as the errors themselves, a tree of the keys' dotted segments is
+    maintained, recording how many errors are at or below each node. This
+    answers "are there errors below this field" and "which errors are below
+    this field" without looking at every key, and allows the keys to be
+    iterated in the form's field order by only visiting the keys in the dict.
+    """
+
+    def __init__(self, form, errors=None):
+        dict.__init__(self)
         self.form = form
+        # segment -> [number of keys at or below the node, children]
+        self._tree = {}
+        if errors:
+            self.update(errors)
+
+    def _index(self, key, delta):
+        """ Add (delta=1) or remove (delta=-1) a key from the tree """
+        children = self._tree
+        for segment in key.split('.'):
+            node = children.get(segment)
+            if node is None:
+                node = children[segment] = [0, {}]
+            node[0] += delta
+            if not node[0]:
+                # Nothing left at or below here.
+                del children[segment]
+                return
+            children = node[1]
+
+    def _node(self, prefix):
+        """ Find the tree node for a key prefix, or None """
+        node = [len(self), self._tree]
+        if not prefix:
+            return node
+        for segment in prefix.split('.'):
+            node = node[1].get(segment)
+            if node is None:
+                return None
+        return node
+
+    def __setitem__(self, key, value):
+        if not dict.__contains__(self, key):
+            self._index(key, 1)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._index(key, -1)
+
+    def pop(self, key, *args):
+        if dict.__contains__(self, key):
+            self._index(key, -1)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._index(key, -1)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._tree = {}
+
+    def contains(self, prefix):
+        """ Are there any errors below (but not at) the dotted prefix? """
+        node = self._node(prefix)
+        if node is None:
+            return False
+        return node[0] > int(dict.__contains__(self, prefix))
+
+    def contained(self, prefix):
+        """
+        Return a list of (key, error) pairs for the errors at and below the
+        dotted prefix, in field order. The keys are relative to the prefix.
+        """
+        node = self._node(prefix)
+        if node is None:
+            return []
+        if prefix:
+            start = len(prefix) + 1
+            attr = self._attr(prefix)
+        else:
+            start = 0
+            attr = self.form.structure.attr
+        return [(key[start:], dict.__getitem__(self, key))
+                for key in self._iterkeys(prefix, node[1], attr)]
+
+    def _attr(self, key):
+        """ The schema attribute for a dotted key or None """
+        attr = self.form.structure.attr
+        for segment in key.split('.'):
+            if isinstance(attr, schemaish.Sequence):
+                attr = attr.attr
+            elif isinstance(attr, schemaish.Structure):
+                attr = self.form._plan.children(attr).get(segment, (None, None))[1]
+            else:
+                return None
+        return attr
+
+    def _iterkeys(self, prefix, children, attr):
+        """
+        Yield the keys at and below the prefix, ordering siblings by their
+        position in the schema.
+        """
+        if dict.__contains__(self, prefix):
+            yield prefix
+        if isinstance(attr, schemaish.Structure):
+            positions = self.form._plan.children(attr)
+            unknown = (len(positions), None)
+            def order(segment):
+                return (positions.get(segment, unknown), tryint(segment))
+        else:
+            def order(segment):
+                return tryint(segment)
+        for segment in sorted(children, key=order):
+            if isinstance(attr, schemaish.Sequence):
+                child_attr = attr.attr
+            elif isinstance(attr, schemaish.Structure):
+                child_attr = positions.get(segment, unknown)[1]
+            else:
+                child_attr = None
+            if prefix:
+                key = '%s.%s'% (prefix, segment)
+            else:
+                key = segment
+            for k in self._iterkeys(key, children[segment][1], child_attr):
+                yield k
+
+    def __iter__(self):
+        return self._iterkeys('', self._tree, self.form.structure.attr)
+
+    iterkeys = __iter__
 
     def keys(self):
-        return list(self.__iter__())
+        return list(self)
+
+    def itervalues(self):
+        for key in self:
+            yield dict.__getitem__(self, key)
+
+    def values(self):
+        return list(self.itervalues())
 
     def iteritems(self):
         for key in self:
-            yield (key, self[key])
+            yield (key, dict.__getitem__(self, key))
 
     def items(self):
         return list(self.iteritems())
 
-    def __iter__(self):
-        for field in self.form.allfields:
-            if field.name in self:
-                fieldvalue = self[field.name]
-                yield fieldvalue
-                if isinstance(fieldvalue, dict):
-                    keys = []
-                    for k in fieldvalue.keys():
-                        keys.append( [tryint(k) for k in k.split('.')] )
-                    keys.sort()
-                    for k in keys:
-                        yield '.'.join(k)
-
 
 
 
@@ -881,10 +1175,13 @@ class Form(object):
 
     base_classes = ['formish-form']
 
+    compiled = False
+
     def __init__(self, structure, name=None, defaults=None, errors=None,
                  action_url=None, renderer=None, method='post',
                  add_default_action=True, include_charset=True,
-                 empty=UNSET, error_summary=None,error_summary_message=None,classes=None):
+                 empty=UNSET, error_summary=None,error_summary_message=None,classes=None,
+                 compiled=None):
         """
         Create a new form instance
 
@@ -911,19 +1208,25 @@ class Form(object):
 
         :arg error_summary: None, 'message', 'list'
         :type error_summary: string
+
+        :arg compiled: Render formish's structural templates (field, group and
+            sequence markup) directly in Python rather than through the
+            renderer. The output is identical; templates that have been
+            overridden are always rendered by the renderer.
+        :type compiled: boolean
         """
         if method.lower() not in self.SUPPORTED_METHODS:
             raise ValueError("method must be one of GET or POST")
         # allow a single schema items to be used on a form
         if not isinstance(structure, schemaish.Structure):
             structure = schemaish.Structure([structure])
+        self._plan = form_plan(structure)
+        self._field_index = {}
         self.structure = Group(None, structure, self)
         self.item_data = {}
         self.name = name
         if defaults is None:
             defaults = self.structure.attr.default or {}
-        if errors is None:
-            errors = ErrorDict(self)
         self.defaults = defaults
         self.errors = errors
         self._alert = None
@@ -947,6 +1250,8 @@ class Form(object):
         self.include_charset = include_charset
         if empty is not UNSET:
             self.empty = empty
+        if compiled is not None:
+            self.compiled = compiled
 
     def alert():
         def get(self):
@@ -973,6 +1278,19 @@ class Form(object):
 
     error = property(_get_error, _set_error)
 
+    def _get_errors(self):
+        return self._errors
+
+    def _set_errors(self, errors):
+        """
+        Assign the form's errors, which are always kept in an ErrorDict
+        """
+        if not isinstance(errors, ErrorDict):
+            errors = ErrorDict(self, errors)
+        self._errors = errors
+
+    errors = property(_get_errors, _set_errors)
+
     def __repr__(self):
         attributes = []
         attributes.append('%r'%self.structure.attr)
@@ -1032,10 +1350,10 @@ class Form(object):
         :arg raise_exceptions: Whether to raise exceptions or return errors
         """
         data = self.widget.from_request_data(self.structure, request_data, skip_read_only_defaults=skip_read_only_defaults)
-        if raise_exceptions and len(self.errors.keys()):
+        if raise_exceptions and len(self.errors):
             raise validation.FormError( \
         'Tried to access data but conversion from request failed with %s errors (%s)'% \
-                   (len(self.errors.keys()), self.errors))
+                   (len(self.errors), self.errors))
         return data
 
 
@@ -1047,6 +1365,7 @@ class Form(object):
         if self._request_data is not None:
             return dotted(self._request_data)
         self._request_data = dotted(self.widget.to_request_data(self.structure, self._defaults))
+        self._field_index = {}
         return dotted(self._request_data)
 
 
@@ -1058,6 +1377,7 @@ class Form(object):
         :type request_data: Dictionary (dotted or nested or dotted or MultiDict)
         """
         self._request_data = dotted(request_data)
+        self._field_index = {}
 
 
     request_data = property(_get_request_data, _set_request_data)
@@ -1072,6 +1392,7 @@ class Form(object):
         """ assign data """
         self._defaults = data
         self._request_data = None
+        self._field_index = {}
 
 
     defaults = property(_get_defaults, _set_defaults)
@@ -1088,18 +1409,16 @@ class Form(object):
         # Decode request data according to the request's charset.
         request_data = UnicodeMultiDict(request_data,
                                         encoding=util.get_post_charset(request))
-        # Remove the sequence factory data from the request
-        for k in request_data.keys():
-            if '*' in k:
-                request_data.pop(k)
         # We need the _request_data to be populated so sequences know how many
         # items they have (i.e. .fields method on a sequence uses the number of
         # values on the _request_data)
 
-        # Convert request data to a dottedish friendly representation
+        # Convert request data to a dottedish friendly representation, removing
+        # the sequence factory data from the request
         request_data = _unflatten_request_data(request_data)
         self._request_data = dotted(request_data)
         self._request_data = dotted(self.widget.pre_parse_incoming_request_data(self.structure,request_data))
+        self._field_index = {}
 
     def _get_request(self):
         return self._request
@@ -1156,9 +1475,9 @@ class Form(object):
             for key, value in e.error_dict.items():
                 if key not in self.errors:
                     self.errors[key] = value
-        if len(self.errors.keys()) > 0:
+        if len(self.errors) > 0:
             err_msg = 'Tried to access data but conversion from request failed with %s errors'
-            raise validation.FormError(err_msg% (len(self.errors.keys())))
+            raise validation.FormError(err_msg% (len(self.errors)))
         return data
 
     def set_item_data(self, key, name, value):
@@ -1168,6 +1487,8 @@ class Form(object):
         """
         allowed = ['title', 'widget', 'description','default']
         if name in allowed:
+            # Widgets and defaults can change the length of a sequence.
+            self._field_index = {}
             if name == 'default' and '*' not in key:
                 dottedish_set(self.defaults,key,value,container_factory=container_factory)
             else:
@@ -1238,30 +1559,53 @@ class Form(object):
         """
         Get a field by dotted field name
 
+        Fields, including '*' template fields, are indexed by their dotted name
+        as they are found. The index is discarded whenever something that can
+        change the number of items in a sequence changes.
+
         :arg name: Dotted name e.g. names.0.firstname
         """
-        # XXX GET FIELD NEEDS TO CACHE THE * FIELDS
+        try:
+            return self._field_index[name]
+        except KeyError:
+            pass
         segments = name.split('.')
-        for field in self.fields:
-            if segments[0] == '*':
-                b = self.bind('*',field.attr)
-                if len(segments) == 1:
-                    return b
-                else:
-                    return b.get_field('.'.join(segments[1:]))
-            if field.name.split('.')[-1] == segments[0]:
-                if len(segments) == 1:
-                    return field
-                else:
-                    return field.get_field('.'.join(segments[1:]))
+        try:
+            field = self.structure.get_child(segments[0])
+        except KeyError:
+            return None
+        if len(segments) > 1:
+            field = field.get_field('.'.join(segments[1:]))
+            self._field_index[name] = field
+        return field
 
 
     def __call__(self):
         """
         Calling the Form generates a serialisation using the form's renderer
         """
+        if self.compiled:
+            html = compiled.render_form(self)
+            if html is not None:
+                return html
         return self.renderer('/formish/form/main.html', {'form':self})
 
+    def stream(self):
+        """
+        Generate the same serialisation as calling the form, but as an
+        iterator of unicode chunks in document order so that a response can
+        be sent while the rest of the form is rendered, e.g.
+        ``(chunk.encode('utf-8') for chunk in form.stream())``.
+
+        Forms using formish's own form templates yield a chunk for each part
+        of the form and field (and for each item of a sequence or row of a
+        grid), rendered as compiled mode does. Anything else is one chunk.
+        """
+        chunks = compiled.iter_form(self)
+        if chunks is None:
+            return iter([self()])
+        return chunks
+
     def header(self):
         """ Return just the header part of the template """
         return self.renderer('/formish/form/header.html', {'form':self})
@@ -1286,16 +1630,27 @@ class Form(object):
 def _unflatten_request_data(request_data):
     """
     Unflatten the request data into nested dicts and lists.
+
+    Sequence template fields (any key containing a '*') are dropped. The data
+    is read in a single pass so that forms posting very large numbers of
+    fields (e.g. grids) are not quadratic in the number of fields.
     """
-    # Build an ordered list of keys. Don't rely on the request_data doing this
-    # for us because webob's MultiDict yields the same key multiple times!
-    # Of course, if request_data is not an ordered dict then this is fairly
+    # Build an ordered list of keys and group the values by key. Don't rely on
+    # the request_data doing this for us because webob's MultiDict yields the
+    # same key multiple times (and getall is a scan of all the items)! Of
+    # course, if request_data is not an ordered dict then the order is fairly
     # pointless anyway.
     keys = []
-    for key in request_data:
-        if key not in keys:
+    values = {}
+    for key, value in request_data.iteritems():
+        if '*' in key:
+            continue
+        try:
+            values[key].append(value)
+        except KeyError:
             keys.append(key)
-    return unflatten(((key, request_data.getall(key)) for key in keys),
+            values[key] = [value]
+    return unflatten(((key, values[key]) for key in keys),
                      container_factory=container_factory)
 
 
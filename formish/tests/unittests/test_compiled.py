@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+import unittest
+import schemaish
+import validatish
+import formish
+from formish import compiled
+from formish.renderer import Renderer
+
+
+def build_form(**k):
+    item = schemaish.Structure([
+        ('x', schemaish.String(title='Ex & Why')),
+        ('y', schemaish.Integer(validator=validatish.Required())),
+        ])
+    schema = schemaish.Structure([
+        ('a', schemaish.String(validator=validatish.Required(), description='<a> & b')),
+        ('h', schemaish.String()),
+        ('b', schemaish.Boolean()),
+        ('g', schemaish.Structure([
+            ('x', schemaish.Integer()),
+            ('d', schemaish.Date()),
+            ], description='group')),
+        ('s', schemaish.Sequence(schemaish.String(), description='sequence')),
+        ('t', schemaish.Sequence(item)),
+        ('u', schemaish.Sequence(schemaish.String())),
+        ('grid', schemaish.Sequence(item)),
+        ('f', schemaish.File()),
+        ])
+    form = formish.Form(schema, **k)
+    form['h'].widget = formish.Hidden()
+    form['g.d'].widget = formish.DateParts()
+    form['u'].widget = formish.SequenceDefault(addremove=False, sortable=False)
+    form['grid'].widget = formish.Grid()
+    form['f'].widget = formish.FileUpload(show_image_thumbnail=True)
+    form.defaults = {'a': 'a"b', 's': ['one', 'two'], 't': [{'x': 'x', 'y': 1}],
+                     'u': ['u'], 'grid': [{'x': 'g', 'y': 2}, {'x': 'h', 'y': 3}]}
+    return form
+
+
+def add_errors(form):
+    form.errors = {
+        'a': 'is required',
+        's.1': 'bad <item>',
+        't.0.y': 'is required',
+        'g': validatish.Invalid('group error'),
+        'u': validatish.Invalid('sequence error'),
+        }
+
+
+class TestCompiled(unittest.TestCase):
+
+    def assertCompiledEqual(self, form):
+        expected = form()
+        form.compiled = True
+        self.assertEqual(form(), expected)
+        for field in form.fields:
+            form.compiled = False
+            expected = field()
+            form.compiled = True
+            self.assertEqual(field(), expected)
+
+    def test_form(self):
+        self.assertCompiledEqual(build_form())
+
+    def test_named_form(self):
+        self.assertCompiledEqual(build_form(name='named'))
+
+    def test_errors(self):
+        form = build_form(name='errors', error_summary='list')
+        add_errors(form)
+        self.assertCompiledEqual(form)
+
+    def assertStreamEqual(self, form):
+        for form.compiled in [False, True]:
+            expected = form()
+            chunks = list(form.stream())
+            self.assertEqual(u''.join(chunks), expected)
+        return chunks
+
+    def test_stream(self):
+        form = build_form()
+        chunks = self.assertStreamEqual(form)
+        self.assertTrue(chunks[0].lstrip().startswith(u'<form'))
+        # The grid is streamed a row at a time.
+        rows = [chunk for chunk in chunks if chunk.startswith(u'  <tr>')]
+        self.assertEqual(len(rows), 2)
+        self.assertTrue('grid.1.y' in rows[1])
+
+    def test_stream_errors(self):
+        form = build_form(name='errors', error_summary='list')
+        add_errors(form)
+        self.assertStreamEqual(form)
+
+    def test_stream_large_sequence(self):
+        form = build_form()
+        form.defaults = {'s': ['item %s'% n for n in range(50)],
+                         'grid': [{'x': str(n), 'y': n} for n in range(50)]}
+        chunks = self.assertStreamEqual(form)
+        self.assertTrue(len(chunks) > 100)
+
+    def test_stream_custom_renderer(self):
+        form = build_form(renderer=lambda template, args: u'custom')
+        self.assertEqual(list(form.stream()), [u'custom'])
+
+    def test_compiled_arg(self):
+        form = build_form(compiled=True)
+        self.assertTrue(form.compiled)
+        self.assertFalse(build_form().compiled)
+
+    def test_custom_renderer(self):
+        form = build_form(renderer=lambda template, args: u'custom', compiled=True)
+        self.assertEqual(form(), u'custom')
+        self.assertEqual(compiled.render_form(form), None)
+
+    def test_overridden_template(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            template = os.path.join(tmpdir, 'formish', 'field', 'label.html')
+            os.makedirs(os.path.dirname(template))
+            open(template, 'w').write('<%page args="field" />custom label')
+            form = build_form(renderer=Renderer([tmpdir]), compiled=True)
+            self.assertEqual(compiled.render_item(form.get_field('a')), None)
+            self.assertEqual(compiled.render_item(form.get_field('g')) is None, False)
+            self.assertTrue('custom label' in form())
+            self.assertCompiledEqual(form)
+            self.assertStreamEqual(form)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_overridden_grid_template(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            template = os.path.join(tmpdir, 'formish', 'widgets', 'Grid', 'widget.html')
+            os.makedirs(os.path.dirname(template))
+            open(template, 'w').write('<%page args="field" />grid')
+            form = build_form(renderer=Renderer([tmpdir]))
+            chunks = self.assertStreamEqual(form)
+            self.assertTrue(u'grid' in chunks)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_overridden_form_template(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            template = os.path.join(tmpdir, 'formish', 'form', 'main.html')
+            os.makedirs(os.path.dirname(template))
+            open(template, 'w').write('<%page args="form" />form')
+            form = build_form(renderer=Renderer([tmpdir]))
+            self.assertEqual(list(form.stream()), [u'form'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_overridden_widget_template(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            template = os.path.join(tmpdir, 'formish', 'widgets', 'Hidden', 'field', 'main.html')
+            os.makedirs(os.path.dirname(template))
+            open(template, 'w').write('<%page args="field" />hidden')
+            form = build_form(renderer=Renderer([tmpdir]), compiled=True)
+            self.assertEqual(compiled.render_item(form.get_field('h')), None)
+            self.assertEqual(form.get_field('h')(), u'hidden')
+            self.assertCompiledEqual(form)
+            self.assertStreamEqual(form)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
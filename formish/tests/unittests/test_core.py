@@ -310,6 +310,216 @@ def failure(request, form):
     return 'failure'
 
 
+class TestFormPlan(unittest.TestCase):
+
+    schema = schemaish.Structure([
+        ("a", schemaish.String(validator=validatish.Required())),
+        ("b", schemaish.Sequence(schemaish.Structure([("first_name", schemaish.String())]))),
+        ])
+
+    def test_plan_shared(self):
+        one = formish.Form(self.schema, 'one')
+        two = formish.Form(self.schema, 'two')
+        assert one._plan is two._plan
+        assert one['a'].field._plan is two['a'].field._plan
+        assert formish.Form(schemaish.Structure(), 'three')._plan is not one._plan
+
+    def test_form_state_not_shared(self):
+        one = formish.Form(self.schema, 'one')
+        two = formish.Form(self.schema)
+        one['a'].title = 'Changed'
+        self.assertEqual(one['a'].title, 'Changed')
+        self.assertEqual(two['a'].title, 'A')
+        self.assertEqual(one['a'].cssname, 'one-a')
+        self.assertEqual(two['a'].cssname, 'a')
+        assert one['a'].required is True
+
+    def test_sequence_items(self):
+        form = formish.Form(self.schema, 'form1')
+        form.defaults = {'b': [{'first_name': 'x'}, {'first_name': 'y'}]}
+        field = form['b.1.first_name'].field
+        self.assertEqual(field.title, 'First Name')
+        self.assertEqual(field.cssname, 'form1-b-1-first_name')
+        assert 'formn-b-n-first_name' in field.classes.split()
+        assert 'type-string' in field.classes.split()
+        assert 'widget-input' in field.classes.split()
+
+    def test_schema_changed(self):
+        schema = schemaish.Structure([("a", schemaish.String())])
+        formish.Form(schema)['a'].title
+        schema.attrs[0] = ("a", schemaish.String(title='Changed'))
+        self.assertEqual(formish.Form(schema)['a'].title, 'Changed')
+
+    def test_rows_share_plans(self):
+        form = formish.Form(self.schema, 'form1')
+        form.defaults = {'b': [{'first_name': str(n)} for n in range(20)]}
+        fields = [form['b.%s.first_name'% n].field for n in range(20)]
+        assert fields[0]._plan is fields[19]._plan
+        assert fields[0]._plan is form['b.*.first_name'].field._plan
+        self.assertEqual(sorted(form._plan._items), [None, 'a', 'b', 'b.*', 'b.*.first_name'])
+        self.assertEqual(fields[19].cssname, 'form1-b-19-first_name')
+        self.assertEqual(fields[19].nodename, 'first_name')
+
+    def test_attr_changed(self):
+        schema = schemaish.Structure([("a", schemaish.String())])
+        form = formish.Form(schema)
+        assert form['a'].required is False
+        schema.attrs[0][1].validator = validatish.Required()
+        schema.attrs[0][1].title = 'Changed'
+        form = formish.Form(schema)
+        assert form['a'].required is True
+        self.assertEqual(form['a'].title, 'Changed')
+
+
+class TestGetField(unittest.TestCase):
+
+    schema = schemaish.Structure([
+        ("a", schemaish.String()),
+        ("b", schemaish.Sequence(schemaish.Structure([("x", schemaish.String())]))),
+        ("c", schemaish.Structure([("y", schemaish.String())])),
+        ])
+
+    def test_get_field(self):
+        form = formish.Form(self.schema, 'form')
+        form.defaults = {'b': [{'x': '1'}, {'x': '2'}]}
+        self.assertEqual(form.get_field('a').name, 'a')
+        self.assertEqual(form.get_field('c.y').name, 'c.y')
+        self.assertEqual(form.get_field('b.1.x').name, 'b.1.x')
+        assert form.get_field('b.1.x') is form['b']['1']['x'].field
+        assert form.get_field('c').get_field('y') is form.get_field('c.y')
+        assert form.get_field('missing') is None
+        self.assertRaises(KeyError, form.get_field, 'c.missing')
+        self.assertRaises(KeyError, form.get_field, 'b.2.x')
+
+    def test_template_fields(self):
+        form = formish.Form(self.schema, 'form')
+        field = form.get_field('b.*.x')
+        self.assertEqual(field.name, 'b.*.x')
+        assert form.get_field('b.*') is form.get_field('b').template
+        assert form.get_field('b.*.x') is field
+        self.assertEqual(form['b.*.x'].title, 'X')
+
+    def test_sequence_length_changes(self):
+        form = formish.Form(self.schema, 'form')
+        form.defaults = {'b': [{'x': '1'}, {'x': '2'}, {'x': '3'}]}
+        self.assertEqual(form.get_field('b.2.x').name, 'b.2.x')
+        form.defaults = {'b': [{'x': '1'}]}
+        self.assertRaises(KeyError, form.get_field, 'b.2.x')
+        request = Request('form', [('b.0.x', '1'), ('b.1.x', '2'), ('b.2.x', '3')])
+        form.validate(request)
+        self.assertEqual(form.get_field('b.2.x').name, 'b.2.x')
+        form.validate(Request('form', {'b.0.x': '1'}))
+        self.assertRaises(KeyError, form.get_field, 'b.2.x')
+
+    def test_widget_changes_length(self):
+        form = formish.Form(self.schema, 'form')
+        self.assertRaises(KeyError, form.get_field, 'b.2')
+        form['b'].widget = formish.SequenceDefault(min_start_fields=3)
+        self.assertEqual(form.get_field('b.2').name, 'b.2')
+
+
+class TestErrorDict(unittest.TestCase):
+
+    schema = schemaish.Structure([
+        ('z', schemaish.String()),
+        ('a', schemaish.Sequence(schemaish.Structure([
+            ('y', schemaish.String()),
+            ('x', schemaish.String()),
+            ]))),
+        ('ab', schemaish.String()),
+        ])
+
+    def test_assignment_wraps(self):
+        form = formish.Form(self.schema, 'form')
+        form.errors = {'z': 'bad'}
+        assert isinstance(form.errors, formish.forms.ErrorDict)
+        self.assertEqual(form.errors.items(), [('z', 'bad')])
+
+    def test_field_order(self):
+        form = formish.Form(self.schema, 'form')
+        form.errors = {'ab': 1, 'a.10.x': 2, 'a.2.x': 3, 'a.2.y': 4,
+                       'a': 5, 'z': 6, 'other': 7}
+        self.assertEqual(form.errors.keys(),
+                         ['z', 'a', 'a.2.y', 'a.2.x', 'a.10.x', 'ab', 'other'])
+        self.assertEqual(form.errors.values(), [6, 5, 4, 3, 2, 1, 7])
+
+    def test_contains(self):
+        form = formish.Form(self.schema, 'form')
+        form.errors = {'ab': 'bad', 'a.1.x': 'bad'}
+        self.assertTrue(form.errors.contains('a'))
+        self.assertTrue(form.errors.contains('a.1'))
+        self.assertFalse(form.errors.contains('a.1.x'))
+        self.assertFalse(form.errors.contains('a.0'))
+        self.assertFalse(form.errors.contains('ab'))
+        self.assertTrue(form['a'].contains_error)
+        self.assertFalse(form['z'].contains_error)
+
+    def test_contained(self):
+        form = formish.Form(self.schema, 'form')
+        form.errors = {'ab': 'ab', 'a': 'a', 'a.1.x': 'x', 'a.0.y': 'y'}
+        self.assertEqual(form['a'].contained_errors,
+                         [('', 'a'), ('0.y', 'y'), ('1.x', 'x')])
+        self.assertEqual(form['ab'].contained_errors, [('', 'ab')])
+        self.assertEqual(form['z'].contained_errors, [])
+
+    def test_mutation(self):
+        form = formish.Form(self.schema, 'form')
+        form.errors['a.0.x'] = 'x'
+        form.errors['a.0.y'] = 'y'
+        self.assertTrue(form.errors.contains('a'))
+        del form.errors['a.0.x']
+        self.assertTrue(form.errors.contains('a'))
+        self.assertEqual(form.errors.pop('a.0.y'), 'y')
+        self.assertFalse(form.errors.contains('a'))
+        self.assertEqual(form.errors.keys(), [])
+        form.errors.update({'z': 'z'})
+        form.errors.setdefault('ab', 'ab')
+        self.assertEqual(form.errors.items(), [('z', 'z'), ('ab', 'ab')])
+        form.errors.clear()
+        self.assertEqual(form.errors.keys(), [])
+
+    def test_validate(self):
+        schema = schemaish.Structure([
+            ('b', schemaish.String(validator=validatish.Required())),
+            ('a', schemaish.String(validator=validatish.Required())),
+            ])
+        form = formish.Form(schema, 'form')
+        self.assertRaises(validation.FormError, form.validate,
+                          Request('form', {'a': '', 'b': ''}))
+        self.assertEqual(form.errors.keys(), ['b', 'a'])
+
+
+class TestRequestData(unittest.TestCase):
+
+    def test_unflatten_order_and_templates(self):
+        data = MultiDict([('b.0', '1'), ('a', 'x'), ('b.*', 't'), ('b.1', '2'),
+                          ('a', 'y'), ('c.*.d', 't')])
+        self.assertEqual(formish.forms._unflatten_request_data(data),
+                         {'a': ['x', 'y'], 'b': [['1'], ['2']]})
+
+    def test_large_grid_post(self):
+        schema = schemaish.Structure([
+            ('rows', schemaish.Sequence(schemaish.Structure([
+                ('a', schemaish.String()),
+                ('b', schemaish.Integer()),
+                ('c', schemaish.String()),
+                ]))),
+            ])
+        form = formish.Form(schema, 'form')
+        form['rows'].widget = formish.Grid()
+        rows = 4000
+        post = []
+        for n in xrange(rows):
+            post.extend([('rows.%d.a'%n, 'a%d'%n), ('rows.%d.b'%n, str(n)),
+                         ('rows.%d.c'%n, 'c%d'%n)])
+            if n % 100 == 0:
+                post.append(('rows.*.a', ''))
+        data = form.validate(Request('form', post))
+        self.assertEqual(len(data['rows']), rows)
+        self.assertEqual(data['rows'][rows-1], {'a': 'a%d'%(rows-1), 'b': rows-1,
+                                                'c': 'c%d'%(rows-1)})
+
+
 class TestBugs(unittest.TestCase):
 
     def test_date_conversion(self):
@@ -1,5 +1,25 @@
+from cStringIO import StringIO
+import gzip
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from restish import http
 from formish import fileresource
+from formish._keylock import KeyLocks
+from formish.filestore import CachedTempFilestore, FileSystemHeaderedFilestore, \
+        MemoryTieredFilestore
+
+
+def upper_resizer(src_fh, size, ismax, quality=70, crop=False):
+    """ A resizer for the process pool tests """
+    if src_fh.read(5) == 'sleep':
+        time.sleep(0.5)
+    src_fh.seek(-5, os.SEEK_CUR)
+    return StringIO('%s %r %r %r %r'% (src_fh.read().upper(), size, ismax, quality, crop))
 
 
 class TestCase(unittest.TestCase):
@@ -30,5 +50,607 @@ class TestCase(unittest.TestCase):
             self.assertEquals(result, expected)
 
 
+class TestFileServing(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname))
+        self.store.put('foo', StringIO('0123456789' * 10000), 'tag',
+                       [('Content-Type', 'text/plain')])
+        self.resource = fileresource.FileResource(self.store)
+        self.resource.chunk_size = 4096
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_chunked(self):
+        response = self.resource.get_file(http.Request.blank('/'), None, 'foo', None)
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.headers['Content-Length'], '100000')
+        self.assertEqual(response.headers['ETag'], 'tag')
+        chunks = list(response.app_iter)
+        self.assertEqual(len(chunks[0]), 4096)
+        self.assertEqual(''.join(chunks), '0123456789' * 10000)
+
+    def test_close(self):
+        response = self.resource.get_file(http.Request.blank('/'), None, 'foo', None)
+        app_iter = response.app_iter
+        app_iter.next()
+        app_iter.close()
+        self.assertRaises(StopIteration, app_iter.next)
+
+    def test_file_wrapper(self):
+        wrapped = []
+        def file_wrapper(f, chunk_size):
+            wrapped.append((f, chunk_size))
+            # A sendfile based wrapper would start at the OS's position.
+            self.assertEqual(os.lseek(f.fileno(), 0, os.SEEK_CUR), f.tell())
+            return iter([f.read()])
+        request = http.Request.blank('/', {'wsgi.file_wrapper': file_wrapper})
+        response = self.resource.get_file(request, None, 'foo', None)
+        self.assertEqual(wrapped[0][1], 4096)
+        self.assertEqual(response.headers['Content-Length'], '100000')
+        self.assertEqual(''.join(response.app_iter), '0123456789' * 10000)
+        wrapped[0][0].close()
+
+    def test_memory_tier(self):
+        store = CachedTempFilestore(MemoryTieredFilestore(
+            FileSystemHeaderedFilestore(self.dirname)))
+        store.put('small', StringIO('Yay!'), 'tag', [('Content-Type', 'text/plain')])
+        resource = fileresource.FileResource(store)
+        request = http.Request.blank('/', {'HTTP_RANGE': 'bytes=1-'})
+        response = resource.get_file(request, None, 'small', None)
+        self.assertEqual(response.status, '206 Partial Content')
+        self.assertEqual(response.headers['Content-Length'], '3')
+        self.assertTrue('Last-Modified' in response.headers)
+        self.assertEqual(''.join(response.app_iter), 'ay!')
+
+    def test_not_modified(self):
+        response = self.resource.get_file(http.Request.blank('/'), None, 'foo', 'tag')
+        self.assertEqual(response.status, '304 Not Modified')
+
+
+class TestAsyncFileServer(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        store = CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname))
+        store.put('foo', StringIO('0123456789' * 1000), 'tag',
+                  [('Content-Type', 'text/plain')])
+        resource = fileresource.FileResource(store)
+        resource.chunk_size = 4096
+        self.server = fileresource.AsyncFileServer(resource, workers=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def read_all(self, response):
+        body = self.server.body(response)
+        chunks = []
+        while True:
+            data = body.read().result(5)
+            if not data:
+                return chunks
+            chunks.append(data)
+
+    def test_serve(self):
+        response = self.server.serve(http.Request.blank('/'), 'foo').result(5)
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.headers['ETag'], 'tag')
+        chunks = self.read_all(response)
+        self.assertEqual(len(chunks[0]), 4096)
+        self.assertEqual(''.join(chunks), '0123456789' * 1000)
+
+    def test_conditional(self):
+        request = http.Request.blank('/', {'HTTP_IF_NONE_MATCH': '"tag"'})
+        response = self.server.serve(request, 'foo').result(5)
+        self.assertEqual(response.status, '304 Not Modified')
+        self.assertEqual(self.read_all(response), [])
+
+    def test_not_found(self):
+        done = threading.Event()
+        future = self.server.serve(http.Request.blank('/'), 'missing')
+        future.add_done_callback(lambda future: done.set())
+        done.wait(5)
+        self.assertEqual(future.result().status, '404 Not Found')
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname))
+        self.store.put('foo', StringIO('0123456789' * 100), 'tag',
+                       [('Content-Type', 'text/plain; charset=utf-8')])
+        self.store.put('small', StringIO('small'), 'tag', [('Content-Type', 'text/plain')])
+        self.store.put('image', StringIO('0123456789' * 100), 'tag', [('Content-Type', 'image/png')])
+        self.resource = fileresource.FileResource(self.store, self.store)
+        self.resource.encodings = ['gzip']
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def get(self, key, accept_encoding='gzip, deflate', etag=None):
+        request = http.Request.blank('/', {'HTTP_ACCEPT_ENCODING': accept_encoding})
+        return self.resource.get_file(request, None, key, etag)
+
+    def test_choose_encoding(self):
+        tests = [
+            (None, None),
+            ('', None),
+            ('gzip', 'gzip'),
+            ('deflate, gzip;q=0.5, br', 'br'),
+            ('gzip;q=1.0, br;q=0.5', 'gzip'),
+            ('gzip;q=0, br;q=0', None),
+            ('*', 'br'),
+            ('*, br;q=0', 'gzip'),
+            ('identity', None),
+            ]
+        for header, expected in tests:
+            self.assertEqual(fileresource.choose_encoding(header, ['br', 'gzip']), expected)
+
+    def test_gzip(self):
+        response = self.get('foo')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['ETag'], 'tag-gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.headers['Content-Type'], 'text/plain; charset=utf-8')
+        body = ''.join(response.app_iter)
+        self.assertEqual(response.headers['Content-Length'], str(len(body)))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(), '0123456789' * 100)
+        # Later requests are served the cached copy.
+        self.assertEqual(self.store.get_headers('_foo-gzip'),
+                         ('tag', [('Content-Type', 'text/plain; charset=utf-8'),
+                                  ('Content-Encoding', 'gzip')]))
+        self.assertEqual(''.join(self.get('foo').app_iter), body)
+
+    def test_not_modified(self):
+        response = self.get('foo', etag='tag-gzip')
+        self.assertEqual(response.status, '304 Not Modified')
+        self.assertEqual(response.headers['ETag'], 'tag-gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        response = self.get('foo', etag='tag')
+        self.assertEqual(response.status, '304 Not Modified')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+    def test_identity(self):
+        for key, accept_encoding in [('foo', 'gzip;q=0'), ('foo', ''), ('small', 'gzip')]:
+            response = self.get(key, accept_encoding)
+            self.assertEqual(response.headers.get('Content-Encoding'), None)
+            self.assertEqual(response.headers['ETag'], 'tag')
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            ''.join(response.app_iter)
+        response = self.get('image')
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(response.headers.get('Vary'), None)
+        ''.join(response.app_iter)
+
+    def test_changed(self):
+        ''.join(self.get('foo').app_iter)
+        self.store.put('foo', StringIO('abcdefghij' * 100), 'tag2', [('Content-Type', 'text/plain')])
+        response = self.get('foo')
+        self.assertEqual(response.headers['ETag'], 'tag2-gzip')
+        body = ''.join(response.app_iter)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(), 'abcdefghij' * 100)
+
+    def test_brotli(self):
+        if fileresource.brotli is None:
+            return
+        self.resource.encodings = ['br', 'gzip']
+        response = self.get('foo', 'gzip, br')
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        body = ''.join(response.app_iter)
+        self.assertEqual(fileresource.brotli.decompress(body), '0123456789' * 100)
+
+
+class TestRanges(unittest.TestCase):
+
+    content = ''.join([chr(ord('a') + n % 26) for n in xrange(1000)])
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname))
+        self.store.put('foo', StringIO(self.content), 'tag',
+                       [('Content-Type', 'text/plain'),
+                        ('Last-Modified', 'Sun, 18 Oct 2009 10:00:00 GMT')])
+        self.resource = fileresource.FileResource(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def get(self, **headers):
+        request = http.Request.blank('/')
+        for name, value in headers.items():
+            request.headers[name.replace('_', '-')] = value
+        return self.resource.get_file(request, None, 'foo', None)
+
+    def test_parse_ranges(self):
+        tests = [
+            (None, None),
+            ('', None),
+            ('items=0-1', None),
+            ('bytes=x-1', None),
+            ('bytes=5-1', None),
+            ('bytes=0-0', [(0, 1)]),
+            ('bytes=0-', [(0, 100)]),
+            ('bytes=90-200', [(90, 100)]),
+            ('bytes=-10', [(90, 100)]),
+            ('bytes=-200', [(0, 100)]),
+            ('bytes=50-59, 0-9', [(0, 10), (50, 60)]),
+            ('bytes=0-9,5-19,20-29', [(0, 30)]),
+            ('bytes=100-', []),
+            ('bytes=-0', []),
+            ]
+        for header, expected in tests:
+            self.assertEqual(fileresource.parse_ranges(header, 100), expected)
+
+    def test_full(self):
+        response = self.get()
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.headers['Last-Modified'], 'Sun, 18 Oct 2009 10:00:00 GMT')
+        self.assertEqual(''.join(response.app_iter), self.content)
+
+    def test_mtime_last_modified(self):
+        self.store.put('bar', StringIO('bar'), 'tag', [('Content-Type', 'text/plain')])
+        response = self.resource.get_file(http.Request.blank('/'), None, 'bar', None)
+        modified = fileresource.parse_http_date(response.headers['Last-Modified'])
+        self.assertEqual(modified, int(os.path.getmtime(os.path.join(self.dirname, 'bar'))))
+        ''.join(response.app_iter)
+
+    def test_single_range(self):
+        response = self.get(Range='bytes=10-19')
+        self.assertEqual(response.status, '206 Partial Content')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 10-19/1000')
+        self.assertEqual(response.headers['Content-Length'], '10')
+        self.assertEqual(''.join(response.app_iter), self.content[10:20])
+
+    def test_multiple_ranges(self):
+        response = self.get(Range='bytes=0-4,-5')
+        self.assertEqual(response.status, '206 Partial Content')
+        content_type = response.headers['Content-Type']
+        assert content_type.startswith('multipart/byteranges; boundary=')
+        boundary = content_type.split('=', 1)[1]
+        body = ''.join(response.app_iter)
+        self.assertEqual(response.headers['Content-Length'], str(len(body)))
+        self.assertEqual(body, '\r\n'.join([
+            '--%s'% boundary, 'Content-Type: text/plain',
+            'Content-Range: bytes 0-4/1000', '', self.content[:5],
+            '--%s'% boundary, 'Content-Type: text/plain',
+            'Content-Range: bytes 995-999/1000', '', self.content[-5:],
+            '--%s--'% boundary, '']))
+
+    def test_unsatisfiable(self):
+        response = self.get(Range='bytes=1000-')
+        self.assertEqual(response.status, '416 Requested Range Not Satisfiable')
+        self.assertEqual(response.headers['Content-Range'], 'bytes */1000')
+
+    def test_if_range(self):
+        response = self.get(Range='bytes=0-0', If_Range='"tag"')
+        self.assertEqual(response.status, '206 Partial Content')
+        ''.join(response.app_iter)
+        response = self.get(Range='bytes=0-0', If_Range='Sun, 18 Oct 2009 10:00:00 GMT')
+        self.assertEqual(response.status, '206 Partial Content')
+        ''.join(response.app_iter)
+        response = self.get(Range='bytes=0-0', If_Range='"other"')
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(''.join(response.app_iter), self.content)
+        response = self.get(Range='bytes=0-0', If_Range='Mon, 19 Oct 2009 10:00:00 GMT')
+        self.assertEqual(response.status, '200 OK')
+        ''.join(response.app_iter)
+
+    def test_if_modified_since(self):
+        response = self.get(If_Modified_Since='Sun, 18 Oct 2009 10:00:00 GMT')
+        self.assertEqual(response.status, '304 Not Modified')
+        response = self.get(If_Modified_Since='Sat, 17 Oct 2009 10:00:00 GMT')
+        self.assertEqual(response.status, '200 OK')
+        ''.join(response.app_iter)
+        response = self.get(If_Modified_Since='garbage')
+        self.assertEqual(response.status, '200 OK')
+        ''.join(response.app_iter)
+
+
+class TestResizing(unittest.TestCase):
+
+    def image(self, size, format='PNG'):
+        f = StringIO()
+        fileresource.Image.new('RGB', size, (255, 0, 0)).save(f, format)
+        f.seek(0)
+        return f
+
+    def resize(self, src_size, size, ismax=False, crop=False, format='PNG'):
+        rf = fileresource.pil_resize_image(self.image(src_size, format), size,
+                                           ismax, crop=crop)
+        try:
+            image = fileresource.Image.open(rf)
+            self.assertEqual(image.format, format)
+            return image.size
+        finally:
+            rf.close()
+
+    def test_pil(self):
+        if fileresource.Image is None:
+            return
+        tests = [
+            ((100, 50), (20, 20), False, False, (20, 10)),
+            ((100, 50), (20, None), False, False, (20, 10)),
+            ((100, 50), (None, 10), False, False, (20, 10)),
+            ((100, 50), (200, 200), False, False, (200, 100)),
+            ((100, 50), (200, 200), True, False, (100, 50)),
+            ((100, 50), (20, 20), True, False, (20, 10)),
+            ((100, 50), (20, 20), False, True, (20, 20)),
+            ((100, 50), (20, None), False, True, (20, 10)),
+            ]
+        for src_size, size, ismax, crop, expected in tests:
+            self.assertEqual(self.resize(src_size, size, ismax, crop), expected)
+
+    def test_pil_formats(self):
+        if fileresource.Image is None:
+            return
+        for format in ['JPEG', 'GIF', 'PNG']:
+            self.assertEqual(self.resize((100, 50), (20, 20), format=format), (20, 10))
+
+    def test_pil_stored(self):
+        # A real image read from a headered store, through each way of
+        # resizing.
+        if fileresource.Image is None:
+            return
+        dirname = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(dirname, 'store'))
+            os.mkdir(os.path.join(dirname, 'cache'))
+            resource = fileresource.FileResource.quickstart(
+                os.path.join(dirname, 'store'), os.path.join(dirname, 'cache'))
+            resource.filestores[None].put('foo', self.image((100, 50)), 'tag',
+                                          [('Content-Type', 'image/png')])
+            request = http.Request.blank('/?size=20x20')
+            response = resource.get_file(request, None, 'foo', None)
+            image = fileresource.Image.open(StringIO(''.join(response.app_iter)))
+            self.assertEqual((image.format, image.size), ('PNG', (20, 10)))
+            self.assertEqual(resource.generate(None, 'foo', {'size': '30x30'}), True)
+            cache_tag, headers, f = resource.cache.get('_foo-30x30')
+            try:
+                self.assertEqual(fileresource.Image.open(StringIO(f.read())).size, (30, 15))
+            finally:
+                f.close()
+            pool = fileresource.ResizePool(fileresource.pil_resize_image, processes=1)
+            try:
+                cache_tag, headers, f = resource.filestores[None].get('foo')
+                try:
+                    rf = pool(f, (10, 10), False)
+                finally:
+                    f.close()
+                self.assertEqual(fileresource.Image.open(rf).size, (10, 5))
+                rf.close()
+            finally:
+                pool.close()
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_convert_cleanup(self):
+        dirname = tempfile.mkdtemp()
+        convert = os.path.join(dirname, 'convert')
+        open(convert, 'w').write('#!/bin/sh\nfor arg; do src=$dst; dst=$arg; done\ncp "$src" "$dst"\n')
+        os.chmod(convert, 0700)
+        tempdir, tempfile.tempdir = tempfile.tempdir, os.path.join(dirname, 'tmp')
+        os.mkdir(tempfile.tempdir)
+        original = fileresource.CONVERT
+        fileresource.CONVERT = convert
+        try:
+            rf = fileresource.convert_resize_image(StringIO('image'), (10, 10), False)
+            self.assertEqual(rf.read(), 'image')
+            rf.close()
+            self.assertEqual(os.listdir(tempfile.tempdir), [])
+        finally:
+            fileresource.CONVERT = original
+            tempfile.tempdir = tempdir
+            shutil.rmtree(dirname)
+
+    def test_resizer(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            store = CachedTempFilestore(FileSystemHeaderedFilestore(dirname))
+            store.put('foo', StringIO('image'), 'tag', [('Content-Type', 'image/png')])
+            def resizer(src_fh, size, ismax, quality=70, crop=False):
+                return StringIO('%s %r %r'% (src_fh.read(), size, crop))
+            resource = fileresource.FileResource(store, store, resizer=resizer)
+            request = http.Request.blank('/?size=10x20&crop=1')
+            response = resource.get_file(request, None, 'foo', None)
+            self.assertEqual(''.join(response.app_iter), 'image (10, 20) True')
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_single_flight(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            store = CachedTempFilestore(FileSystemHeaderedFilestore(dirname))
+            store.put('foo', StringIO('image'), 'tag', [('Content-Type', 'image/png')])
+            calls = []
+            def resizer(src_fh, size, ismax, quality=70, crop=False):
+                calls.append(size)
+                time.sleep(0.05)
+                return StringIO('resized')
+            resource = fileresource.FileResource(store, store, resizer=resizer)
+            bodies = []
+            def get():
+                request = http.Request.blank('/?size=10x20')
+                response = resource.get_file(request, None, 'foo', None)
+                bodies.append(''.join(response.app_iter))
+            threads = [threading.Thread(target=get) for n in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(calls, [(10, 20)])
+            self.assertEqual(bodies, ['resized']*5)
+        finally:
+            shutil.rmtree(dirname)
+
+
+class TestDerivatives(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname))
+        self.store.put('foo', StringIO('image'), 'tag', [('Content-Type', 'image/png')])
+        self.store.put('doc', StringIO('text'), 'tag', [('Content-Type', 'text/plain')])
+        self.calls = []
+        def resizer(src_fh, size, ismax, quality=70, crop=False):
+            self.calls.append((size, ismax, crop))
+            return StringIO('resized')
+        self.resource = fileresource.FileResource({'tmp': self.store}, self.store,
+                                                  resizer=resizer)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_generate(self):
+        self.assertEqual(self.resource.generate('tmp', 'foo', {'size': '10x20'}), True)
+        self.assertEqual(self.resource.generate('tmp', 'foo', {'size': '10x20'}), False)
+        self.assertEqual(self.resource.generate('tmp', 'doc', {'size': '10x20'}), False)
+        self.assertEqual(self.resource.generate('tmp', 'foo', {}), False)
+        self.assertRaises(KeyError, self.resource.generate, 'tmp', 'missing', {'size': '1x1'})
+        self.assertEqual(self.calls, [((10, 20), False, False)])
+        # The request is served from the cache.
+        request = http.Request.blank('/?size=10x20')
+        response = self.resource.get_file(request, 'tmp', 'foo', None)
+        self.assertEqual(''.join(response.app_iter), 'resized')
+        self.assertEqual(response.headers['ETag'], 'tag')
+        self.assertEqual(len(self.calls), 1)
+
+    def cached(self):
+        return sorted([key for key, size, atime in self.store.backend.iter_files()
+                       if key.startswith('tmp_')])
+
+    def test_index(self):
+        self.resource.generate('tmp', 'foo', {'size': '10x20'})
+        self.resource.generate('tmp', 'foo', {'size': '30x30', 'crop': '1'})
+        self.assertEqual(self.cached(), ['tmp_foo-10x20', 'tmp_foo-30x30-crop',
+                                         'tmp_foo-derivatives'])
+        # A new version of the original replaces the old version's variants.
+        self.store.put('foo', StringIO('image2'), 'tag2', [('Content-Type', 'image/png')])
+        request = http.Request.blank('/?size=10x20')
+        response = self.resource.get_file(request, 'tmp', 'foo', None)
+        self.assertEqual(response.headers['ETag'], 'tag2')
+        ''.join(response.app_iter)
+        self.assertEqual(self.cached(), ['tmp_foo-10x20', 'tmp_foo-derivatives'])
+        # Requesting a deleted original removes its variants.
+        self.store.delete('foo')
+        self.assertEqual(self.resource.get_file(request, 'tmp', 'foo', None), None)
+        self.assertEqual(self.cached(), [])
+
+    def test_invalidate(self):
+        self.resource.generate('tmp', 'foo', {'size': '10x20'})
+        self.resource.invalidate_derivatives('tmp', 'foo')
+        self.assertEqual(self.cached(), [])
+        self.resource.invalidate_derivatives('tmp', 'foo')
+
+    def test_pipeline(self):
+        pipeline = fileresource.DerivativePipeline(self.resource,
+                ['20x20', 'max-size=100x100&crop=1', {'size': '20x20'}])
+        pipeline.enqueue('tmp', 'foo', ['20x20', '30x30'])
+        pipeline.enqueue('tmp', 'missing')
+        pipeline.join()
+        self.assertEqual(sorted(self.calls), [((20, 20), False, False),
+                                              ((30, 30), False, False),
+                                              ((100, 100), True, True)])
+
+    def test_two_processes(self):
+        # Two processes resizing different images, whose resize and index
+        # locks share lock files the other way round, mustn't deadlock.
+        locks = KeyLocks(self.dirname, stripes=2)
+        def stripes(name):
+            return (locks._stripe(fileresource.get_cache_filename('tmp', name, '-10x10', False))[0],
+                    locks._stripe(fileresource.get_derivative_index_key('tmp', name))[0])
+        names = [str(n) for n in range(100) if stripes(str(n))[0] != stripes(str(n))[1]]
+        names = [names[0]] + [n for n in names if stripes(n) != stripes(names[0])][:1]
+        for name in names:
+            self.store.put(name, StringIO('image'), 'tag', [('Content-Type', 'image/png')])
+        def resizer(src_fh, size, ismax, quality=70, crop=False):
+            # Wait until both processes hold their resize lock.
+            open(os.path.join(self.dirname, 'resizing-%s'% os.getpid()), 'w').close()
+            for n in range(500):
+                if len([f for f in os.listdir(self.dirname) if f.startswith('resizing-')]) == 2:
+                    break
+                time.sleep(0.01)
+            return StringIO('resized')
+        resource = fileresource.FileResource({'tmp': self.store}, self.store, resizer=resizer)
+        resource.resize_locks = locks
+        def generate(name):
+            try:
+                resource.generate('tmp', name, {'size': '10x10'})
+            finally:
+                os._exit(0)
+        processes = [multiprocessing.Process(target=generate, args=(name,)) for name in names]
+        for process in processes:
+            process.start()
+        deadline = time.time() + 10
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+        alive = [process for process in processes if process.is_alive()]
+        for process in alive:
+            process.terminate()
+        self.assertEqual(alive, [])
+        self.assertEqual(self.cached(), sorted(['tmp_%s-10x10'% name for name in names] +
+                                               ['tmp_%s-derivatives'% name for name in names]))
+
+
+class TestResizePool(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname))
+        self.store.put('foo', StringIO('image'), 'tag', [('Content-Type', 'image/png')])
+        self.store.put('slow', StringIO('sleep'), 'tag', [('Content-Type', 'image/png')])
+        self.pool = fileresource.ResizePool(upper_resizer, processes=1, queue_depth=0)
+        self.resource = fileresource.FileResource(self.store, self.store, resizer=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.dirname)
+
+    def test_resize(self):
+        rf = self.pool(StringIO('image'), (10, 10), True, quality=50, crop=True)
+        self.assertEqual(rf.read(), 'IMAGE (10, 10) True 50 True')
+        rf.close()
+        request = http.Request.blank('/?size=10x20')
+        response = self.resource.get_file(request, None, 'foo', None)
+        self.assertEqual(''.join(response.app_iter), 'IMAGE (10, 20) False 70 False')
+
+    def test_replaced(self):
+        # The worker reads the file that was opened, even once a new file
+        # has been put in its place.
+        cache_tag, headers, f = self.store.get('foo')
+        try:
+            self.store.put('foo', StringIO('new image, longer'), 'tag2',
+                           [('Content-Type', 'image/png'), ('Extra', 'header')])
+            rf = self.pool(f, (10, 10), False)
+        finally:
+            f.close()
+        self.assertEqual(rf.read(), 'IMAGE (10, 10) False 70 False')
+        rf.close()
+
+    def test_busy(self):
+        thread = threading.Thread(target=self.pool, args=(StringIO('sleep'), (1, 1), False))
+        thread.start()
+        time.sleep(0.1)
+        try:
+            self.assertRaises(fileresource.ResizeBusy, self.pool, StringIO('image'), (1, 1), False)
+            request = http.Request.blank('/?size=10x20')
+            response = self.resource.get_file(request, None, 'foo', None)
+            self.assertEqual(response.status, '503 Service Unavailable')
+            self.assertEqual(response.headers['Retry-After'], '5')
+            self.resource.serve_original_when_busy = True
+            response = self.resource.get_file(request, None, 'foo', None)
+            self.assertEqual(response.status, '200 OK')
+            self.assertEqual(response.headers.get('ETag'), None)
+            self.assertEqual(''.join(response.app_iter), 'image')
+        finally:
+            thread.join()
+        response = self.resource.get_file(request, None, 'foo', None)
+        self.assertEqual(response.headers['ETag'], 'tag')
+        self.assertEqual(''.join(response.app_iter), 'IMAGE (10, 20) False 70 False')
+
+
 if __name__ == '__main__':
     unittest.main()
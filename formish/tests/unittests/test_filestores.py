@@ -1,11 +1,24 @@
 # -*- coding: utf-8
 from cStringIO import StringIO
+import logging
 import os.path
 import shutil
+import struct
 import tempfile
+import threading
+import time
+from hashlib import md5, sha1
 import unittest
 
-from formish.filestore import CachedTempFilestore, FileSystemHeaderedFilestore
+from formish.filestore import CachedTempFilestore, FileSystemHeaderedFilestore, \
+        SizeLimitExceeded, BudgetedCache, ExpiringTempFilestore, FileSystemFilestore, \
+        ContentAddressedFilestore, AsyncFilestore, MemoryTieredFilestore, \
+        get_many, put_many, delete_many
+
+
+def stored(headers, body):
+    """ The stored form of a file """
+    return 'FMHS\x01' + struct.pack('>I', len(headers)) + headers + body
 
 
 class TestFileSystemHeaderedFileStore(unittest.TestCase):
@@ -19,7 +32,7 @@ class TestFileSystemHeaderedFileStore(unittest.TestCase):
 
     def test_put(self):
         self.store.put('foo', [('Cache-Tag', '1'), ('Content-Type', 'text/plain')], StringIO("Yay!"))
-        assert file(os.path.join(self.dirname, 'foo'), 'rb').read() == 'Cache-Tag: 1\nContent-Type: text/plain\n\nYay!'
+        assert file(os.path.join(self.dirname, 'foo'), 'rb').read() == stored('Cache-Tag: 1\nContent-Type: text/plain\n', 'Yay!')
         (headers, f) = self.store.get('foo')
         try:
             assert headers == [('Cache-Tag', '1'), ('Content-Type', 'text/plain')]
@@ -29,7 +42,7 @@ class TestFileSystemHeaderedFileStore(unittest.TestCase):
 
     def test_put_headersdict(self):
         self.store.put('foo', {'Cache-Tag':'1', 'Content-Type':'text/plain'}, StringIO("Yay!"))
-        assert file(os.path.join(self.dirname, 'foo'), 'rb').read() == 'Cache-Tag: 1\nContent-Type: text/plain\n\nYay!'
+        assert file(os.path.join(self.dirname, 'foo'), 'rb').read() == stored('Cache-Tag: 1\nContent-Type: text/plain\n', 'Yay!')
 
     def test_get(self):
         self.store.put('foo', [('Cache-Tag', '1'), ('Content-Type', 'text/plain')], StringIO("Yay!"))
@@ -62,6 +75,122 @@ class TestFileSystemHeaderedFileStore(unittest.TestCase):
         self.store.delete('fo', glob=True)
         self.assertRaises(KeyError, self.store.get, 'foo')
 
+    def test_max_size(self):
+        self.store.put('foo', [], StringIO('Yay!'), max_size=4)
+        (headers, f) = self.store.get('foo')
+        try:
+            assert f.read() == 'Yay!'
+        finally:
+            f.close()
+        self.assertRaises(SizeLimitExceeded, self.store.put, 'bar', [],
+                          StringIO('Yay!!'), max_size=4)
+        self.assertRaises(KeyError, self.store.get, 'bar')
+
+    def test_max_size_early(self):
+        src = tempfile.TemporaryFile()
+        try:
+            src.write('x' * 100)
+            src.seek(10)
+            self.assertRaises(SizeLimitExceeded, self.store.put, 'foo', [], src,
+                              max_size=80)
+            self.assertEqual(src.tell(), 10)
+            self.assertEqual(os.listdir(self.dirname), [])
+            self.store.put('foo', [], src, max_size=90)
+        finally:
+            src.close()
+        (headers, f) = self.store.get('foo')
+        try:
+            assert f.read() == 'x' * 90
+        finally:
+            f.close()
+
+    def test_chunk_size(self):
+        store = FileSystemHeaderedFilestore(self.dirname, chunk_size=3)
+        store.put('foo', [], StringIO('0123456789'), max_size=10)
+        (headers, f) = store.get('foo')
+        try:
+            assert f.read() == '0123456789'
+        finally:
+            f.close()
+
+    def test_text_format(self):
+        # Files stored before the format was versioned.
+        open(os.path.join(self.dirname, 'foo'), 'wb').write('Cache-Tag: 1\na: \xc2\xa3\n\nYay!')
+        (headers, f) = self.store.get('foo')
+        try:
+            assert headers == [('Cache-Tag', '1'), ('a', u'\xa3')]
+            assert f.read() == 'Yay!'
+        finally:
+            f.close()
+
+    def test_header_line_breaks(self):
+        self.store.put('foo', [('Filename', 'a\rb.txt'), ('a', u'\x85')], StringIO('Yay!'))
+        (headers, f) = self.store.get('foo')
+        try:
+            self.assertEqual(headers, [('Filename', 'a\rb.txt'), ('a', u'\x85')])
+            self.assertEqual(f.read(), 'Yay!')
+        finally:
+            f.close()
+
+    def test_header_escapes(self):
+        headers = [('Filename', 'a\nb\\n.txt'), ('x\ny', 'c\r\n')]
+        self.store.put('foo', headers, StringIO('Yay!'))
+        self.assertEqual(file(os.path.join(self.dirname, 'foo'), 'rb').read(),
+                         stored('Filename: a\\nb\\\\n.txt\nx\\ny: c\\r\\n\n', 'Yay!'))
+        self.assertEqual(self.store.get_headers('foo'), headers)
+
+    def test_unknown_version(self):
+        open(os.path.join(self.dirname, 'foo'), 'wb').write('FMHS\x02\x00\x00\x00\x00')
+        self.assertRaises(ValueError, self.store.get, 'foo')
+
+    def test_get_headers(self):
+        self.store.put('foo', [('Cache-Tag', '1')], StringIO('Yay!'))
+        self.assertEqual(self.store.get_headers('foo'), [('Cache-Tag', '1')])
+        self.assertRaises(KeyError, self.store.get_headers, 'bar')
+
+    def test_empty_headers(self):
+        self.store.put('foo', [], StringIO('Yay!'))
+        (headers, f) = self.store.get('foo')
+        try:
+            assert headers == []
+            assert f.read() == 'Yay!'
+        finally:
+            f.close()
+
+    def test_overwrite(self):
+        self.store.put('foo', [('Cache-Tag', '1')], StringIO('A longer file'))
+        (headers, old) = self.store.get('foo')
+        try:
+            self.store.put('foo', [('Cache-Tag', '2')], StringIO('Short'))
+            # A reader of the old file isn't affected by the overwrite.
+            self.assertEqual(headers, [('Cache-Tag', '1')])
+            self.assertEqual(old.read(), 'A longer file')
+        finally:
+            old.close()
+        self.assertEqual(open(os.path.join(self.dirname, 'foo'), 'rb').read(),
+                         stored('Cache-Tag: 2\n', 'Short'))
+        self.assertEqual(os.listdir(self.dirname), ['foo'])
+
+    def test_failed_overwrite(self):
+        self.store.put('foo', [], StringIO('Yay!'))
+        self.assertRaises(SizeLimitExceeded, self.store.put, 'foo', [],
+                          StringIO('Yay!!'), max_size=4)
+        self.assertEqual(os.listdir(self.dirname), ['foo'])
+        (headers, f) = self.store.get('foo')
+        try:
+            assert f.read() == 'Yay!'
+        finally:
+            f.close()
+
+    def test_fsync(self):
+        store = FileSystemHeaderedFilestore(self.dirname, shard_depth=1, fsync=True)
+        store.put('foo', [], StringIO('Yay!'))
+        (headers, f) = store.get('foo')
+        try:
+            assert f.read() == 'Yay!'
+        finally:
+            f.close()
+
     def test_unicode(self):
         gbp = '£'.decode('utf-8')
         self.store.put('foo', [('a', gbp)], StringIO('foo'))
@@ -82,12 +211,12 @@ class TestCachedTempFilestore(unittest.TestCase):
 
     def test_put(self):
         self.store.put('foo', StringIO('bar'), '1', [('Content-Type', 'text/plain')])
-        assert file(os.path.join(self.dirname, 'foo'), 'rb').read() == 'Cache-Tag: 1\nContent-Type: text/plain\n\nbar'
+        assert file(os.path.join(self.dirname, 'foo'), 'rb').read() == stored('Cache-Tag: 1\nContent-Type: text/plain\n', 'bar')
 
     def test_put_noheaders(self):
         self.store.put('foo', StringIO('bar'), '1')
         self.assertEqual(open(os.path.join(self.dirname, 'foo'), 'rb').read(),
-        'Cache-Tag: 1\n\nbar')
+        stored('Cache-Tag: 1\n', 'bar'))
 
     def test_get(self):
         self.store.put('foo', StringIO('bar'), '1', [('Content-Type', 'text/plain')])
@@ -136,6 +265,617 @@ class TestCachedTempFilestore(unittest.TestCase):
         finally:
             f.close()
 
+    def test_get_headers(self):
+        self.store.put('foo', StringIO('bar'), '1', [('Content-Type', 'text/plain')])
+        self.assertEqual(self.store.get_headers('foo'), ('1', [('Content-Type', 'text/plain')]))
+
+    def test_put_max_size(self):
+        self.assertRaises(SizeLimitExceeded, self.store.put, 'foo',
+                          StringIO('bar'), '1', max_size=2)
+        self.assertRaises(KeyError, self.store.get, 'foo')
+
     def test_delete(self):
         self.assertRaises(OSError, self.store.delete, 'not_found')
 
+
+class TestBudgetedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def keys(self):
+        return sorted(os.listdir(self.dirname))
+
+    def test_entries_budget(self):
+        cache = BudgetedCache(self.store, max_entries=2)
+        cache.put('a', StringIO('a'), '1')
+        cache.put('b', StringIO('b'), '1')
+        cache.get('a')[2].close()
+        cache.put('c', StringIO('c'), '1')
+        self.assertEqual(self.keys(), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+        self.assertRaises(KeyError, cache.get, 'b')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_bytes_budget(self):
+        cache = BudgetedCache(self.store, max_bytes=10)
+        cache.put('a', StringIO('12345'), '1')
+        cache.put('b', StringIO('12345'), '1')
+        self.assertEqual(cache.total_bytes, 10)
+        cache.put('c', StringIO('123'), '1')
+        self.assertEqual(self.keys(), ['b', 'c'])
+        cache.put('b', StringIO('1'), '2')
+        self.assertEqual(cache.total_bytes, 4)
+        # A file bigger than the budget is kept until the next put.
+        cache.put('d', StringIO('x' * 20), '1')
+        self.assertEqual(self.keys(), ['d'])
+        self.assertEqual(cache.evictions, 3)
+
+    def test_delete(self):
+        cache = BudgetedCache(self.store, max_entries=1)
+        cache.put('a', StringIO('a'), '1')
+        cache.delete('a')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_existing_files(self):
+        # Files already in the store are counted, and evicted first.
+        self.store.put('a', StringIO('x' * 10), '1')
+        cache = BudgetedCache(self.store, max_entries=2)
+        cache.put('b', StringIO('12345'), '1')
+        self.assertEqual(self.keys(), ['a', 'b'])
+        cache.put('c', StringIO('12345'), '1')
+        self.assertEqual(self.keys(), ['b', 'c'])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_shared(self):
+        # Caches in separate processes count each other's files when they
+        # rescan the store.
+        caches = [BudgetedCache(self.store, max_entries=2, rescan_interval=0)
+                  for n in range(2)]
+        caches[0].put('a', StringIO('a'), '1')
+        # File times are coarser than time.time().
+        time.sleep(0.02)
+        caches[1].put('b', StringIO('b'), '1')
+        caches[0].put('c', StringIO('c'), '1')
+        self.assertEqual(self.keys(), ['b', 'c'])
+        caches[1].delete('b')
+        caches[0].put('d', StringIO('d'), '1')
+        self.assertEqual(self.keys(), ['c', 'd'])
+        self.assertEqual(len(caches[0]), 2)
+
+    def test_rescan_interval(self):
+        cache = BudgetedCache(self.store, max_entries=1, rescan_interval=None)
+        cache.put('a', StringIO('a'), '1')
+        self.store.put('b', StringIO('b'), '1')
+        cache.put('c', StringIO('c'), '1')
+        self.assertEqual(self.keys(), ['b', 'c'])
+
+
+class TestExpiringTempFilestore(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = ExpiringTempFilestore(FileSystemHeaderedFilestore(self.dirname), ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def index(self):
+        return open(self.store.index_path).read().splitlines()
+
+    def test_put(self):
+        self.store.put('a b', StringIO('12345'), '1')
+        (created, size, key), = [line.split(' ') for line in self.index()]
+        self.assertEqual((size, key), ('5', 'a_b'))
+        assert abs(int(created) - time.time()) < 5
+        (cache_tag, headers, f) = self.store.get('a b')
+        f.close()
+        self.assertEqual(cache_tag, '1')
+
+    def test_sweep(self):
+        now = time.time()
+        self.store.put('a', StringIO('123'), '1')
+        self.store.put('b', StringIO('45'), '1')
+        self.assertEqual(self.store.sweep(now+30), (0, 0))
+        self.assertEqual(len(self.index()), 2)
+        self.store.delete('b')
+        self.assertEqual(self.store.sweep(now+120), (1, 3))
+        self.assertEqual(self.index(), [])
+        self.assertEqual(os.listdir(self.dirname), [ExpiringTempFilestore.index_name])
+        self.assertRaises(KeyError, self.store.get, 'a')
+
+    def test_sweep_stops_at_unexpired(self):
+        open(self.store.index_path, 'w').write('100 1 a\ngarbage\n%d 1 b\n' % (time.time()+1000))
+        self.store.backend.put('a', [], StringIO('a'))
+        self.assertEqual(self.store.sweep(), (1, 1))
+        self.assertEqual(len(self.index()), 1)
+        assert self.index()[0].endswith(' 1 b')
+
+    def test_max_size(self):
+        self.assertRaises(SizeLimitExceeded, self.store.put, 'a', StringIO('123'), '1', max_size=2)
+        self.assertEqual(os.listdir(self.dirname), [])
+
+    def test_sweeper(self):
+        self.store.ttl = 0
+        self.store.put('a', StringIO('123'), '1')
+        stop = self.store.start_sweeper(0.01)
+        try:
+            for n in range(100):
+                if self.index() == []:
+                    break
+                time.sleep(0.01)
+        finally:
+            stop.set()
+        self.assertRaises(KeyError, self.store.get, 'a')
+
+    def test_sweeper_logs_errors(self):
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        def sweep():
+            raise IOError('broken')
+        self.store.sweep = sweep
+        handler = Handler()
+        logger = logging.getLogger('formish')
+        logger.addHandler(handler)
+        try:
+            stop = self.store.start_sweeper(0.01)
+            try:
+                for n in range(100):
+                    if records:
+                        break
+                    time.sleep(0.01)
+            finally:
+                stop.set()
+        finally:
+            logger.removeHandler(handler)
+        assert records[0].exc_info[0] is IOError
+
+
+class TestShardedLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def files(self):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.dirname):
+            dirnames[:] = [d for d in dirnames if d != '.index']
+            for name in filenames:
+                files.append(os.path.relpath(os.path.join(dirpath, name), self.dirname))
+        return sorted(files)
+
+    def test_sharded(self):
+        store = FileSystemHeaderedFilestore(self.dirname, shard_depth=2)
+        store.put('Foo', [('a', 'b')], StringIO('Yay!'))
+        digest = md5('(f)oo').hexdigest()
+        self.assertEqual(self.files(), [os.path.join(digest[:2], digest[2:4], '(f)oo')])
+        (headers, f) = store.get('Foo')
+        try:
+            assert headers == [('a', 'b')]
+            assert f.read() == 'Yay!'
+        finally:
+            f.close()
+        self.assertEqual([key for key, size, atime in store.iter_files()], ['Foo'])
+        store.delete('Foo')
+        self.assertRaises(KeyError, store.get, 'Foo')
+
+    def test_glob_delete(self):
+        store = FileSystemHeaderedFilestore(self.dirname, shard_depth=1)
+        for key in ['foo', 'foo-10x10', 'fob', 'bar']:
+            store.put(key, [], StringIO(key))
+        store.delete('foo', glob=True)
+        self.assertEqual(sorted([k for k, s, a in store.iter_files()]), ['bar', 'fob'])
+
+    def test_indexed_glob_delete(self):
+        store = FileSystemHeaderedFilestore(self.dirname, shard_depth=1, index_prefix=3)
+        for key in ['foo', 'foo-10x10', 'fob', 'bar', 'foo']:
+            store.put(key, [], StringIO(key))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dirname, '.index'))),
+                         ['bar', 'fob', 'foo'])
+        # Doesn't need to list the store.
+        store._iter_names = None
+        store.delete('foo', glob=True)
+        self.assertRaises(KeyError, store.get, 'foo-10x10')
+        self.assertEqual(open(os.path.join(self.dirname, '.index', 'foo')).read(), '')
+        store.put('foo-20x20', [], StringIO('foo'))
+        store.delete('foo-', glob=True)
+        self.assertRaises(KeyError, store.get, 'foo-20x20')
+        self.assertEqual(store.get('fob')[0], [])
+
+    def test_migrate(self):
+        flat = FileSystemHeaderedFilestore(self.dirname)
+        for key in ['a', 'b', 'c']:
+            flat.put(key, [('key', key)], StringIO(key))
+        sharded = FileSystemHeaderedFilestore(self.dirname, shard_depth=2, index_prefix=1)
+        self.assertEqual(sharded.migrate(), 3)
+        self.assertEqual(sharded.migrate(), 0)
+        for key in ['a', 'b', 'c']:
+            (headers, f) = sharded.get(key)
+            try:
+                assert headers == [('key', key)]
+                assert f.read() == key
+            finally:
+                f.close()
+        self.assertEqual(len(self.files()), 3)
+        assert 'a' not in os.listdir(self.dirname)
+        sharded.delete('a', glob=True)
+        self.assertRaises(KeyError, sharded.get, 'a')
+        # And back again.
+        self.assertEqual(flat.migrate(previous_shard_depth=2), 2)
+        self.assertEqual(sorted(os.listdir(self.dirname)), ['b', 'c'])
+
+    def test_migrate_shared_root(self):
+        # Files the store didn't write are left alone.
+        open(os.path.join(self.dirname, 'other'), 'w').write('other data')
+        open(os.path.join(self.dirname, 'old'), 'w').write('key: old\n\nold')
+        flat = FileSystemHeaderedFilestore(self.dirname)
+        flat.put('new', [], StringIO('new'))
+        sharded = FileSystemHeaderedFilestore(self.dirname, shard_depth=1, index_prefix=1)
+        self.assertEqual(sharded.migrate(), 2)
+        names = os.listdir(self.dirname)
+        assert 'other' in names and 'old' not in names and 'new' not in names
+        self.assertEqual(sharded.get_headers('old'), [('key', 'old')])
+        sharded.delete('o', glob=True)
+        self.assertEqual(open(os.path.join(self.dirname, 'other')).read(), 'other data')
+
+    def test_shared_root(self):
+        # Other files and directories in the root aren't part of the store.
+        os.makedirs(os.path.join(self.dirname, 'otherapp', 'ab'))
+        open(os.path.join(self.dirname, 'otherapp', 'foo-data'), 'w').write('data')
+        open(os.path.join(self.dirname, 'otherapp', 'ab', 'foo'), 'w').write('data')
+        flat = FileSystemHeaderedFilestore(self.dirname)
+        flat.put('foo', [], StringIO('foo'))
+        flat.delete('foo', glob=True)
+        self.assertEqual(self.files(), [os.path.join('otherapp', 'ab', 'foo'),
+                                        os.path.join('otherapp', 'foo-data')])
+        self.assertEqual(flat.migrate(), 0)
+        sharded = FileSystemHeaderedFilestore(self.dirname, shard_depth=1)
+        sharded.put('foo', [], StringIO('foo'))
+        self.assertEqual(sharded.migrate(), 0)
+        self.assertEqual([k for k, s, a in sharded.iter_files()], ['foo'])
+        sharded.delete('fo', glob=True)
+        self.assertEqual(self.files(), [os.path.join('otherapp', 'ab', 'foo'),
+                                        os.path.join('otherapp', 'foo-data')])
+
+    def test_index_pruned(self):
+        store = FileSystemHeaderedFilestore(self.dirname, shard_depth=1, index_prefix=1)
+        for key in ['a1', 'a2', 'a3', 'b1']:
+            store.put(key, [], StringIO(key))
+        store.delete('a1')
+        store.delete_many(['a2', 'b1'])
+        index_dir = os.path.join(self.dirname, '.index')
+        self.assertEqual(open(os.path.join(index_dir, 'a')).read(), 'a3\n')
+        self.assertEqual(open(os.path.join(index_dir, 'b')).read(), '')
+
+    def test_plain_store(self):
+        store = FileSystemFilestore(self.dirname, shard_depth=1)
+        store.put('foo', [], StringIO('foo'))
+        digest = md5('foo').hexdigest()
+        self.assertEqual(self.files(), [os.path.join(digest[:2], 'foo')])
+        store.delete('foo')
+        self.assertEqual(self.files(), [])
+
+
+class TestContentAddressedFilestore(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = ContentAddressedFilestore(self.dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def contents(self):
+        return sorted([k for k, size, atime in self.store.contents.iter_files()])
+
+    def read(self, key):
+        (cache_tag, headers, f) = self.store.get(key)
+        try:
+            return cache_tag, headers, f.read()
+        finally:
+            f.close()
+
+    def test_put_get(self):
+        digest = self.store.put('foo', StringIO('bar'), 'ignored', [('Content-Type', 'text/plain')])
+        self.assertEqual(digest, sha1('bar').hexdigest())
+        self.assertEqual(self.read('foo'), (digest, [('Content-Type', 'text/plain')], 'bar'))
+        self.assertEqual(self.store.get('foo', digest), (digest, [('Content-Type', 'text/plain')], None))
+        self.assertEqual(self.store.get_headers('foo'), (digest, [('Content-Type', 'text/plain')]))
+        self.assertRaises(KeyError, self.store.get, 'missing')
+
+    def test_dedup(self):
+        digest = self.store.put('a', StringIO('same'), None)
+        self.store.put('b', StringIO('same'), None, [('Filename', 'b')])
+        self.assertEqual(self.contents(), [digest])
+        self.assertEqual(self.read('b'), (digest, [('Filename', 'b')], 'same'))
+        self.store.delete('a')
+        self.assertEqual(self.read('b')[2], 'same')
+        self.store.delete('b')
+        self.assertEqual(self.contents(), [])
+        self.assertRaises(KeyError, self.store.get, 'b')
+
+    def test_replace(self):
+        self.store.put('a', StringIO('one'), None)
+        self.store.put('b', StringIO('one'), None)
+        self.store.put('a', StringIO('two'), None)
+        self.assertEqual(self.read('a')[2], 'two')
+        self.assertEqual(self.read('b')[2], 'one')
+        self.store.put('b', StringIO('two'), None)
+        self.assertEqual(self.contents(), [sha1('two').hexdigest()])
+        # Putting the same content again doesn't count it twice.
+        self.store.put('b', StringIO('two'), None)
+        self.store.delete('a')
+        self.store.delete('b')
+        self.assertEqual(self.contents(), [])
+
+    def test_real_file(self):
+        src = tempfile.TemporaryFile()
+        try:
+            src.write('xxreal')
+            src.seek(2)
+            digest = self.store.put('a', src, None)
+        finally:
+            src.close()
+        self.assertEqual(digest, sha1('real').hexdigest())
+        self.assertEqual(self.read('a')[2], 'real')
+
+    def test_budgeted(self):
+        cache = BudgetedCache(self.store, max_entries=1)
+        src = tempfile.TemporaryFile()
+        try:
+            src.write('real')
+            src.seek(0)
+            cache.put('a', src, None, [])
+        finally:
+            src.close()
+        self.assertEqual(self.read('a')[2], 'real')
+        self.assertEqual(cache.total_bytes, 4)
+        cache.put('b', StringIO('other'), None)
+        self.assertEqual(self.contents(), [sha1('other').hexdigest()])
+        self.assertEqual([n for n in os.listdir(self.dirname) if n.startswith('.tmp')], [])
+
+    def test_max_size(self):
+        self.assertRaises(SizeLimitExceeded, self.store.put, 'a', StringIO('123'), None, max_size=2)
+        src = tempfile.TemporaryFile()
+        try:
+            src.write('123')
+            src.seek(0)
+            self.assertRaises(SizeLimitExceeded, self.store.put, 'a', src, None, max_size=2)
+        finally:
+            src.close()
+        self.assertEqual(self.contents(), [])
+        self.assertEqual([n for n in os.listdir(self.dirname) if n.startswith('.tmp')], [])
+
+
+class TestMemoryTieredFilestore(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.backend = FileSystemHeaderedFilestore(self.dirname)
+        self.store = MemoryTieredFilestore(self.backend, max_bytes=10, max_file_size=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def read(self, key):
+        headers, f = self.store.get(key)
+        try:
+            return headers, f.read()
+        finally:
+            f.close()
+
+    def test_memory(self):
+        self.store.put('foo', [('Cache-Tag', '1')], StringIO('Yay!'))
+        os.remove(os.path.join(self.dirname, 'foo'))
+        self.assertEqual(self.read('foo'), ([('Cache-Tag', '1')], 'Yay!'))
+        self.assertEqual(self.store.get_headers('foo'), [('Cache-Tag', '1')])
+        self.assertEqual((self.store.hits, self.store.misses), (2, 0))
+        self.assertEqual(self.store.get('foo')[1].mtime is not None, True)
+
+    def test_put_not_read_back(self):
+        reads = []
+        get = self.backend.get
+        self.backend.get = lambda key: reads.append(key) or get(key)
+        self.store.put('foo', {'Filename': u'\xa3'}, StringIO('Yay!'))
+        self.store.put_many([('bar', [('Cache-Tag', 1)], StringIO('bar'))])
+        self.assertEqual(self.read('foo'), ([('Filename', u'\xa3')], 'Yay!'))
+        self.assertEqual(self.read('bar'), ([('Cache-Tag', u'1')], 'bar'))
+        self.assertEqual(reads, [])
+        self.assertEqual(self.backend.get_headers('foo'), [('Filename', u'\xa3')])
+
+    def test_read_through(self):
+        self.backend.put('foo', [], StringIO('Yay!'))
+        self.assertEqual(self.read('foo'), ([], 'Yay!'))
+        os.remove(os.path.join(self.dirname, 'foo'))
+        self.assertEqual(self.read('foo'), ([], 'Yay!'))
+        self.assertEqual((self.store.hits, self.store.misses), (1, 1))
+        self.assertRaises(KeyError, self.store.get, 'missing')
+
+    def test_large(self):
+        self.store.put('foo', [], StringIO('Too big'))
+        headers, f = self.store.get('foo')
+        try:
+            self.assertEqual(hasattr(f, 'fileno'), True)
+            self.assertEqual(f.read(), 'Too big')
+        finally:
+            f.close()
+
+    def test_budget(self):
+        for key in ['a', 'b', 'c']:
+            self.store.put(key, [], StringIO('1234'))
+        self.read('a')
+        for key in ['a', 'b', 'c']:
+            os.remove(os.path.join(self.dirname, key))
+        self.assertEqual(self.read('a'), ([], '1234'))
+        self.assertEqual(self.read('c'), ([], '1234'))
+        self.assertRaises(KeyError, self.store.get, 'b')
+
+    def test_overwrite(self):
+        self.store.put('foo', [], StringIO('one'))
+        self.store.put('foo', [], StringIO('two'))
+        self.assertEqual(self.read('foo'), ([], 'two'))
+        self.store.put('foo', [], StringIO('Too big'))
+        self.assertEqual(self.read('foo'), ([], 'Too big'))
+
+    def test_delete(self):
+        self.store.put('foo', [], StringIO('foo'))
+        self.store.put('foo2', [], StringIO('foo2'))
+        self.store.put('bar', [], StringIO('bar'))
+        self.store.delete('bar')
+        self.assertRaises(KeyError, self.store.get, 'bar')
+        self.store.delete('foo', glob=True)
+        self.assertRaises(KeyError, self.store.get, 'foo')
+        self.assertRaises(KeyError, self.store.get, 'foo2')
+
+    def test_cached_temp_filestore(self):
+        store = CachedTempFilestore(self.store)
+        store.put('foo', StringIO('Yay!'), 'tag', [('Content-Type', 'text/plain')])
+        self.assertEqual(store.get('foo', 'tag'), ('tag', [('Content-Type', 'text/plain')], None))
+        cache_tag, headers, f = store.get('foo')
+        try:
+            self.assertEqual(f.read(), 'Yay!')
+        finally:
+            f.close()
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def files(self, store):
+        return sorted([key for key, size, atime in store.iter_files()])
+
+    def test_headered(self):
+        for store in [FileSystemHeaderedFilestore(self.dirname),
+                      FileSystemHeaderedFilestore(self.dirname, shard_depth=1,
+                                                  index_prefix=2, fsync=True)]:
+            store.put_many([('foo1', [('a', '1')], StringIO('one')),
+                            ('foo2', [], StringIO('two')),
+                            ('bar', [], StringIO('bar'))])
+            files = store.get_many(['foo1', 'bar', 'missing'])
+            self.assertEqual(sorted(files), ['bar', 'foo1'])
+            headers, f = files['foo1']
+            self.assertEqual((headers, f.read()), ([('a', '1')], 'one'))
+            for headers, f in files.values():
+                f.close()
+            store.delete_many(['bar', 'missing'])
+            self.assertEqual(self.files(store), ['foo1', 'foo2'])
+            store.put('baz', [], StringIO('baz'))
+            store.delete_many(['fo', 'ba'], glob=True)
+            self.assertEqual(self.files(store), [])
+
+    def test_plain(self):
+        store = FileSystemFilestore(self.dirname, shard_depth=1, index_prefix=1)
+        store.put_many([('a1', [], StringIO('one')), ('a2', [], StringIO('two')),
+                        ('b', [], StringIO('b'))])
+        files = store.get_many(['a1', 'missing'])
+        self.assertEqual(files.keys(), ['a1'])
+        headers, f = files['a1']
+        self.assertEqual((headers, f.read()), ([], 'one'))
+        f.close()
+        self.assertEqual(sorted(get_many(store, ['a2', 'b'])), ['a2', 'b'])
+        store.delete_many(['b', 'missing'])
+        store.delete_many(['a'], glob=True)
+        self.assertEqual(store.get_many(['a1', 'a2', 'b']), {})
+
+    def test_put_many_max_size(self):
+        store = FileSystemHeaderedFilestore(self.dirname)
+        self.assertRaises(SizeLimitExceeded, store.put_many,
+                          [('a', [], StringIO('12')), ('b', [], StringIO('123'))], max_size=2)
+        # The sizes are known so nothing is stored.
+        self.assertEqual(self.files(store), [])
+
+    def test_cached_temp_filestore(self):
+        store = CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname))
+        store.put_many([('a', StringIO('a'), 'tag-a', [('Content-Type', 'text/plain')]),
+                        ('b', StringIO('b'), None)])
+        files = store.get_many(['a', 'b', 'c'])
+        self.assertEqual(sorted(files), ['a', 'b'])
+        self.assertEqual(files['a'][:2], ('tag-a', [('Content-Type', 'text/plain')]))
+        self.assertEqual(files['b'][:2], (None, []))
+        for cache_tag, headers, f in files.values():
+            f.close()
+        store.delete_many(['a', 'b', 'c'])
+        self.assertEqual(store.get_many(['a', 'b']), {})
+
+    def test_memory_tier(self):
+        store = MemoryTieredFilestore(FileSystemHeaderedFilestore(self.dirname))
+        store.put_many([('a', [], StringIO('a')), ('b', [], StringIO('b'))])
+        store.delete_many(['a'])
+        self.assertEqual(sorted(store.get_many(['a', 'b'])), ['b'])
+        store.delete_many(['b'], glob=True)
+        self.assertEqual(store.get_many(['a', 'b']), {})
+
+    def test_expiring(self):
+        store = ExpiringTempFilestore(FileSystemHeaderedFilestore(self.dirname), ttl=10)
+        store.put_many([('a', StringIO('a'), None), ('b', StringIO('bb'), None)])
+        self.assertEqual(store.sweep(time.time() + 20), (2, 3))
+
+    def test_fallback(self):
+        # BudgetedCache has no batch methods of its own.
+        store = BudgetedCache(CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname)))
+        put_many(store, [('a', StringIO('a'), 'tag'), ('b', StringIO('b'), 'tag')])
+        files = get_many(store, ['a', 'b', 'c'])
+        self.assertEqual(sorted(files), ['a', 'b'])
+        for cache_tag, headers, f in files.values():
+            f.close()
+        delete_many(store, ['a', 'c'])
+        self.assertEqual(sorted(get_many(store, ['a', 'b'])), ['b'])
+        self.assertRaises(SizeLimitExceeded, put_many,
+                          CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname)),
+                          [('c', StringIO('123'), None)], max_size=2)
+
+
+class TestAsyncFilestore(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.store = AsyncFilestore(
+            CachedTempFilestore(FileSystemHeaderedFilestore(self.dirname)), workers=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_put_get(self):
+        self.assertEqual(self.store.put('foo', StringIO('bar'), 'tag').result(5), None)
+        cache_tag, headers, f = self.store.get('foo').result(5)
+        self.assertEqual((cache_tag, headers), ('tag', []))
+        self.assertEqual(self.store.read(f).result(5), 'bar')
+        f.close()
+        self.assertEqual(self.store.get('foo', 'tag').result(5), ('tag', [], None))
+        self.assertEqual(self.store.get_headers('foo').result(5), ('tag', []))
+
+    def test_errors(self):
+        future = self.store.get('missing')
+        self.assertRaises(KeyError, future.result, 5)
+        self.assertTrue(isinstance(future.exception(), KeyError))
+
+    def test_callback(self):
+        results = []
+        done = threading.Event()
+        def callback(future):
+            results.append(future.result())
+            done.set()
+        self.store.put('foo', StringIO('bar'), 'tag').result(5)
+        self.store.delete('foo').add_done_callback(callback)
+        done.wait(5)
+        self.assertEqual(results, [None])
+        # Callbacks added after the call has finished are called at once.
+        future = self.store.get_headers('missing')
+        future.exception(5)
+        future.add_done_callback(lambda future: results.append('late'))
+        self.assertEqual(results, [None, 'late'])
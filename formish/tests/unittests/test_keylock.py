@@ -0,0 +1,106 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from formish._keylock import KeyLocks
+
+
+class TestKeyLocks(unittest.TestCase):
+
+    def run_threads(self, locks_list, keys):
+        """
+        Run a thread per (locks, key), each recording when it held its lock.
+        """
+        held = []
+        def work(locks, key):
+            locks.acquire(key)
+            try:
+                held.append((key, 'in'))
+                time.sleep(0.01)
+                held.append((key, 'out'))
+            finally:
+                locks.release(key)
+        threads = [threading.Thread(target=work, args=(locks, key))
+                   for locks, key in zip(locks_list, keys)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return held
+
+    def test_same_key(self):
+        locks = KeyLocks()
+        held = self.run_threads([locks]*4, ['a']*4)
+        self.assertEqual(held, [('a', 'in'), ('a', 'out')]*4)
+        self.assertEqual(locks._locks, {})
+
+    def test_different_keys(self):
+        locks = KeyLocks()
+        held = self.run_threads([locks]*2, ['a', 'b'])
+        self.assertEqual([h[1] for h in held], ['in', 'in', 'out', 'out'])
+
+    def test_lock_dir(self):
+        # Separate KeyLocks exclude each other through the lock files, as
+        # separate processes would.
+        dirname = tempfile.mkdtemp()
+        try:
+            held = self.run_threads([KeyLocks(dirname) for n in range(3)], ['a/b']*3)
+            self.assertEqual(held, [('a/b', 'in'), ('a/b', 'out')]*3)
+            self.assertEqual(len(os.listdir(dirname)), 1)
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_stripes(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            locks = KeyLocks(dirname, stripes=4)
+            for n in range(50):
+                locks.acquire(str(n))
+                locks.release(str(n))
+            self.assertTrue(len(os.listdir(dirname)) <= 4)
+            # Keys sharing a stripe can be held together by one process.
+            locks = KeyLocks(dirname, stripes=1)
+            locks.acquire('a')
+            locks.acquire(u'b')
+            locks.release('a')
+            locks.release(u'b')
+            self.assertEqual(locks._locks, {})
+            # And the stripe is free for another process.
+            held = self.run_threads([KeyLocks(dirname, stripes=1) for n in range(2)], ['a', 'b'])
+            self.assertEqual([h[1] for h in held], ['in', 'out', 'in', 'out'])
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_held_by_other_process(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            other = open(os.path.join(dirname, '.lock-00'), 'a')
+            fcntl.flock(other.fileno(), fcntl.LOCK_EX)
+            locks = KeyLocks(dirname, stripes=1)
+            held = []
+            def work(key):
+                locks.acquire(key)
+                held.append(key)
+                locks.release(key)
+            threads = [threading.Thread(target=work, args=(key,)) for key in ['a', 'b']]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.05)
+            self.assertEqual(held, [])
+            # Both threads get the stripe once the other process lets go.
+            fcntl.flock(other.fileno(), fcntl.LOCK_UN)
+            other.close()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sorted(held), ['a', 'b'])
+            self.assertEqual(locks._stripes[0][1:], [None, 0])
+        finally:
+            shutil.rmtree(dirname)
+
+
+if __name__ == '__main__':
+    unittest.main()
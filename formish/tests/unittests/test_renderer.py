@@ -3,6 +3,7 @@ import shutil
 import tempfile
 import unittest
 from formish.renderer import Renderer, _default_renderer
+from formish.forms import fall_back_renderer
 
 
 class TestRenderer(unittest.TestCase):
@@ -26,6 +27,64 @@ class TestRenderer(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+class CountingRenderer(Renderer):
+
+    def __init__(self, directories=None):
+        Renderer.__init__(self, directories)
+        self.lookups = []
+        self.renders = []
+        get_template = self.lookup.get_template
+        def counting_get_template(uri):
+            self.lookups.append(uri)
+            return get_template(uri)
+        self.lookup.get_template = counting_get_template
+
+    def __call__(self, template, args):
+        self.renders.append(template)
+        return Renderer.__call__(self, template, args)
+
+
+class TestFallBackRenderer(unittest.TestCase):
+
+    def test_resolution_cached(self):
+        renderer = CountingRenderer()
+        self.assertTrue('seqgrab' in fall_back_renderer(renderer, 'field/seqgrab', 'Input', {'field': None}))
+        self.assertTrue('/formish/widgets/Input/field/seqgrab.html' in renderer.lookups)
+        renderer.lookups = []
+        renderer.renders = []
+        self.assertTrue('seqgrab' in fall_back_renderer(renderer, 'field/seqgrab', 'Input', {'field': None}))
+        self.assertEqual(renderer.lookups, ['/formish/field/seqgrab.html'])
+        self.assertEqual(renderer.renders, ['/formish/field/seqgrab.html'])
+
+    def test_directories_changed(self):
+        template = 'formish/widgets/Input/field/seqgrab.html'
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tmptemplate = os.path.join(tmpdir, template)
+            os.makedirs(os.path.dirname(tmptemplate))
+            open(tmptemplate, 'w').write('custom')
+            renderer = Renderer()
+            self.assertTrue('seqgrab' in fall_back_renderer(renderer, 'field/seqgrab', 'Input', {'field': None}))
+            renderer.lookup.directories.insert(0, tmpdir)
+            self.assertEqual(fall_back_renderer(renderer, 'field/seqgrab', 'Input', {'field': None}), 'custom')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_callable_renderer(self):
+        import mako.exceptions
+        calls = []
+        def renderer(template, args):
+            calls.append(template)
+            if template.startswith('/formish/widgets/'):
+                raise mako.exceptions.TopLevelLookupException(template)
+            return template
+        self.assertEqual(fall_back_renderer(renderer, 'field/label', 'Input', {}), '/formish/field/label.html')
+        self.assertEqual(fall_back_renderer(renderer, 'field/label', 'Input', {}), '/formish/field/label.html')
+        self.assertEqual(calls, ['/formish/widgets/Input/field/label.html',
+                                 '/formish/field/label.html',
+                                 '/formish/field/label.html'])
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 import base
+import cgi
+import os
+import shutil
+import tempfile
 import unittest
+from StringIO import StringIO
 import formish
+from formish.filestore import CachedTempFilestore, FileSystemHeaderedFilestore
 import schemaish
 from BeautifulSoup import BeautifulSoup
 from datetime import date
@@ -309,6 +315,64 @@ class TestFileUpload(base.TestCase):
         assert 'foo' in html
         assert '/images/blank.png?size=40x40' in html
 
+    def test_max_size(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            schema = schemaish.Structure()
+            schema.add('foo', schemaish.File())
+            form = formish.Form(schema, 'form')
+            store = CachedTempFilestore(FileSystemHeaderedFilestore(dirname))
+            form['foo'].widget = formish.FileUpload(store, max_size=5)
+            def upload(content):
+                upload = cgi.FieldStorage()
+                upload.file = StringIO(content)
+                upload.type = 'text/plain'
+                upload.filename = 'foo.txt'
+                return self.Request('form', [('foo.name', ''), ('foo.default', ''),
+                                                ('foo.file', upload)])
+            data = form.validate(upload('12345'))
+            self.assertEqual(data['foo'].file.read(), '12345')
+            data['foo'].file.close()
+            self.assertRaises(formish.FormError, form.validate, upload('123456'))
+            assert 'too large' in str(form.errors['foo'])
+            self.assertEqual(len(os.listdir(dirname)), 1)
+            # A posted toolarge field is just ignored.
+            request = self.Request('form', [('foo.name', ''), ('foo.default', ''),
+                                            ('foo.toolarge', '1')])
+            self.assertEqual(form.validate(request), {'foo': None})
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_derivatives(self):
+        class Derivatives(object):
+            queued = []
+            def enqueue(self, filestore_name, key, presets=None):
+                self.queued.append((filestore_name, key, presets))
+        dirname = tempfile.mkdtemp()
+        try:
+            schema = schemaish.Structure()
+            schema.add('foo', schemaish.File())
+            form = formish.Form(schema, 'form')
+            store = CachedTempFilestore(FileSystemHeaderedFilestore(dirname))
+            derivatives = Derivatives()
+            form['foo'].widget = formish.FileUpload(store, show_image_thumbnail=True,
+                                                    derivatives=derivatives)
+            for type in ['image/png', 'text/plain']:
+                upload = cgi.FieldStorage()
+                upload.file = StringIO('data')
+                upload.type = type
+                upload.filename = 'foo'
+                data = form.validate(self.Request('form', [('foo.name', ''), ('foo.default', ''),
+                                                           ('foo.file', upload)]))
+                data['foo'].file.close()
+            self.assertEqual(len(derivatives.queued), 1)
+            filestore_name, key, presets = derivatives.queued[0]
+            self.assertEqual(filestore_name, 'tmp')
+            self.assertEqual(presets, ['20x20'])
+            assert key in os.listdir(dirname)
+        finally:
+            shutil.rmtree(dirname)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -12,12 +12,15 @@ from schemaish.type import File as SchemaFile
 import uuid
 
 from formish import util
-from formish.filestore import CachedTempFilestore
+from formish.filestore import CachedTempFilestore, SizeLimitExceeded
 from validatish import Invalid
 
 
 UNSET = object()
 
+# Marks a rejected upload in the request data; it's never a posted value.
+_TOO_LARGE = object()
+
 def recursive_convert_sequences(data):
     """
     recursively applies ``convert_sequences``
@@ -602,9 +605,14 @@ class FileUpload(Widget):
                  show_download_link=False, show_image_thumbnail=False,
                  url_base=None, css_class=None, image_thumbnail_default=None,
                  show_remove_checkbox=True, url_ident_factory=None,
-                 thumbnail_size="20x20"):
+                 thumbnail_size="20x20", max_size=None, derivatives=None):
         """
         :arg filestore: filestore for temporary files
+        :arg derivatives: a fileresource.DerivativePipeline to generate resized
+            copies of uploaded images (including the thumbnail) in the
+            background.
+        :arg max_size: maximum size of an upload in bytes. Larger uploads are
+            rejected with a conversion error without being stored.
         :arg show_image_thumbnail: a boolean that, if set, will include an image
             thumbnail with the widget
         :arg css_class: extra css classes to apply to the widget
@@ -631,6 +639,8 @@ class FileUpload(Widget):
         self.url_ident_factory = url_ident_factory
         self.show_remove_checkbox = show_remove_checkbox
         self.thumbnail_size = thumbnail_size
+        self.max_size = max_size
+        self.derivatives = derivatives
 
     def __repr__(self):
         attributes = []
@@ -651,6 +661,8 @@ class FileUpload(Widget):
             attributes.append('css_class=%r'%self.css_class)
         if self.empty is not None:
             attributes.append('empty=%r'%self.empty)
+        if self.max_size is not None:
+            attributes.append('max_size=%r'%self.max_size)
         attributes.append('thumbnailsize=%r'%self.thumbnail_size)
 
         return 'formish.%s(%s)'%(self.__class__.__name__, ', '.join(attributes))
@@ -698,11 +710,26 @@ class FileUpload(Widget):
             # creating an additional temp file?
             key = uuid.uuid4().hex
             cache_tag = uuid.uuid4().hex
-            self.filestore.put(key, fieldstorage.file, cache_tag,
-                               [('Content-Type', fieldstorage.type),
-                                ('Filename', fieldstorage.filename)])
+            headers = [('Content-Type', fieldstorage.type),
+                       ('Filename', fieldstorage.filename)]
+            try:
+                if self.max_size is None:
+                    self.filestore.put(key, fieldstorage.file, cache_tag, headers)
+                else:
+                    self.filestore.put(key, fieldstorage.file, cache_tag, headers,
+                                       max_size=self.max_size)
+            except SizeLimitExceeded:
+                # Keep whatever was there before and report the problem when
+                # the data is converted.
+                data['toolarge'] = [_TOO_LARGE]
+                return data
             data['name'] = [util.encode_file_resource_path('tmp', key)]
             data['mimetype'] = [fieldstorage.type]
+            if self.derivatives is not None and fieldstorage.type.startswith('image/'):
+                presets = []
+                if self.show_image_thumbnail:
+                    presets.append(self.thumbnail_size)
+                self.derivatives.enqueue('tmp', key, presets)
         return data
     
     def from_request_data(self, field, request_data):
@@ -711,6 +738,9 @@ class FileUpload(Widget):
         """
         # XXX We could add a file converter that converts this to a string data?
 
+        if self.max_size is not None and \
+                request_data.get('toolarge', [None])[0] is _TOO_LARGE:
+            raise ConvertError('The file is too large (the maximum size is %s bytes)'%self.max_size)
         if request_data['name'] == ['']:
             return None
         elif request_data['name'] == request_data['default']:
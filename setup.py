@@ -45,6 +45,8 @@ Formish is a schema backed, templating language agnostic form generation and han
       ],
       extras_require={
           'File Resource': ['restish'],
+          'Image Resizing': ['Pillow'],
+          'Brotli Compression': ['brotli'],
       },
       entry_points="""
       # -*- Entry points: -*-